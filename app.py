@@ -5,10 +5,9 @@ import os
 import logging
 import traceback
 import atexit  # Added import atexit
+import click
 from best_setup_voting import init_best_setup_voting_routes, auto_finalize_best_setup_voting
 from datetime import datetime, timedelta
-from urllib.parse import urlparse, urlunparse, parse_qs, urlencode
-from web3 import Web3  # Added Web3 import
 import pytz
 import boto3
 from botocore.exceptions import ClientError
@@ -23,16 +22,26 @@ from routes_staking import staking_bp  # Make sure routes_staking.py exists and
 
 
 
-# Adding OpenAI
-import openai
+# Adding OpenAI (загружается при первом обращении, см. lazy_imports.py)
+from lazy_imports import LazyObject, lazy_import, on_import
+openai = lazy_import('openai')
 
 # Adding APScheduler for job scheduling
 from apscheduler.schedulers.background import BackgroundScheduler
 
 # Import models and forms
 import models  # Make sure models.py imports db from extensions.py
-from poll_functions import start_new_poll, process_poll_results, update_real_prices_for_active_polls
+from poll_functions import start_new_poll, process_poll_results, update_real_prices_for_active_polls, process_pending_payouts
+from chat_store import purge_expired_conversations
+from poll_aggregates import rebuild_aggregates
+from job_runner import JobRunner
+from app_lifecycle import worker_service
+from db_engines import engine_options, normalize_database_url, get_scheduler_engine, get_lock_engine
+from request_metrics import init_request_metrics
+from profiler import init_profiler
+from read_replica import replica_router
 from staking_logic import (
+    Web3,
     web3,
     WETH_CONTRACT_ADDRESS,
     UJO_CONTRACT_ADDRESS,
@@ -51,14 +60,6 @@ class ConfigScheduler:
 app = Flask(__name__)
 app.config.from_object(ConfigScheduler())
 
-# --- Новая настройка SQLAlchemy Engine Options ---
-app.config['SQLALCHEMY_ENGINE_OPTIONS'] = {
-    'pool_pre_ping': True,       # Проверять соединение перед каждым запросом
-    'pool_recycle': 300,         # Пересоздавать соединения каждые 300 секунд (5 минут)
-    'pool_size': 5,              # Размер пула соединений
-    'max_overflow': 10,          # Дополнительные соединения сверх pool_size
-}
-# --- Конец вставки ---
 
 # Setup CSRF protection
 csrf = CSRFProtect(app)
@@ -107,26 +108,72 @@ if not raw_database_url:
     logger.error("DATABASE_URL is not set in environment variables.")
     raise ValueError("DATABASE_URL is not set in environment variables.")
 
-# Parsing and adjusting the database connection string
-parsed_url = urlparse(raw_database_url)
-
-# Check and add 'sslmode=require' if necessary
-query_params = parse_qs(parsed_url.query)
-if 'sslmode' not in query_params:
-    query_params['sslmode'] = ['require']
-
-new_query = urlencode(query_params, doseq=True)
-parsed_url = parsed_url._replace(query=new_query)
-
-# Updated connection string
-DATABASE_URL = urlunparse(parsed_url)
+# Connection string with sslmode (DB_SSLMODE, default 'require')
+DATABASE_URL = normalize_database_url(raw_database_url)
 
 app.config['SQLALCHEMY_DATABASE_URI'] = DATABASE_URL
 app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+# Пул web-движка (HTTP-запросы, вебхук): DB_POOL_SIZE, DB_MAX_OVERFLOW, DB_POOL_TIMEOUT,
+# DB_POOL_RECYCLE, DB_POOL_PRE_PING. Задания планировщика работают через отдельный движок
+# (SCHEDULER_DB_POOL_SIZE и т.д.), DB_PGBOUNCER=true — режим transaction pooling,
+# DATABASE_DIRECT_URL — прямое соединение для advisory-блокировок (см. db_engines.py)
+app.config['SQLALCHEMY_ENGINE_OPTIONS'] = engine_options('web', DATABASE_URL)
+# Реплика для read-only view (read_replica.py); пусто — всё читается из primary.
+# REPLICA_STICKY_SECONDS — сколько пользователь читает из primary после своей записи
+app.config['REPLICA_DATABASE_URL'] = os.environ.get('REPLICA_DATABASE_URL', '').strip()
 
 # App host settings for link formation
 app.config['APP_HOST'] = os.environ.get('APP_HOST', 'trend-share.onrender.com')
 
+# Максимум сделок в одном импорте журнала (CSV/JSON)
+app.config['MAX_IMPORT_TRADES'] = int(os.environ.get('MAX_IMPORT_TRADES', '10000'))
+
+# Бюджет токенов на контекст сделок в system prompt ассистента
+app.config['ASSISTANT_CONTEXT_TOKEN_BUDGET'] = int(os.environ.get('ASSISTANT_CONTEXT_TOKEN_BUDGET', '2500'))
+
+# Время жизни диалога с ассистентом без активности (секунды), история хранится в БД
+app.config['CHAT_HISTORY_TTL'] = int(os.environ.get('CHAT_HISTORY_TTL', str(24 * 3600)))
+
+# Кэш ответов ассистента: размер (LRU), TTL (секунды), опциональный поиск по эмбеддингам
+app.config['ASSISTANT_CACHE_SIZE'] = int(os.environ.get('ASSISTANT_CACHE_SIZE', '1000'))
+app.config['ASSISTANT_CACHE_TTL'] = int(os.environ.get('ASSISTANT_CACHE_TTL', str(6 * 3600)))
+app.config['ASSISTANT_CACHE_EMBEDDINGS'] = os.environ.get('ASSISTANT_CACHE_EMBEDDINGS', 'false').lower() == 'true'
+app.config['ASSISTANT_CACHE_SIMILARITY'] = float(os.environ.get('ASSISTANT_CACHE_SIMILARITY', '0.95'))
+# Сколько последних реплик диалога (без system prompt) входит в ключ кэша ответов
+app.config['ASSISTANT_CACHE_CONTEXT_TURNS'] = int(os.environ.get('ASSISTANT_CACHE_CONTEXT_TURNS', '4'))
+
+# Загрузка TrendCNN (и torch) при старте процесса; по умолчанию модель загружается
+# при первом анализе графика. С APP_PRELOAD=true (gunicorn --preload, wsgi.py) модель,
+# справочники и шаблоны загружаются один раз в мастере независимо от этого флага
+app.config['TREND_PRELOAD'] = os.environ.get('TREND_PRELOAD', 'false').lower() == 'true'
+# Бэкенд TrendCNN (TREND_BACKEND=eager|torchscript_int8) задаётся переменной окружения,
+# артефакт int8 собирается командой 'python trend_export.py'
+# Тяжёлые подсистемы (torch, matplotlib, numpy, yfinance, openai, web3) загружаются при первом
+# использовании (lazy_imports.py), RPC сети Base — при первом обращении к сети, после неудачи
+# повтор через RPC_RETRY_SECONDS; 'python startup_bench.py --app' — время импорта и RSS по подсистемам
+
+# Максимум записей в кэше результатов анализа графиков
+app.config['CHART_CACHE_SIZE'] = int(os.environ.get('CHART_CACHE_SIZE', '5000'))
+# Отдавать результат и при совпадении всех 256 бит dHash (перекодированный скриншот),
+# а не только при точном совпадении пикселей входа модели
+app.config['CHART_CACHE_MATCH_PHASH'] = os.environ.get('CHART_CACHE_MATCH_PHASH', 'true').lower() == 'true'
+
+# Выборы лидера планировщика (job_runner.py): SCHEDULER_LEADER_ELECTION=true|false,
+# SCHEDULER_LEADER_CHECK_SECONDS; история запусков хранится JOB_RUN_HISTORY_DAYS дней
+# SCHEDULER_JOB_MIN_GAP_RATIO — задание не запускается, если стартовало меньше этой доли интервала назад
+
+# Токен для /metrics/* (Authorization: Bearer <METRICS_TOKEN>); без него — только админская сессия
+app.config['METRICS_TOKEN'] = os.environ.get('METRICS_TOKEN', '').strip()
+# Метрики запросов: N_PLUS_ONE_THRESHOLD (одинаковых запросов за HTTP-запрос до предупреждения),
+# METRICS_MULTIPROC_DIR — общий каталог снимков, если воркеров gunicorn несколько
+# (счётчики завершившихся воркеров копятся там же в retired.json)
+
+# Очередь уведомлений Telegram (telegram_notify.py) настраивается переменными окружения:
+# TELEGRAM_GLOBAL_RATE (сообщений/с на процесс), TELEGRAM_PER_CHAT_INTERVAL (секунды),
+# TELEGRAM_MAX_ATTEMPTS; TELEGRAM_API_BASE_URL — свой/фейковый Bot API ('python fake_telegram_api.py')
+# Приём вебхука (telegram_ingest.py): TELEGRAM_WEBHOOK_WORKERS, TELEGRAM_WEBHOOK_QUEUE_SIZE,
+# TELEGRAM_WEBHOOK_OVERFLOW=reject|drop (503 и повторная доставка Telegram'ом / потеря апдейта)
+
 # Session settings
 app.config['SESSION_COOKIE_SAMESITE'] = 'None'  # Allow cross-domain requests for session cookies
 app.config['SESSION_COOKIE_SECURE'] = True      # Require HTTPS
@@ -144,13 +191,13 @@ if not all([app.config['AWS_ACCESS_KEY_ID'], app.config['AWS_SECRET_ACCESS_KEY']
     logger.error("Some AWS settings are missing from environment variables.")
     raise ValueError("Some AWS settings are missing from environment variables.")
 
-# Initialize S3 client
-s3_client = boto3.client(
+# Initialize S3 client (создаётся при первой загрузке/удалении файла)
+s3_client = LazyObject(lambda: boto3.client(
     's3',
     region_name=app.config['AWS_S3_REGION'],
     aws_access_key_id=app.config['AWS_ACCESS_KEY_ID'],
     aws_secret_access_key=app.config['AWS_SECRET_ACCESS_KEY']
-)
+), 's3_client')
 
 # Initialize extensions with app
 db = SQLAlchemy(app)
@@ -167,6 +214,13 @@ def teardown_request(exception=None):
         db.session.rollback()
     db.session.remove()
 
+# Латентность, SQL и внешние вызовы по endpoint (/metrics), детектор N+1
+init_request_metrics(app)
+# Сэмплирующий профайлер по запросу из админки (/admin/profile/*)
+init_profiler(app)
+# Чтение с реплики для @replica_router.read_only, read-your-writes после записи пользователя
+replica_router.init_app(app)
+
 from mini_game import mini_game_bp, distribute_game_rewards
 
 init_best_setup_voting_routes(app, db)
@@ -389,6 +443,10 @@ def create_predefined_data():
     db.session.commit()
     logger.info("Instruments and (RU) categories successfully added to DB.")
 
+    # Индекс инструментов для ассистента строится по таблице instrument — сбрасываем его
+    from instrument_resolver import reset_instrument_resolver
+    reset_instrument_resolver()
+
     # Ниже аналогично сохраняем критерии на русском.
     categories_data = {
         'Смарт-мани': {
@@ -734,6 +792,13 @@ def initialize():
         # Открываем одно соединение и внутри него делаем все нужные запросы
         with db.engine.connect() as con:
 
+            # Кэш графиков с 64-битным dHash заменён на chart_trend_cache (записи
+            # со слишком грубым ключом могли отдать результат другого графика)
+            try:
+                con.execute("DROP TABLE IF EXISTS chart_analysis_cache")
+            except Exception as e:
+                logger.error(f"Error dropping chart_analysis_cache: {e}")
+
             # Добавляем новую таблицу для игры
             try:
                 con.execute("""
@@ -821,6 +886,13 @@ def initialize():
                 """)
                 logger.info("Column 'voting_screenshot' added to best_setup_candidate if it didn't exist.")
 
+                # Версия журнала пользователя для кэша контекста ассистента
+                con.execute("""
+                    ALTER TABLE "user"
+                    ADD COLUMN IF NOT EXISTS trade_data_version INTEGER NOT NULL DEFAULT 0
+                """)
+                logger.info("Column 'trade_data_version' added to 'user' table if it didn't exist.")
+
             except Exception as e:
                 logger.error(f"ALTER TABLE execution failed: {e}")
 
@@ -894,6 +966,14 @@ def initialize():
         logger.error(f"Error initializing the database: {e}")
         logger.error(traceback.format_exc())
 
+@app.cli.command('rebuild-poll-aggregates')
+@click.option('--poll-id', type=int, default=None, help='Пересчитать только этот опрос.')
+def rebuild_poll_aggregates_command(poll_id):
+    """Пересчитывает агрегаты прогнозов (poll_prediction_aggregate) из user_prediction."""
+    db.create_all()
+    rebuilt = rebuild_aggregates(poll_id)
+    click.echo(f"Rebuilt {rebuilt} poll/instrument aggregates.")
+
 @app.context_processor
 def inject_admin_ids():
     return {'ADMIN_TELEGRAM_IDS': ADMIN_TELEGRAM_IDS}
@@ -922,10 +1002,24 @@ def update_real_prices_job():
     with app.app_context():
         update_real_prices_for_active_polls()
 
+def process_poll_payouts_job():
+    with app.app_context():
+        process_pending_payouts()
+
+def purge_chat_conversations_job():
+    with app.app_context():
+        purge_expired_conversations()
+
 scheduler = BackgroundScheduler(timezone=pytz.UTC)
+# Планировщик работает в каждом процессе, задания выполняет только лидер (job_runner.py)
+job_runner = JobRunner(
+    app, scheduler,
+    engine=lambda: get_scheduler_engine(app),
+    lock_engine=lambda: get_lock_engine(app)
+)
 
 # 1) Auto finalize best_setup_voting every 5 minutes
-scheduler.add_job(
+job_runner.add_job(
     id='Auto Finalize Best Setup Voting',
     func=lambda: auto_finalize_best_setup_voting(),
     trigger='interval',
@@ -934,7 +1028,7 @@ scheduler.add_job(
 )
 
 # 2) Start a new poll every 10 minutes
-scheduler.add_job(
+job_runner.add_job(
     id='Start Poll',
     func=start_new_poll_job,
     trigger='interval',
@@ -943,7 +1037,7 @@ scheduler.add_job(
 )
 
 # 3) Check poll results every 2 minutes (immediately starts a new one)
-scheduler.add_job(
+job_runner.add_job(
     id='Process Poll Results',
     func=process_poll_results_job,
     trigger='interval',
@@ -952,7 +1046,7 @@ scheduler.add_job(
 )
 
 # 4) Accumulate staking rewards — every minute
-scheduler.add_job(
+job_runner.add_job(
     id='Accumulate Staking Rewards',
     func=accumulate_staking_rewards_job,
     trigger='interval',
@@ -961,7 +1055,7 @@ scheduler.add_job(
 )
 
 # 5) Update real price every 2 minutes
-scheduler.add_job(
+job_runner.add_job(
     id='Update Real Prices',
     func=update_real_prices_job,
     trigger='interval',
@@ -971,7 +1065,7 @@ scheduler.add_job(
 
 #6) P2E
 
-scheduler.add_job(
+job_runner.add_job(
     id='Distribute Weekly Game Rewards',
     func=distribute_game_rewards_job,   # <-- вызываем "обёртку"
     trigger='cron',
@@ -981,8 +1075,41 @@ scheduler.add_job(
     
 )
 
-scheduler.start()
-atexit.register(lambda: scheduler.shutdown())
+# Выплаты победителям опросов (токены + уведомление) — отдельно от подсчёта, каждую минуту
+job_runner.add_job(
+    id='Process Poll Payouts',
+    func=process_poll_payouts_job,
+    trigger='interval',
+    minutes=1,
+    next_run_time=datetime.now(pytz.UTC) + timedelta(minutes=1)
+)
+
+# Очистка просроченных диалогов ассистента (TTL) — раз в час
+job_runner.add_job(
+    id='Purge Expired Chat Conversations',
+    func=purge_chat_conversations_job,
+    trigger='interval',
+    hours=1,
+    next_run_time=datetime.now(pytz.UTC) + timedelta(minutes=10)
+)
+
+# Очистка истории запусков заданий — раз в сутки
+job_runner.add_job(
+    id='Purge Job Run History',
+    func=job_runner.purge_history,
+    trigger='interval',
+    hours=24,
+    next_run_time=datetime.now(pytz.UTC) + timedelta(minutes=15)
+)
+
+# Потоки планировщика запускаются в процессе, который обслуживает запросы:
+# при gunicorn --preload (APP_PRELOAD=true) — в каждом воркере после fork
+@worker_service('scheduler')
+def start_scheduler():
+    scheduler.start()
+    job_runner.start()
+    atexit.register(lambda: scheduler.shutdown())
+    atexit.register(job_runner.shutdown)
 
 ##########################################
 # 7) Ежедневная покупка ровно 100000 UJO #
@@ -1235,7 +1362,7 @@ def daily_buy_100k_ujo():
 
 
 # 7) Добавляем новую задачу APScheduler на каждый день в полночь
-scheduler.add_job(
+job_runner.add_job(
     id='Daily Admin Purchase EXACT 100k UJO',
     func=daily_buy_100k_ujo,
     trigger='cron',
@@ -1264,8 +1391,8 @@ if not app.config['OPENAI_API_KEY']:
     logger.error("OPENAI_API_KEY is not set in environment variables.")
     raise ValueError("OPENAI_API_KEY is not set in environment variables.")
 
-# Initialize OpenAI
-openai.api_key = app.config['OPENAI_API_KEY']
+# Initialize OpenAI (ключ выставляется при загрузке модуля)
+on_import('openai', lambda module: setattr(module, 'api_key', app.config['OPENAI_API_KEY']))
 
 # Add Robokassa settings
 app.config['ROBOKASSA_MERCHANT_LOGIN'] = os.environ.get('ROBOKASSA_MERCHANT_LOGIN', '').strip()
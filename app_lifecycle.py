@@ -0,0 +1,84 @@
+# app_lifecycle.py
+"""
+Фазы жизни процесса для gunicorn --preload (wsgi.py, gunicorn.conf.py).
+
+Без предзагрузки (APP_PRELOAD=false, по умолчанию) каждый воркер сам
+импортирует app.py, и фоновые службы запускаются при импорте, как раньше.
+
+С APP_PRELOAD=true app.py импортируется один раз в мастере:
+  * prefork_setup() — в мастере: веса модели, справочники, шаблоны —
+    всё, что воркеры разделяют copy-on-write. Затем пулы БД закрываются
+    (сокеты не должны достаться воркерам) и gc.freeze() убирает прогретые
+    объекты из обхода сборщика мусора, чтобы он не «пачкал» общие страницы;
+  * @worker_service — потоки, планировщик, клиенты с сокетами: в мастере не
+    запускаются, а выполняются в каждом воркере после fork (post_fork_setup()).
+"""
+
+import gc
+import logging
+import os
+import time
+
+logger = logging.getLogger(__name__)
+
+PRELOAD = os.environ.get('APP_PRELOAD', 'false').lower() == 'true'
+
+_worker_services = []  # (name, func)
+_state = {'prefork_done': False, 'worker_pid': None}
+
+
+def _run_step(phase, name, func):
+    started = time.perf_counter()
+    result = func()
+    logger.info(f"{phase} '{name}' done in {(time.perf_counter() - started) * 1000:.0f} ms (pid {os.getpid()}).")
+    return result
+
+
+def worker_service(name):
+    """
+    Декоратор: функция запускает потоки/соединения процесса. Без предзагрузки
+    вызывается сразу, с предзагрузкой — в каждом воркере после fork.
+    """
+    def decorator(func):
+        _worker_services.append((name, func))
+        if not PRELOAD:
+            _run_step('Service', name, func)
+        return func
+    return decorator
+
+
+def prefork_setup(tasks, engines=()):
+    """
+    Выполняется в мастере один раз. tasks — [(name, func)]; ошибка прогрева
+    не мешает старту (воркер загрузит то же самое при первом использовании).
+    engines — движки или функция, возвращающая их после прогрева.
+    """
+    if _state['prefork_done']:
+        return
+    started = time.perf_counter()
+    for name, func in tasks:
+        try:
+            _run_step('Prefork', name, func)
+        except Exception as e:
+            logger.error(f"Prefork '{name}' failed, workers will load it on demand: {e}", exc_info=True)
+    for engine in (engines() if callable(engines) else engines):
+        # Соединения, открытые прогревом, закрываются до fork
+        engine.dispose()
+    gc.collect()
+    if hasattr(gc, 'freeze'):
+        gc.freeze()
+    _state['prefork_done'] = True
+    logger.info(f"Prefork setup finished in {(time.perf_counter() - started) * 1000:.0f} ms.")
+
+
+def post_fork_setup():
+    """
+    Хук gunicorn post_fork: запускает отложенные службы в воркере.
+    """
+    if not PRELOAD or _state['worker_pid'] == os.getpid():
+        return
+    _state['worker_pid'] = os.getpid()
+    started = time.perf_counter()
+    for name, func in _worker_services:
+        _run_step('Service', name, func)
+    logger.info(f"Worker {os.getpid()} ready in {(time.perf_counter() - started) * 1000:.0f} ms after fork.")
@@ -0,0 +1,290 @@
+# assistant_context.py
+
+import logging
+import threading
+import time
+from collections import OrderedDict
+
+from flask import current_app
+from sqlalchemy import case, func
+
+from models import db, User, Trade, Instrument, Setup, Criterion, trade_criteria
+
+logger = logging.getLogger(__name__)
+
+# Бюджет токенов на контекст сделок в system prompt ассистента (переопределяется
+# через app.config['ASSISTANT_CONTEXT_TOKEN_BUDGET'])
+DEFAULT_TOKEN_BUDGET = 2500
+# Сколько сделок-кандидатов читаем из БД для отбора по релевантности
+CANDIDATE_TRADES = 200
+# Сколько строк в разбивках по инструментам/сетапам
+BREAKDOWN_LIMIT = 8
+# Максимальная длина комментария к сделке в контексте
+MAX_COMMENT_CHARS = 200
+# Кэш контекста: число пользователей в процессе и время жизни записи
+CONTEXT_CACHE_SIZE = 256
+CONTEXT_CACHE_TTL = 30 * 60
+
+
+def estimate_tokens(text: str) -> int:
+    """
+    Оценка числа токенов сверху: ~3 байта UTF-8 на токен. Для английского это
+    с запасом (~4 символа на токен), а кириллица (2 байта на символ, токен
+    gpt-3.5-turbo — 2-3 символа) по числу символов недооценивалась бы в 2-3 раза.
+    """
+    return max(1, len(text.encode('utf-8')) // 3) if text else 0
+
+
+def trade_stats_version(user_id) -> str:
+    """
+    Версия журнала пользователя (User.trade_data_version) — одно чтение по
+    первичному ключу вместо агрегата по всем сделкам на каждый запрос к ассистенту.
+    Увеличивается bump_trade_stats_version() во всех путях записи сделок.
+    """
+    version = db.session.query(User.trade_data_version).filter(User.id == user_id).scalar()
+    return str(version or 0)
+
+
+def bump_trade_stats_version(user_id):
+    """
+    Отмечает изменение сделок или их критериев. Вызывается в той же транзакции,
+    что и сама запись; коммит остаётся за вызывающим кодом.
+    """
+    db.session.query(User).filter(User.id == user_id).update(
+        {User.trade_data_version: User.trade_data_version + 1}, synchronize_session=False
+    )
+
+
+def _fmt(value, digits=2):
+    if value is None:
+        return '-'
+    return f"{value:.{digits}f}" if isinstance(value, float) else str(value)
+
+
+def compute_trade_statistics(user_id) -> str:
+    """
+    Компактная сводка по журналу, посчитанная агрегатами в SQL:
+    общая статистика, разбивки по направлению, инструментам и сетапам.
+    """
+    win = case((Trade.profit_loss > 0, 1), else_=0)
+    loss = case((Trade.profit_loss < 0, 1), else_=0)
+
+    totals = db.session.query(
+        func.count(Trade.id),
+        func.count(Trade.exit_price),
+        func.sum(win),
+        func.sum(loss),
+        func.sum(Trade.profit_loss),
+        func.avg(Trade.profit_loss_percentage),
+        func.max(Trade.profit_loss_percentage),
+        func.min(Trade.profit_loss_percentage),
+        func.min(Trade.trade_open_time),
+        func.max(Trade.trade_open_time)
+    ).filter(Trade.user_id == user_id).one()
+
+    total, closed, wins, losses, pl_sum, pl_avg, pl_best, pl_worst, first_date, last_date = totals
+    if not total:
+        return "You currently have no trades."
+
+    wins = wins or 0
+    losses = losses or 0
+    win_rate = (wins / closed * 100.0) if closed else None
+    lines = [
+        f"Trades: {total} (closed {closed}, open {total - closed}), period {first_date} .. {last_date}",
+        f"Wins/Losses: {wins}/{losses}, win rate {_fmt(win_rate, 1)}%",
+        f"Total P/L: {_fmt(pl_sum, 4)}, avg P/L% {_fmt(pl_avg)}, best {_fmt(pl_best)}%, worst {_fmt(pl_worst)}%",
+    ]
+
+    def breakdown(title, label_col, join_target=None, join_cond=None, outer=False):
+        q = db.session.query(
+            label_col,
+            func.count(Trade.id),
+            func.sum(win),
+            func.count(Trade.exit_price),
+            func.sum(Trade.profit_loss),
+            func.avg(Trade.profit_loss_percentage)
+        ).filter(Trade.user_id == user_id)
+        if join_target is not None:
+            q = q.outerjoin(join_target, join_cond) if outer else q.join(join_target, join_cond)
+        rows = q.group_by(label_col).order_by(func.count(Trade.id).desc()).limit(BREAKDOWN_LIMIT).all()
+        if not rows:
+            return
+        lines.append(f"{title}:")
+        for label, count, row_wins, row_closed, row_pl, row_pl_avg in rows:
+            row_wr = (row_wins or 0) / row_closed * 100.0 if row_closed else None
+            lines.append(
+                f" - {label or 'No setup'}: {count} trades, win rate {_fmt(row_wr, 1)}%, "
+                f"P/L {_fmt(row_pl, 4)}, avg {_fmt(row_pl_avg)}%"
+            )
+
+    breakdown("By direction", Trade.direction)
+    breakdown("By instrument", Instrument.name, Instrument, Instrument.id == Trade.instrument_id)
+    breakdown("By setup", Setup.setup_name, Setup, Setup.id == Trade.setup_id, outer=True)
+    return "\n".join(lines)
+
+
+def _candidate_trades(user_id):
+    """
+    Читает кандидатов для контекста одним запросом с join'ами (без lazy-load):
+    последние сделки и сделки с наибольшим |P/L%|.
+    """
+    columns = (
+        Trade.id, Instrument.name.label('instrument'), Trade.direction, Trade.entry_price, Trade.exit_price,
+        Trade.trade_open_time, Trade.trade_close_time, Trade.profit_loss,
+        Trade.profit_loss_percentage, Setup.setup_name, Trade.comment
+    )
+    base = db.session.query(*columns).join(
+        Instrument, Instrument.id == Trade.instrument_id
+    ).outerjoin(
+        Setup, Setup.id == Trade.setup_id
+    ).filter(Trade.user_id == user_id)
+
+    recent = base.order_by(Trade.trade_open_time.desc(), Trade.id.desc()).limit(CANDIDATE_TRADES).all()
+    extreme = base.filter(Trade.profit_loss_percentage.isnot(None)).order_by(
+        func.abs(Trade.profit_loss_percentage).desc()
+    ).limit(CANDIDATE_TRADES // 4).all()
+
+    by_id = OrderedDict()
+    for rank, row in enumerate(recent):
+        by_id[row.id] = (row, rank)
+    for row in extreme:
+        by_id.setdefault(row.id, (row, len(recent)))
+    return list(by_id.values()), len(recent)
+
+
+def _relevance(row, recency_rank, recent_count):
+    """
+    Релевантность сделки: свежесть + величина результата + наличие комментария.
+    """
+    score = 1.0 - (recency_rank / max(recent_count, 1))
+    if row.profit_loss_percentage is not None:
+        score += min(abs(row.profit_loss_percentage), 20.0) / 20.0
+    if row.comment:
+        score += 0.5
+    return score
+
+
+def _format_trade(row, criteria_names):
+    parts = [
+        f"#{row.id} {row.instrument} {row.direction} {row.entry_price}->{_fmt(row.exit_price, 5) if row.exit_price else 'open'}",
+        f"{row.trade_open_time}..{row.trade_close_time or ''}",
+    ]
+    if row.profit_loss is not None:
+        parts.append(f"P/L {_fmt(row.profit_loss, 4)} ({_fmt(row.profit_loss_percentage)}%)")
+    if row.setup_name:
+        parts.append(f"setup: {row.setup_name}")
+    if criteria_names:
+        parts.append(f"criteria: {'; '.join(criteria_names)}")
+    if row.comment:
+        comment = " ".join(row.comment.split())
+        if len(comment) > MAX_COMMENT_CHARS:
+            comment = comment[:MAX_COMMENT_CHARS] + "..."
+        parts.append(f"comment: {comment}")
+    return " | ".join(parts)
+
+
+def build_trade_context(user_id, token_budget=None) -> str:
+    """
+    Строит текст контекста для system prompt: SQL-статистика + самые релевантные
+    сделки, уложенные в token_budget. Без кэша — см. get_trade_context.
+    """
+    if token_budget is None:
+        token_budget = current_app.config.get('ASSISTANT_CONTEXT_TOKEN_BUDGET', DEFAULT_TOKEN_BUDGET)
+
+    stats = compute_trade_statistics(user_id)
+    sections = [f"**Trading Statistics:**\n{stats}"]
+    remaining = token_budget - estimate_tokens(sections[0])
+
+    candidates, recent_count = _candidate_trades(user_id)
+    if not candidates:
+        return sections[0]
+
+    ranked = sorted(
+        candidates,
+        key=lambda item: _relevance(item[0], item[1], recent_count),
+        reverse=True
+    )
+
+    criteria_by_trade = {}
+    for trade_id, name in db.session.query(
+        trade_criteria.c.trade_id, Criterion.name
+    ).join(
+        Criterion, Criterion.id == trade_criteria.c.criterion_id
+    ).filter(trade_criteria.c.trade_id.in_([row.id for row, _ in ranked])).all():
+        criteria_by_trade.setdefault(trade_id, []).append(name)
+
+    selected = []
+    for row, _ in ranked:
+        line = _format_trade(row, criteria_by_trade.get(row.id))
+        cost = estimate_tokens(line) + 1
+        if cost > remaining:
+            continue
+        selected.append((row.trade_open_time, row.id, line))
+        remaining -= cost
+
+    if selected:
+        # В промпте сделки идут от новых к старым
+        selected.sort(reverse=True)
+        header = f"**Most Relevant Trades ({len(selected)} of {len(candidates)} candidates, newest first):**"
+        sections.append(header + "\n" + "\n".join(line for _, _, line in selected))
+    return "\n\n".join(sections)
+
+
+class TradeContextCache:
+    """
+    Per-process LRU cache of built contexts, keyed by user and validated
+    against trade_stats_version on every lookup.
+    """
+
+    def __init__(self, max_size=CONTEXT_CACHE_SIZE, ttl=CONTEXT_CACHE_TTL):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._entries = OrderedDict()  # user_id -> (version, built_at, context)
+        self._lock = threading.Lock()
+
+    def get(self, user_id, version):
+        with self._lock:
+            entry = self._entries.get(user_id)
+            if not entry:
+                return None
+            cached_version, built_at, context = entry
+            if cached_version != version or time.time() - built_at > self.ttl:
+                del self._entries[user_id]
+                return None
+            self._entries.move_to_end(user_id)
+            return context
+
+    def put(self, user_id, version, context):
+        with self._lock:
+            self._entries[user_id] = (version, time.time(), context)
+            self._entries.move_to_end(user_id)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, user_id):
+        with self._lock:
+            self._entries.pop(user_id, None)
+
+
+context_cache = TradeContextCache()
+
+
+def get_trade_context(user_id) -> str:
+    """
+    Контекст сделок для ассистента с кэшированием: пересобирается только
+    когда меняется trade_stats_version пользователя.
+    """
+    version = trade_stats_version(user_id)
+    context = context_cache.get(user_id, version)
+    if context is not None:
+        logger.debug(f"Trade context cache hit for user {user_id}.")
+        return context
+
+    started = time.time()
+    context = build_trade_context(user_id)
+    context_cache.put(user_id, version, context)
+    logger.info(
+        f"Trade context built for user {user_id}: ~{estimate_tokens(context)} tokens "
+        f"in {(time.time() - started) * 1000:.0f} ms."
+    )
+    return context
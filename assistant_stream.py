@@ -0,0 +1,115 @@
+# assistant_stream.py
+
+import json
+import logging
+
+logger = logging.getLogger(__name__)
+
+# Заголовки SSE-ответа: без кэширования и без буферизации на прокси (nginx/render)
+SSE_HEADERS = {
+    'Cache-Control': 'no-cache',
+    'X-Accel-Buffering': 'no',
+}
+
+
+def sse_event(event: str, data) -> str:
+    """
+    Форматирует одно Server-Sent Event. data сериализуется в JSON
+    (одна строка, поэтому переносы внутри текста не ломают кадр).
+    """
+    return f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
+
+
+class ChatStreamCollector:
+    """
+    Collects a streamed openai.ChatCompletion (stream=True) response.
+
+    Text deltas are yielded as they arrive; function_call deltas (name and
+    argument fragments) are assembled silently so the complete call can be
+    dispatched once the stream finishes. With leading_tag, a tag the model
+    puts at the very start of its answer is cut from the text and reported
+    via the tagged flag.
+    """
+
+    def __init__(self, leading_tag=None):
+        self._content = []
+        self.function_name = None
+        self._function_args = []
+        self.finish_reason = None
+        self.leading_tag = leading_tag
+        self.tagged = False
+        # Начало ответа придерживается, пока не ясно, метка ли это (None — уже отдано)
+        self._held = '' if leading_tag else None
+        self._skip_space = False
+
+    @property
+    def content(self) -> str:
+        return "".join(self._content)
+
+    @property
+    def function_arguments(self) -> str:
+        return "".join(self._function_args)
+
+    @property
+    def has_function_call(self) -> bool:
+        return self.function_name is not None
+
+    def feed(self, chunk):
+        """
+        Обрабатывает один chunk стрима. Возвращает текстовую дельту или None.
+        """
+        choices = chunk.get("choices") or []
+        if not choices:
+            return None
+        choice = choices[0]
+        if choice.get("finish_reason"):
+            self.finish_reason = choice["finish_reason"]
+
+        delta = choice.get("delta") or {}
+        function_call = delta.get("function_call")
+        if function_call:
+            if function_call.get("name"):
+                self.function_name = function_call["name"]
+            if function_call.get("arguments"):
+                self._function_args.append(function_call["arguments"])
+
+        text = delta.get("content")
+        if text:
+            return self._accept(text)
+        return None
+
+    def _accept(self, text):
+        if self._held is not None:
+            self._held += text
+            head = self._held.lstrip()
+            if len(head) < len(self.leading_tag) and self.leading_tag.startswith(head):
+                return None
+            return self._release()
+        if self._skip_space:
+            # Пробелы и перенос строки после метки
+            text = text.lstrip()
+            if not text:
+                return None
+            self._skip_space = False
+        self._content.append(text)
+        return text
+
+    def _release(self):
+        text, self._held = self._held, None
+        head = text.lstrip()
+        if head.startswith(self.leading_tag):
+            self.tagged = True
+            self._skip_space = True
+            text = head[len(self.leading_tag):]
+        return self._accept(text) if text else None
+
+    def iter_text(self, response):
+        for chunk in response:
+            text = self.feed(chunk)
+            if text:
+                yield text
+        if self._held is not None:
+            # Ответ короче метки
+            text = self._release()
+            if text:
+                yield text
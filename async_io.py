@@ -0,0 +1,125 @@
+# async_io.py
+"""
+Ввод-вывод для async-view (Flask[async]: async def view, asgiref).
+
+Flask 2.0 выполняет async def view в отдельном event loop (свой поток на время
+запроса), поток запроса при этом ждёт. Отсюда правила:
+
+  * внешние вызовы view выполняются параллельно: asyncio.gather над
+    httpx.AsyncClient (http_client()) и пакеты JSON-RPC (AsyncRpc.batch) —
+    пять последовательных eth_call превращаются в один запрос к RPC;
+  * БД, flask-login, синхронный web3/requests — только через await run_sync(...):
+    функция выполняется в потоке запроса, т.е. в его сессии SQLAlchemy
+    (scoped_session привязан к потоку) и с его сбором метрик;
+  * ORM-объекты из run_sync можно читать в view (загруженные колонки), но не
+    дозагружать связи.
+
+Сколько запросов одного процесса одновременно ждут внешних сервисов,
+задаёт WEB_THREADS (gunicorn.conf.py).
+"""
+
+import asyncio
+import logging
+import os
+import time
+from contextlib import asynccontextmanager
+
+from asgiref.sync import sync_to_async
+
+from instrumentation import current_collector, external_call_kind, record_external_call
+from lazy_imports import lazy_import
+
+logger = logging.getLogger(__name__)
+
+httpx = lazy_import('httpx')
+
+ASYNC_HTTP_TIMEOUT = float(os.environ.get('ASYNC_HTTP_TIMEOUT', '20'))
+ASYNC_HTTP_MAX_CONNECTIONS = int(os.environ.get('ASYNC_HTTP_MAX_CONNECTIONS', '20'))
+# Некоторые публичные RPC не принимают пакеты — тогда вызовы идут параллельно по одному
+RPC_BATCH = os.environ.get('RPC_BATCH', 'true').lower() == 'true'
+
+
+class RpcError(Exception):
+    pass
+
+
+async def run_sync(func, *args, **kwargs):
+    """
+    Выполняет синхронную функцию в потоке запроса (БД, web3, requests).
+    """
+    return await sync_to_async(func, thread_sensitive=True)(*args, **kwargs)
+
+
+@asynccontextmanager
+async def http_client(**kwargs):
+    """
+    httpx.AsyncClient на время view; вызовы учитываются в метриках запроса
+    (external_calls, /metrics) так же, как вызовы через requests.
+    """
+    collector = await run_sync(current_collector)
+
+    async def on_request(request):
+        request.extensions['started_at'] = time.perf_counter()
+
+    async def on_response(response):
+        started = response.request.extensions.get('started_at')
+        if collector is None or started is None:
+            return
+        host = response.request.url.host
+        record_external_call(
+            host, (time.perf_counter() - started) * 1000,
+            external_call_kind(response.request, host), collector=collector
+        )
+
+    client = httpx.AsyncClient(
+        timeout=ASYNC_HTTP_TIMEOUT,
+        limits=httpx.Limits(max_connections=ASYNC_HTTP_MAX_CONNECTIONS),
+        event_hooks={'request': [on_request], 'response': [on_response]},
+        **kwargs
+    )
+    async with client:
+        yield client
+
+
+class AsyncRpc:
+    """
+    JSON-RPC поверх httpx: call() — один вызов, batch() — несколько одним запросом.
+    """
+
+    def __init__(self, client, url):
+        self.client = client
+        self.url = url
+
+    async def _post(self, payload):
+        response = await self.client.post(self.url, json=payload)
+        response.raise_for_status()
+        return response.json()
+
+    @staticmethod
+    def _result(method, reply):
+        if not isinstance(reply, dict) or 'error' in reply or 'result' not in reply:
+            error = reply.get('error') if isinstance(reply, dict) else reply
+            raise RpcError(f"{method}: {error}")
+        return reply['result']
+
+    async def call(self, method, *params):
+        reply = await self._post({'jsonrpc': '2.0', 'id': 0, 'method': method, 'params': list(params)})
+        return self._result(method, reply)
+
+    async def batch(self, calls):
+        """
+        calls — [(method, [params])]; результаты в том же порядке.
+        """
+        if not calls:
+            return []
+        if not RPC_BATCH:
+            return list(await asyncio.gather(*(self.call(method, *params) for method, params in calls)))
+        replies = await self._post([
+            {'jsonrpc': '2.0', 'id': index, 'method': method, 'params': list(params)}
+            for index, (method, params) in enumerate(calls)
+        ])
+        if not isinstance(replies, list):
+            # Ошибка всего пакета (например, пакеты не поддерживаются)
+            raise RpcError(f"batch of {len(calls)}: {replies}")
+        by_id = {reply.get('id'): reply for reply in replies if isinstance(reply, dict)}
+        return [self._result(method, by_id.get(index)) for index, (method, _) in enumerate(calls)]
@@ -0,0 +1,176 @@
+# bench_trend.py
+"""
+CPU-бенчмарки пайплайна анализа графиков (TrendCNN).
+
+    python bench_trend.py preprocess [--images 200] [--size 1280x720]
+    python bench_trend.py latency [--runs 500] [--batch 1]
+
+'preprocess' сравнивает пропускную способность (изображений/с) старого пути
+(сохранение загрузки в temp/, повторное открытие с диска, Compose на каждый
+вызов) и текущего пути в памяти (decode из bytes, модульный TREND_TRANSFORM).
+
+'latency' меряет p50/p99 forward-прохода и прирост RSS для каждого бэкенда
+(eager fp32, eager dynamic int8, TorchScript int8). Каждый бэкенд запускается
+в отдельном процессе, чтобы замеры памяти не смешивались.
+Не импортирует app/routes, поэтому не требует переменных окружения.
+"""
+
+import argparse
+import io
+import multiprocessing
+import os
+import tempfile
+import time
+
+import numpy as np
+import torch
+from PIL import Image
+from torchvision import transforms
+
+from trend_inference import (
+    TREND_MODEL_PATH, TREND_SCRIPTED_MODEL_PATH, TrendCNN,
+    configure_torch_threads, load_eager_model, load_scripted_model, preprocess_image
+)
+
+LATENCY_BACKENDS = ('eager_fp32', 'eager_int8', 'torchscript_int8')
+
+
+def make_chart_pngs(count, size):
+    """
+    Синтетические PNG-«скриншоты» графиков заданного размера.
+    """
+    rng = np.random.default_rng(42)
+    width, height = size
+    images = []
+    for _ in range(count):
+        pixels = rng.integers(0, 255, size=(height, width, 3), dtype=np.uint8)
+        buffer = io.BytesIO()
+        Image.fromarray(pixels).save(buffer, format='PNG')
+        images.append(buffer.getvalue())
+    return images
+
+
+def legacy_disk_preprocess(image_bytes, temp_dir):
+    # Повторяет прежний путь: image.save(temp_path) -> Image.open(path) -> Compose() -> os.remove
+    temp_path = os.path.join(temp_dir, 'chart.png')
+    with open(temp_path, 'wb') as f:
+        f.write(image_bytes)
+    transform = transforms.Compose([
+        transforms.Resize((128, 128)),
+        transforms.ToTensor(),
+        transforms.Normalize(mean=[0.5, 0.5, 0.5], std=[0.5, 0.5, 0.5])
+    ])
+    img = Image.open(temp_path).convert('RGB')
+    tensor = transform(img).unsqueeze(0)
+    os.remove(temp_path)
+    return tensor
+
+
+def _throughput(func, images):
+    started = time.perf_counter()
+    for image_bytes in images:
+        func(image_bytes)
+    elapsed = time.perf_counter() - started
+    return len(images) / elapsed if elapsed else float('inf')
+
+
+def bench_preprocess(count, size):
+    images = make_chart_pngs(count, size)
+    with tempfile.TemporaryDirectory() as temp_dir:
+        # Прогрев (кэши PIL/torch)
+        legacy_disk_preprocess(images[0], temp_dir)
+        preprocess_image(images[0])
+
+        legacy = _throughput(lambda b: legacy_disk_preprocess(b, temp_dir), images)
+    in_memory = _throughput(preprocess_image, images)
+
+    print(f"Images: {count} PNG, {size[0]}x{size[1]}")
+    print(f"  disk + per-call Compose : {legacy:8.1f} img/s")
+    print(f"  in-memory + module-level: {in_memory:8.1f} img/s  (x{in_memory / legacy:.2f})")
+
+
+def _rss_mb():
+    # Resident set size текущего процесса (Linux)
+    with open('/proc/self/statm') as f:
+        pages = int(f.read().split()[1])
+    return pages * os.sysconf('SC_PAGE_SIZE') / (1024 * 1024)
+
+
+def _load_backend(backend):
+    if os.path.exists(TREND_MODEL_PATH):
+        model = load_eager_model(TREND_MODEL_PATH)
+    else:
+        # Для замера задержки веса не важны
+        model = TrendCNN().eval()
+    if backend == 'eager_fp32':
+        return model
+
+    from trend_export import build_scripted_int8, quantize_dynamic_int8
+    if backend == 'eager_int8':
+        return quantize_dynamic_int8(model)
+    if os.path.exists(TREND_SCRIPTED_MODEL_PATH):
+        del model
+        return load_scripted_model(TREND_SCRIPTED_MODEL_PATH)
+    return build_scripted_int8(model)
+
+
+def _latency_worker(backend, runs, batch):
+    configure_torch_threads()
+    rss_before = _rss_mb()
+    model = _load_backend(backend)
+    inputs = torch.rand((batch, 3, 128, 128)) * 2 - 1
+
+    timings = []
+    with torch.inference_mode():
+        for _ in range(20):
+            model(inputs)
+        for _ in range(runs):
+            started = time.perf_counter()
+            model(inputs)
+            timings.append((time.perf_counter() - started) * 1000)
+    return {
+        'p50': float(np.percentile(timings, 50)),
+        'p99': float(np.percentile(timings, 99)),
+        'rss_mb': _rss_mb() - rss_before,
+    }
+
+
+def bench_latency(runs, batch):
+    weights = TREND_MODEL_PATH if os.path.exists(TREND_MODEL_PATH) else 'random init'
+    print(f"Forward latency, batch={batch}, runs={runs}, weights: {weights}")
+    ctx = multiprocessing.get_context('spawn')
+    for backend in LATENCY_BACKENDS:
+        with ctx.Pool(1) as pool:
+            result = pool.apply(_latency_worker, (backend, runs, batch))
+        print(
+            f"  {backend:<17} p50 {result['p50']:7.2f} ms   p99 {result['p99']:7.2f} ms   "
+            f"+RSS {result['rss_mb']:6.1f} MB"
+        )
+
+
+def _parse_size(value):
+    width, height = value.lower().split('x')
+    return int(width), int(height)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="TrendCNN pipeline benchmarks")
+    sub = parser.add_subparsers(dest='command', required=True)
+
+    pre = sub.add_parser('preprocess', help="image decode/preprocess throughput")
+    pre.add_argument('--images', type=int, default=200)
+    pre.add_argument('--size', type=_parse_size, default=(1280, 720))
+
+    lat = sub.add_parser('latency', help="forward-pass latency and memory per backend")
+    lat.add_argument('--runs', type=int, default=500)
+    lat.add_argument('--batch', type=int, default=1)
+
+    args = parser.parse_args()
+    if args.command == 'preprocess':
+        bench_preprocess(args.images, args.size)
+    elif args.command == 'latency':
+        bench_latency(args.runs, args.batch)
+
+
+if __name__ == '__main__':
+    main()
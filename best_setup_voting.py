@@ -9,9 +9,11 @@ from sqlalchemy.exc import IntegrityError
 
 from flask import Blueprint, request, render_template, flash, redirect, url_for, session, current_app
 from models import db, User, Trade, Setup, Criterion, Config, BestSetupCandidate, BestSetupVote, BestSetupPoll
-from web3 import Web3
-from web3.middleware import geth_poa_middleware
-from eth_account import Account
+from telegram_notify import send_notification
+from read_replica import replica_router
+from types import SimpleNamespace
+from lazy_imports import LazyObject, load_module
+from staking_logic import Web3, Account, RPC_RETRY_SECONDS
 
 logger = logging.getLogger(__name__)
 
@@ -68,56 +70,56 @@ PRIVATE_KEY = os.environ.get('PRIVATE_KEY', '')
 TOKEN_CONTRACT_ADDRESS = os.environ.get('TOKEN_CONTRACT_ADDRESS', '')
 TOKEN_DECIMALS = int(os.environ.get('TOKEN_DECIMALS', '18'))
 
-web3 = None
-token_contract = None
-account = None
+ERC20_ABI = [
+    {
+        "constant": False,
+        "inputs": [{"name": "_to", "type": "address"}, {"name": "_value", "type": "uint256"}],
+        "name": "transfer",
+        "outputs": [{"name": "success", "type": "bool"}],
+        "type": "function"
+    },
+    {
+        "constant": True,
+        "inputs": [{"name": "_owner", "type": "address"}],
+        "name": "balanceOf",
+        "outputs": [{"name": "balance", "type": "uint256"}],
+        "type": "function"
+    }
+]
+
+if not (BASE_RPC_URL and PRIVATE_KEY and TOKEN_CONTRACT_ADDRESS):
+    logger.error("Не все необходимые переменные окружения установлены (BASE_RPC_URL, PRIVATE_KEY, TOKEN_CONTRACT_ADDRESS).")
 
-if BASE_RPC_URL and PRIVATE_KEY and TOKEN_CONTRACT_ADDRESS:
-    web3 = Web3(Web3.HTTPProvider(BASE_RPC_URL))
-    if web3.is_connected():
-        logger.info("Подключено к RPC сети Base.")
-        web3.middleware_onion.inject(geth_poa_middleware, layer=0)
-        try:
-            account = Account.from_key(PRIVATE_KEY)
-            logger.info(f"Аккаунт инициализирован: {account.address}")
-        except Exception as e:
-            logger.error(f"Ошибка при инициализации аккаунта: {e}")
-            account = None
-
-        ERC20_ABI = [
-            {
-                "constant": False,
-                "inputs": [{"name": "_to", "type": "address"}, {"name": "_value", "type": "uint256"}],
-                "name": "transfer",
-                "outputs": [{"name": "success", "type": "bool"}],
-                "type": "function"
-            },
-            {
-                "constant": True,
-                "inputs": [{"name": "_owner", "type": "address"}],
-                "name": "balanceOf",
-                "outputs": [{"name": "balance", "type": "uint256"}],
-                "type": "function"
-            }
-        ]
 
-        try:
-            token_contract = web3.eth.contract(
-                address=Web3.to_checksum_address(TOKEN_CONTRACT_ADDRESS),
-                abi=ERC20_ABI
-            )
-            logger.info(f"Токен-контракт инициализирован: {TOKEN_CONTRACT_ADDRESS}")
-        except Exception as e:
-            logger.error(f"Ошибка при инициализации токен-контракта: {e}")
-            token_contract = None
-    else:
+def _connect_reward_sender():
+    """
+    Подключение к RPC, аккаунт и токен-контракт для выплат — при первой выплате.
+    """
+    if not (BASE_RPC_URL and PRIVATE_KEY and TOKEN_CONTRACT_ADDRESS):
+        raise RuntimeError("BASE_RPC_URL, PRIVATE_KEY and TOKEN_CONTRACT_ADDRESS must be set.")
+    web3 = Web3(Web3.HTTPProvider(BASE_RPC_URL))
+    if not web3.is_connected():
         logger.error("Не удалось подключиться к сети Base.")
-else:
-    logger.error("Не все необходимые переменные окружения установлены (BASE_RPC_URL, PRIVATE_KEY, TOKEN_CONTRACT_ADDRESS).")
+        raise ConnectionError(f"RPC {BASE_RPC_URL} is not reachable.")
+    logger.info("Подключено к RPC сети Base.")
+    web3.middleware_onion.inject(load_module('web3.middleware').geth_poa_middleware, layer=0)
+    account = Account.from_key(PRIVATE_KEY)
+    logger.info(f"Аккаунт инициализирован: {account.address}")
+    token_contract = web3.eth.contract(
+        address=Web3.to_checksum_address(TOKEN_CONTRACT_ADDRESS),
+        abi=ERC20_ABI
+    )
+    logger.info(f"Токен-контракт инициализирован: {TOKEN_CONTRACT_ADDRESS}")
+    return SimpleNamespace(web3=web3, account=account, token_contract=token_contract)
+
+
+reward_sender = LazyObject(_connect_reward_sender, 'best setup reward sender', retry_seconds=RPC_RETRY_SECONDS)
 
 def send_token_reward(user_wallet, amount):
-    if not account or not token_contract:
-        logger.error("Нет настроек для отправки токенов.")
+    try:
+        web3, account, token_contract = reward_sender.web3, reward_sender.account, reward_sender.token_contract
+    except Exception as e:
+        logger.error(f"Нет настроек для отправки токенов: {e}")
         return False
 
     if not user_wallet or not user_wallet.startswith('0x') or len(user_wallet) != 42:
@@ -302,6 +304,7 @@ def start_best_setup_contest():
 
 @best_setup_voting_bp.route('/best_setup_candidates', methods=['GET'])
 @premium_required
+@replica_router.read_only
 def best_setup_candidates():
     poll = get_active_poll()
     if not poll:
@@ -416,8 +419,6 @@ def set_wallet():
     return render_template('set_wallet.html', user=user)
 
 def auto_finalize_best_setup_voting():
-    from routes import bot  # Импортируем бота, чтобы можно было отправить сообщение
-    
     poll = BestSetupPoll.query.filter_by(status='active').first()
     if not poll:
         return
@@ -467,15 +468,12 @@ def auto_finalize_best_setup_voting():
             success = send_token_reward(user_obj.wallet_address, amount)
             if success:
                 logger.info(f"{reason} Пользователь {user_obj.id} получил {amount} UJO.")
-                # Отправляем через телеграм
-                try:
-                    if user_obj.telegram_id:
-                        bot.send_message(
-                            chat_id=user_obj.telegram_id,
-                            text=f"Congratulations! You have been awarded {amount:.4f} UJO {reason}"
-                        )
-                except Exception as e:
-                    logger.error(f"Ошибка при отправке уведомления TG: {e}")
+                # Уведомление в телеграм уходит через очередь, не блокируя финализацию
+                if user_obj.telegram_id:
+                    send_notification(
+                        user_obj.telegram_id,
+                        f"Congratulations! You have been awarded {amount:.4f} UJO {reason}"
+                    )
             else:
                 logger.error(f"Не удалось отправить {amount} UJO пользователю {user_obj.id}.")
 
@@ -0,0 +1,96 @@
+# chart_cache.py
+
+import logging
+from datetime import datetime
+
+from flask import current_app
+from sqlalchemy import tuple_
+from sqlalchemy.dialects.postgresql import insert
+
+from models import db, ChartAnalysisCache
+
+logger = logging.getLogger(__name__)
+
+# Максимум записей в кэше результатов (LRU по last_used_at), переопределяется
+# через app.config['CHART_CACHE_SIZE']
+DEFAULT_CHART_CACHE_SIZE = 5000
+
+# Версии модели, для которых этот процесс уже удалил устаревшие записи
+_purged_versions = set()
+
+
+def _max_size():
+    return current_app.config.get('CHART_CACHE_SIZE', DEFAULT_CHART_CACHE_SIZE)
+
+
+def purge_stale_versions(model_version):
+    """
+    Удаляет результаты, посчитанные другой версией модели (файл модели
+    поменялся). Выполняется один раз на процесс для каждой версии.
+    """
+    if model_version in _purged_versions:
+        return
+    deleted = ChartAnalysisCache.query.filter(
+        ChartAnalysisCache.model_version != model_version
+    ).delete(synchronize_session=False)
+    db.session.commit()
+    _purged_versions.add(model_version)
+    if deleted:
+        logger.info(f"Chart analysis cache: removed {deleted} entries of previous model versions.")
+
+
+def get_cached_trend(content_hash, phash, model_version):
+    """
+    Возвращает закэшированный trend label или None: сначала точное совпадение
+    входа модели (content_hash), затем — если CHART_CACHE_MATCH_PHASH — совпадение
+    всех 256 бит phash. Ошибки кэша не прерывают анализ — просто считаем промахом.
+    """
+    if not model_version:
+        return None
+    try:
+        purge_stale_versions(model_version)
+        entry = ChartAnalysisCache.query.get((content_hash, model_version))
+        if entry is None and current_app.config.get('CHART_CACHE_MATCH_PHASH', True):
+            entry = ChartAnalysisCache.query.filter_by(phash=phash, model_version=model_version).first()
+        if entry is None:
+            return None
+        entry.hits = (entry.hits or 0) + 1
+        entry.last_used_at = datetime.utcnow()
+        label = entry.trend_label
+        db.session.commit()
+        return label
+    except Exception as e:
+        db.session.rollback()
+        logger.warning(f"Chart analysis cache lookup failed: {e}")
+        return None
+
+
+def store_trend(content_hash, phash, model_version, trend_label):
+    """
+    Сохраняет результат (upsert — несколько воркеров могут посчитать один
+    и тот же график одновременно) и обрезает кэш до CHART_CACHE_SIZE.
+    """
+    if not model_version:
+        return
+    try:
+        now = datetime.utcnow()
+        stmt = insert(ChartAnalysisCache.__table__).values(
+            content_hash=content_hash, phash=phash, model_version=model_version,
+            trend_label=trend_label, hits=0, created_at=now, last_used_at=now
+        ).on_conflict_do_update(
+            index_elements=['content_hash', 'model_version'],
+            set_={'trend_label': trend_label, 'last_used_at': now}
+        )
+        db.session.execute(stmt)
+
+        # LRU: всё, что старше первых CHART_CACHE_SIZE по last_used_at, удаляется
+        overflow = db.session.query(
+            ChartAnalysisCache.content_hash, ChartAnalysisCache.model_version
+        ).order_by(ChartAnalysisCache.last_used_at.desc()).offset(_max_size())
+        ChartAnalysisCache.query.filter(
+            tuple_(ChartAnalysisCache.content_hash, ChartAnalysisCache.model_version).in_(overflow.subquery().select())
+        ).delete(synchronize_session=False)
+        db.session.commit()
+    except Exception as e:
+        db.session.rollback()
+        logger.warning(f"Chart analysis cache store failed: {e}")
@@ -0,0 +1,114 @@
+# chart_render.py
+
+import hashlib
+import io
+import logging
+import threading
+from collections import OrderedDict
+
+from lazy_imports import lazy_import, load_module, on_import
+
+logger = logging.getLogger(__name__)
+
+# matplotlib и numpy загружаются при первом рендере графика, а не при старте
+on_import('matplotlib', lambda module: module.use('Agg'))  # без GUI, до любого импорта pyplot
+np = lazy_import('numpy')
+
+HISTOGRAM_BINS = 20
+CHART_FORMATS = {
+    'png': 'image/png',
+    'svg': 'image/svg+xml',
+}
+# Сколько отрендеренных графиков держать в памяти процесса
+RENDER_CACHE_SIZE = 256
+
+
+def histogram_bins(values, bins=HISTOGRAM_BINS):
+    """
+    Считает гистограмму NumPy'ем: (counts, edges) — то же, что plt.hist, без рисования.
+    """
+    values = np.asarray(values, dtype=np.float64)
+    if values.size == 0:
+        return np.zeros(0, dtype=np.int64), np.zeros(0)
+    return np.histogram(values, bins=bins)
+
+
+def _new_figure(figsize):
+    load_module('matplotlib')
+    return load_module('matplotlib.figure').Figure(figsize=figsize)
+
+
+def _figure_bytes(fig, fmt):
+    # Figure + FigureCanvasAgg не трогают глобальное состояние pyplot и потокобезопасны
+    load_module('matplotlib.backends.backend_agg').FigureCanvasAgg(fig)
+    buf = io.BytesIO()
+    fig.savefig(buf, format=fmt)
+    return buf.getvalue()
+
+
+def render_distribution_chart(title, counts, edges, real_price=None, fmt='png'):
+    """
+    Гистограмма распределения прогнозов по готовым корзинам (counts/edges).
+    """
+    fig = _new_figure((10, 6))
+    ax = fig.add_subplot(1, 1, 1)
+    if len(counts):
+        ax.bar(edges[:-1], counts, width=np.diff(edges), align='edge', color='green', alpha=0.7)
+    ax.set_xlabel('Predicted Price')
+    ax.set_ylabel('Number of Predictions')
+    ax.set_title(title)
+
+    if real_price is not None:
+        ax.axvline(float(real_price), color='red', linestyle='dashed', linewidth=2,
+                   label=f'Real Price: {real_price}')
+        ax.legend()
+
+    fig.tight_layout()
+    return _figure_bytes(fig, fmt)
+
+
+def render_comparison_chart(predicted_price, real_price, fmt='png'):
+    fig = _new_figure((6, 4))
+    ax = fig.add_subplot(1, 1, 1)
+    ax.bar(['Predicted Price', 'Real Price'], [predicted_price, real_price], color=['blue', 'green'])
+    ax.set_title('Comparison of Predicted and Real Prices')
+    ax.set_ylabel('Price')
+    fig.tight_layout()
+    return _figure_bytes(fig, fmt)
+
+
+def chart_version(*parts) -> str:
+    """
+    Короткая версия графика по данным, от которых зависит картинка
+    (число прогнозов, последний id, реальная цена). Меняется — URL меняется.
+    """
+    return hashlib.md5(repr(parts).encode()).hexdigest()[:12]
+
+
+class RenderedChartCache:
+    """
+    Per-process LRU of rendered chart bytes keyed by
+    (poll_id, instrument_id, version, fmt). Old versions fall out naturally.
+    """
+
+    def __init__(self, max_size=RENDER_CACHE_SIZE):
+        self.max_size = max_size
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            data = self._entries.get(key)
+            if data is not None:
+                self._entries.move_to_end(key)
+            return data
+
+    def put(self, key, data):
+        with self._lock:
+            self._entries[key] = data
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+
+rendered_charts = RenderedChartCache()
@@ -0,0 +1,127 @@
+# chat_store.py
+
+import logging
+import uuid
+from datetime import datetime, timedelta
+
+from flask import current_app, session
+
+from models import db, ChatConversation
+
+logger = logging.getLogger(__name__)
+
+# Ключ в cookie-сессии: там хранится только id диалога, сами сообщения — в БД
+SESSION_KEY = 'chat_conversation_id'
+# Сколько сообщений (без system prompt) хранить в диалоге
+MAX_CHAT_HISTORY = 20
+# Время жизни диалога без активности, секунд (переопределяется
+# через app.config['CHAT_HISTORY_TTL'])
+DEFAULT_CHAT_HISTORY_TTL = 24 * 3600
+
+
+def _ttl():
+    return timedelta(seconds=current_app.config.get('CHAT_HISTORY_TTL', DEFAULT_CHAT_HISTORY_TTL))
+
+
+class ChatHistory:
+    """
+    Server-side conversation of one user with the assistant.
+
+    Messages are kept in a plain list while the request is handled and
+    written back with save(); the row is re-read on save, so a rollback of
+    the request's own transaction (e.g. a failed create_trades) does not
+    lose the conversation.
+    """
+
+    def __init__(self, user_id, conversation_id=None, messages=None):
+        self.user_id = user_id
+        self.conversation_id = conversation_id
+        self.messages = list(messages or [])
+        self.cleared = False
+
+    @classmethod
+    def load(cls, user_id):
+        """
+        Loads the conversation referenced by the session. Unknown, foreign
+        or expired conversations are treated as empty.
+        """
+        # История из старой cookie-сессии больше не используется
+        session.pop('chat_history', None)
+
+        conversation_id = session.get(SESSION_KEY)
+        if not conversation_id:
+            return cls(user_id)
+
+        conversation = ChatConversation.query.get(conversation_id)
+        if conversation is None or conversation.user_id != user_id:
+            session.pop(SESSION_KEY, None)
+            return cls(user_id)
+
+        if conversation.expires_at <= datetime.utcnow():
+            logger.debug(f"Chat conversation {conversation_id} of user {user_id} expired.")
+            db.session.delete(conversation)
+            db.session.commit()
+            session.pop(SESSION_KEY, None)
+            return cls(user_id)
+
+        return cls(user_id, conversation.id, conversation.messages)
+
+    @property
+    def is_new(self):
+        return not self.messages
+
+    def append(self, role, content):
+        self.messages.append({'role': role, 'content': content})
+
+    def display_messages(self):
+        # Системные сообщения скрываем
+        return [msg for msg in self.messages if msg['role'] != 'system']
+
+    def _trimmed(self):
+        # System prompt всегда остаётся первым, обрезаем только диалог
+        system = [msg for msg in self.messages[:1] if msg['role'] == 'system']
+        dialog = self.messages[len(system):]
+        return system + dialog[-MAX_CHAT_HISTORY:]
+
+    def save(self):
+        if self.cleared:
+            return
+        now = datetime.utcnow()
+        conversation = ChatConversation.query.get(self.conversation_id) if self.conversation_id else None
+        if conversation is None:
+            conversation = ChatConversation(id=uuid.uuid4().hex, user_id=self.user_id, created_at=now)
+            db.session.add(conversation)
+        self.messages = self._trimmed()
+        conversation.messages = list(self.messages)
+        conversation.updated_at = now
+        conversation.expires_at = now + _ttl()
+        db.session.commit()
+        self.conversation_id = conversation.id
+        session[SESSION_KEY] = conversation.id
+
+    def clear(self):
+        if self.conversation_id:
+            ChatConversation.query.filter_by(id=self.conversation_id, user_id=self.user_id).delete()
+            db.session.commit()
+        session.pop(SESSION_KEY, None)
+        self.conversation_id = None
+        self.messages = []
+        self.cleared = True
+
+
+def purge_expired_conversations():
+    """
+    Удаляет просроченные диалоги (TTL-эвикция). Вызывается планировщиком.
+    """
+    try:
+        deleted = ChatConversation.query.filter(
+            ChatConversation.expires_at <= datetime.utcnow()
+        ).delete(synchronize_session=False)
+        db.session.commit()
+        if deleted:
+            logger.info(f"Purged {deleted} expired chat conversations.")
+        return deleted
+    except Exception as e:
+        db.session.rollback()
+        logger.error(f"Error purging expired chat conversations: {e}", exc_info=True)
+        return 0
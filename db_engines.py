@@ -0,0 +1,356 @@
+# db_engines.py
+"""
+Настройка движков SQLAlchemy и пулов соединений.
+
+  * web — движок Flask-SQLAlchemy (db.engine), его параметры пула приходят
+    из SQLALCHEMY_ENGINE_OPTIONS = engine_options('web');
+  * scheduler — отдельный движок для заданий APScheduler, чтобы долгие
+    задания не забирали соединения у HTTP-запросов и вебхука;
+  * lock — соединения с сессионными advisory-блокировками (job_runner.py);
+  * replica — реплика для чтения (REPLICA_DATABASE_URL, read_replica.py).
+
+Параметры пула (DB_POOL_SIZE, DB_MAX_OVERFLOW, DB_POOL_TIMEOUT, DB_POOL_RECYCLE,
+DB_POOL_PRE_PING) задаются переменными окружения, для планировщика их можно
+переопределить с префиксом SCHEDULER_ (SCHEDULER_DB_POOL_SIZE и т.д.).
+
+DB_PGBOUNCER=true — режим transaction pooling в pgbouncer: соединение сервера
+выдаётся только на время транзакции, поэтому нельзя полагаться на состояние
+сессии. psycopg2 не использует серверные prepared statements, для asyncpg /
+psycopg3 их кэш отключается через connect_args. Сессионные advisory-блокировки
+через pgbouncer не работают — для них нужен DATABASE_DIRECT_URL (в обход pgbouncer).
+
+Время ожидания свободного соединения из пула пишется в гистограмму
+db_pool_wait_seconds{pool=...} (/metrics), таймауты — в db_pool_timeouts_total.
+
+Соединение пула, открытое в другом процессе (мастер gunicorn --preload),
+при checkout отбрасывается, см. _check_connection_pid.
+
+Проверка session_bound_to на двух базах (ORM-запрос должен уйти во вторую):
+
+    python db_engines.py check --primary postgresql://...:5432/db --other postgresql://...:5433/db
+"""
+
+import argparse
+import logging
+import os
+import threading
+import time
+from contextlib import contextmanager
+from urllib.parse import urlparse, urlunparse, parse_qs, urlencode
+
+from sqlalchemy import create_engine, event, exc
+from sqlalchemy.pool import QueuePool
+
+from request_metrics import request_metrics
+
+logger = logging.getLogger(__name__)
+
+DB_SSLMODE = os.environ.get('DB_SSLMODE', 'require').strip()
+DB_PGBOUNCER = os.environ.get('DB_PGBOUNCER', 'false').lower() == 'true'
+
+# Значения по умолчанию: web — как было в app.py, scheduler — под пул потоков APScheduler
+POOL_DEFAULTS = {
+    'web': {'pool_size': 5, 'max_overflow': 10, 'pool_timeout': 30, 'pool_recycle': 300, 'pool_pre_ping': True},
+    'scheduler': {'pool_size': 3, 'max_overflow': 7, 'pool_timeout': 60, 'pool_recycle': 300, 'pool_pre_ping': True},
+}
+
+_engines = {}  # role -> (pid, engine)
+_engines_lock = threading.Lock()
+_pool_classes = {}
+_lock_url_warned = False
+
+
+def _env_option(role, name, default):
+    keys = [f'DB_{name}']
+    if role != 'web':
+        keys.insert(0, f'{role.upper()}_DB_{name}')
+    for key in keys:
+        value = os.environ.get(key)
+        if value is not None and value.strip():
+            return value.strip()
+    return default
+
+
+def normalize_database_url(raw_url, sslmode=DB_SSLMODE):
+    """
+    Добавляет sslmode в строку подключения, если его там нет
+    (DB_SSLMODE=disable — для локального pgbouncer / Postgres без SSL).
+    """
+    parsed_url = urlparse(raw_url)
+    query_params = parse_qs(parsed_url.query)
+    if sslmode and 'sslmode' not in query_params:
+        query_params['sslmode'] = [sslmode]
+    return urlunparse(parsed_url._replace(query=urlencode(query_params, doseq=True)))
+
+
+class TimedQueuePool(QueuePool):
+    """
+    QueuePool, измеряющий ожидание соединения при checkout.
+    Подкласс на каждую роль (pool_class()) — recreate() создаёт пул
+    того же класса, и метка сохраняется.
+    """
+
+    metrics_role = 'web'
+
+    def _do_get(self):
+        labels = (('pool', self.metrics_role),)
+        started = time.perf_counter()
+        try:
+            return super()._do_get()
+        except exc.TimeoutError:
+            request_metrics.inc('db_pool_timeouts_total', labels)
+            logger.error(
+                f"DB pool '{self.metrics_role}' exhausted: {self.checkedout()} connections checked out "
+                f"(pool_size {self.size()}, overflow {self.overflow()})."
+            )
+            raise
+        finally:
+            request_metrics.observe('db_pool_wait_seconds', labels, time.perf_counter() - started)
+
+
+# Защита от fork (gunicorn --preload): соединение, открытое в мастере, не
+# выдаётся воркеру — пул считает его разорванным и открывает новое.
+# Слушатели на классе действуют и на подклассы ролей.
+@event.listens_for(TimedQueuePool, 'connect')
+def _remember_connection_pid(dbapi_connection, connection_record):
+    connection_record.info['pid'] = os.getpid()
+
+
+@event.listens_for(TimedQueuePool, 'checkout')
+def _check_connection_pid(dbapi_connection, connection_record, connection_proxy):
+    pid = os.getpid()
+    owner = connection_record.info.get('pid', pid)
+    if owner != pid:
+        # Не закрываем чужой сокет — только отвязываем его от записи пула
+        connection_record.connection = connection_proxy.connection = None
+        raise exc.DisconnectionError(
+            f"Connection record belongs to pid {owner}, attempting to check out in pid {pid}"
+        )
+
+
+def pool_class(role):
+    with _engines_lock:
+        cls = _pool_classes.get(role)
+        if cls is None:
+            cls = _pool_classes[role] = type(f'{role.title()}TimedQueuePool', (TimedQueuePool,), {'metrics_role': role})
+        return cls
+
+
+def _connect_args(url):
+    if not DB_PGBOUNCER:
+        return {}
+    driver = urlparse(url).scheme.partition('+')[2]
+    if driver == 'asyncpg':
+        return {'statement_cache_size': 0, 'prepared_statement_cache_size': 0}
+    if driver == 'psycopg':
+        return {'prepare_threshold': None}
+    # psycopg2 не создаёт серверных prepared statements
+    return {}
+
+
+def engine_options(role='web', url=None):
+    """
+    Параметры create_engine / SQLALCHEMY_ENGINE_OPTIONS для роли.
+    """
+    defaults = POOL_DEFAULTS.get(role, POOL_DEFAULTS['web'])
+    options = {
+        'poolclass': pool_class(role),
+        'pool_size': int(_env_option(role, 'POOL_SIZE', defaults['pool_size'])),
+        'max_overflow': int(_env_option(role, 'MAX_OVERFLOW', defaults['max_overflow'])),
+        'pool_timeout': float(_env_option(role, 'POOL_TIMEOUT', defaults['pool_timeout'])),
+        'pool_recycle': int(_env_option(role, 'POOL_RECYCLE', defaults['pool_recycle'])),
+        'pool_pre_ping': str(_env_option(role, 'POOL_PRE_PING', defaults['pool_pre_ping'])).lower() == 'true',
+    }
+    connect_args = _connect_args(url or '')
+    if connect_args:
+        options['connect_args'] = connect_args
+    return options
+
+
+def _cached_engine(role, url_factory):
+    """
+    Движок роли, созданный в текущем процессе: после fork пул родителя
+    не используется (его сокеты общие с родителем).
+    """
+    pid = os.getpid()
+    with _engines_lock:
+        cached = _engines.get(role)
+        if cached and cached[0] == pid:
+            return cached[1]
+    url = url_factory()
+    options = engine_options('scheduler' if role == 'lock' else role, url)
+    if role == 'lock':
+        options['poolclass'] = pool_class('lock')
+    engine = create_engine(url, **options)
+    with _engines_lock:
+        cached = _engines.get(role)
+        if cached and cached[0] == pid:
+            engine.dispose()
+            return cached[1]
+        _engines[role] = (pid, engine)
+    logger.info(
+        f"DB engine '{role}' created in pid {pid}: pool_size {options['pool_size']}, "
+        f"max_overflow {options['max_overflow']}, pgbouncer {DB_PGBOUNCER}."
+    )
+    return engine
+
+
+def get_scheduler_engine(app):
+    return _cached_engine('scheduler', lambda: app.config['SQLALCHEMY_DATABASE_URI'])
+
+
+def get_lock_engine(app):
+    """
+    Движок для advisory-блокировок: DATABASE_DIRECT_URL, если задан
+    (обязателен при DB_PGBOUNCER), иначе движок планировщика.
+    """
+    global _lock_url_warned
+    direct_url = os.environ.get('DATABASE_DIRECT_URL', '').strip()
+    if not direct_url:
+        if DB_PGBOUNCER and not _lock_url_warned:
+            _lock_url_warned = True
+            logger.warning(
+                "DB_PGBOUNCER is set without DATABASE_DIRECT_URL: advisory locks "
+                "(scheduler leader election) are unreliable in transaction pooling mode."
+            )
+        return get_scheduler_engine(app)
+    return _cached_engine('lock', lambda: normalize_database_url(direct_url))
+
+
+def get_replica_engine(app):
+    """
+    Движок реплики или None, если REPLICA_DATABASE_URL не задан
+    (пул — REPLICA_DB_POOL_SIZE и т.д., по умолчанию как у web).
+    """
+    replica_url = (app.config.get('REPLICA_DATABASE_URL') or '').strip()
+    if not replica_url:
+        return None
+    return _cached_engine('replica', lambda: normalize_database_url(replica_url))
+
+
+def created_engines():
+    """
+    Движки, созданные в этом процессе (без web — он у Flask-SQLAlchemy).
+    """
+    pid = os.getpid()
+    with _engines_lock:
+        return {role: engine for role, (owner, engine) in _engines.items() if owner == pid}
+
+
+def bound_session_options(db, engine):
+    """
+    Параметры db.create_session() для сессии, все запросы которой идут в engine.
+    Одного bind мало: SignallingSession Flask-SQLAlchemy всегда передаёт
+    binds (таблица -> db.engine), а Session.get_bind проверяет binds раньше
+    bind — ORM-запросы ушли бы в основной движок, только text() — в engine.
+    """
+    return {
+        'bind': engine,
+        'binds': {table: engine for table in db.Model.metadata.tables.values()},
+    }
+
+
+@contextmanager
+def session_bound_to(db, engine):
+    """
+    Подменяет db.session текущего потока сессией, привязанной к engine
+    (нужен app context). Код заданий по-прежнему пишет db.session.
+    """
+    db.session.remove()
+    db.session.registry.set(db.create_session(bound_session_options(db, engine))())
+    try:
+        yield db.session
+    finally:
+        db.session.remove()
+
+
+def pool_status_text(pools):
+    """
+    Текущее состояние пулов этого процесса в формате Prometheus.
+    pools — {role: pool}.
+    """
+    gauges = (
+        ('db_pool_checked_out', "Connections currently checked out of the pool (this process).", 'checkedout'),
+        ('db_pool_size', "Configured pool_size.", 'size'),
+        ('db_pool_overflow', "Current overflow connections (negative while the pool is not full).", 'overflow'),
+    )
+    pid = os.getpid()
+    lines = []
+    for name, help_text, method in gauges:
+        lines.append(f"# HELP {name} {help_text}")
+        lines.append(f"# TYPE {name} gauge")
+        for role, pool in sorted(pools.items()):
+            value = getattr(pool, method, None)
+            if value is None:
+                continue
+            lines.append(f'{name}{{pool="{role}",pid="{pid}"}} {float(value())}')
+    return '\n'.join(lines) + '\n'
+
+
+# --- Проверка на двух базах ---
+
+def check(primary_url, other_url):
+    from flask import Flask
+    from flask_sqlalchemy import SQLAlchemy
+
+    app = Flask(__name__)
+    app.config['SQLALCHEMY_DATABASE_URI'] = primary_url
+    app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+    check_db = SQLAlchemy(app)
+    other_engine = create_engine(other_url)
+
+    class EngineCheckNote(check_db.Model):
+        id = check_db.Column(check_db.Integer, primary_key=True)
+        label = check_db.Column(check_db.String(20), nullable=False)
+
+    results = {}
+    with app.app_context():
+        for engine, label in ((check_db.engine, 'primary'), (other_engine, 'other')):
+            EngineCheckNote.__table__.drop(engine, checkfirst=True)
+            EngineCheckNote.__table__.create(engine)
+            with engine.begin() as conn:
+                conn.execute(EngineCheckNote.__table__.insert(), {'label': label})
+        try:
+            results['db.session reads the primary'] = [n.label for n in EngineCheckNote.query.all()] == ['primary']
+            with session_bound_to(check_db, other_engine):
+                results['ORM query inside session_bound_to reads the other database'] = (
+                    [n.label for n in EngineCheckNote.query.all()] == ['other']
+                )
+                check_db.session.add(EngineCheckNote(label='written'))
+                check_db.session.commit()
+            results['db.session is restored after the block'] = (
+                [n.label for n in EngineCheckNote.query.all()] == ['primary']
+            )
+            with other_engine.connect() as conn:
+                labels = sorted(conn.execute(EngineCheckNote.__table__.select()).mappings().all(),
+                                key=lambda row: row['id'])
+            results['ORM write inside session_bound_to goes to the other database'] = (
+                [row['label'] for row in labels] == ['other', 'written']
+            )
+        finally:
+            check_db.session.remove()
+            for engine in (check_db.engine, other_engine):
+                EngineCheckNote.__table__.drop(engine, checkfirst=True)
+    other_engine.dispose()
+
+    for name, ok in results.items():
+        print(f"  {'ok  ' if ok else 'FAIL'} {name}")
+    return all(results.values())
+
+
+def main():
+    parser = argparse.ArgumentParser(description="SQLAlchemy engines and pools")
+    sub = parser.add_subparsers(dest='command', required=True)
+
+    ck = sub.add_parser('check', help="run mapped-model queries through session_bound_to against two databases")
+    ck.add_argument('--primary', default=os.environ.get('DATABASE_URL'), required=not os.environ.get('DATABASE_URL'))
+    ck.add_argument('--other', required=True, help="second database (e.g. a local Postgres on another port)")
+
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+    if args.command == 'check':
+        raise SystemExit(0 if check(args.primary, args.other) else 1)
+
+
+if __name__ == '__main__':
+    main()
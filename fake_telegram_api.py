@@ -0,0 +1,165 @@
+# fake_telegram_api.py
+"""
+Локальный фейковый Telegram Bot API для проверки очереди уведомлений.
+
+    python fake_telegram_api.py serve [--port 8081]
+    python fake_telegram_api.py check [--chats 40] [--messages 200]
+
+'serve' поднимает сервер, отвечающий на sendMessage как Bot API: при
+превышении лимитов (30 сообщений/с на бота, 1 сообщение/с в чат) он
+возвращает 429 с parameters.retry_after. Приложение направляется на него
+через TELEGRAM_API_BASE_URL=http://127.0.0.1:8081/bot.
+
+'check' запускает сервер в фоне, прогоняет через NotificationQueue пачку
+сообщений (несколько на пользователя) и печатает, сколько запросов дошло,
+сколько было 429 и соблюдались ли лимиты. Не импортирует app/routes.
+"""
+
+import argparse
+import json
+import threading
+import time
+from collections import defaultdict, deque
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs
+
+GLOBAL_LIMIT = 30
+PER_CHAT_INTERVAL = 1.0
+RETRY_AFTER = 1
+
+
+class FakeBotAPI:
+    """
+    Состояние фейкового API: принятые сообщения и выданные 429.
+    """
+
+    def __init__(self, global_limit=GLOBAL_LIMIT, per_chat_interval=PER_CHAT_INTERVAL,
+                 retry_after=RETRY_AFTER):
+        self.global_limit = global_limit
+        self.per_chat_interval = per_chat_interval
+        self.retry_after = retry_after
+        self.lock = threading.Lock()
+        self.recent = deque()
+        self.last_by_chat = {}
+        self.messages = defaultdict(list)   # chat_id -> [text, ...]
+        self.rejected = 0
+        self.message_id = 0
+
+    def send_message(self, chat_id, text):
+        """
+        Возвращает (status, payload) в формате ответа Bot API.
+        """
+        with self.lock:
+            now = time.monotonic()
+            while self.recent and now - self.recent[0] >= 1.0:
+                self.recent.popleft()
+            last = self.last_by_chat.get(chat_id)
+            if len(self.recent) >= self.global_limit or (last is not None and now - last < self.per_chat_interval):
+                self.rejected += 1
+                return 429, {
+                    'ok': False, 'error_code': 429,
+                    'description': f"Too Many Requests: retry after {self.retry_after}",
+                    'parameters': {'retry_after': self.retry_after},
+                }
+            self.recent.append(now)
+            self.last_by_chat[chat_id] = now
+            self.messages[chat_id].append(text)
+            self.message_id += 1
+            return 200, {'ok': True, 'result': {
+                'message_id': self.message_id, 'date': int(time.time()),
+                'chat': {'id': chat_id, 'type': 'private'}, 'text': text,
+            }}
+
+
+def make_handler(api):
+    class Handler(BaseHTTPRequestHandler):
+        def do_POST(self):
+            body = self.rfile.read(int(self.headers.get('Content-Length') or 0)).decode()
+            if 'json' in (self.headers.get('Content-Type') or ''):
+                params = json.loads(body or '{}')
+            else:
+                params = {k: v[0] for k, v in parse_qs(body).items()}
+
+            if self.path.endswith('/sendMessage'):
+                status, payload = api.send_message(int(params['chat_id']), params.get('text', ''))
+            elif self.path.endswith('/getMe'):
+                status, payload = 200, {'ok': True, 'result': {
+                    'id': 1, 'is_bot': True, 'first_name': 'Fake', 'username': 'fake_bot'}}
+            else:
+                status, payload = 404, {'ok': False, 'error_code': 404, 'description': 'Not Found'}
+
+            data = json.dumps(payload).encode()
+            self.send_response(status)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        do_GET = do_POST
+
+        def log_message(self, format, *args):
+            pass
+
+    return Handler
+
+
+def start_server(api, port=0):
+    server = ThreadingHTTPServer(('127.0.0.1', port), make_handler(api))
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def check(chats, messages):
+    from telegram import Bot
+    from telegram_notify import NotificationQueue
+
+    api = FakeBotAPI()
+    server = start_server(api)
+    base_url = f"http://127.0.0.1:{server.server_address[1]}/bot"
+    queue = NotificationQueue(Bot(token='123:fake', base_url=base_url))
+
+    started = time.monotonic()
+    for i in range(messages):
+        queue.send(1000 + i % chats, f"Notification #{i}")
+    enqueued = time.monotonic() - started
+    drained = queue.drain(timeout=120)
+    elapsed = time.monotonic() - started
+    server.shutdown()
+
+    received = sum(len(texts) for texts in api.messages.values())
+    delivered = sum(text.count('Notification #') for texts in api.messages.values() for text in texts)
+    print(f"Enqueued {messages} messages for {chats} chats in {enqueued * 1000:.1f} ms")
+    print(f"  drained: {drained} in {elapsed:.2f}s")
+    print(f"  API calls accepted: {received}, rejected with 429: {api.rejected}")
+    print(f"  notifications delivered: {delivered}/{messages}")
+    print(f"  queue stats: {queue.stats()}")
+    return drained and delivered == messages
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Fake Telegram Bot API for the notification queue")
+    sub = parser.add_subparsers(dest='command', required=True)
+
+    serve = sub.add_parser('serve', help="run the fake API")
+    serve.add_argument('--port', type=int, default=8081)
+
+    chk = sub.add_parser('check', help="push notifications through NotificationQueue against the fake API")
+    chk.add_argument('--chats', type=int, default=40)
+    chk.add_argument('--messages', type=int, default=200)
+
+    args = parser.parse_args()
+    if args.command == 'serve':
+        api = FakeBotAPI()
+        server = start_server(api, args.port)
+        print(f"Fake Bot API on http://127.0.0.1:{args.port}/bot<token>/ (Ctrl+C to stop)")
+        try:
+            while True:
+                time.sleep(1)
+        except KeyboardInterrupt:
+            server.shutdown()
+    elif args.command == 'check':
+        raise SystemExit(0 if check(args.chats, args.messages) else 1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,30 @@
+# gunicorn.conf.py
+# gunicorn читает этот файл автоматически (запуск: gunicorn wsgi:application).
+#
+# APP_PRELOAD=true — preload_app: app.py и прогрев (wsgi.py) выполняются один раз
+# в мастере, воркеры получают модель и справочники copy-on-write и стартуют
+# без повторного импорта. Потоки и соединения в мастере не создаются,
+# их запускает post_fork (app_lifecycle.post_fork_setup).
+
+import os
+
+bind = f"0.0.0.0:{os.environ.get('PORT', '5000')}"
+timeout = int(os.environ.get('GUNICORN_TIMEOUT', '120'))
+workers = int(os.environ.get('WEB_CONCURRENCY', '1'))
+preload_app = os.environ.get('APP_PRELOAD', 'false').lower() == 'true'
+
+# WEB_THREADS>1 — воркер gthread: столько запросов одного процесса могут
+# одновременно ждать внешних сервисов (OpenAI, RPC, ParaSwap, GeckoTerminal),
+# а async-view (async_io.py) внутри запроса делают свои вызовы параллельно.
+# timeout для gthread — это пульс воркера, а не лимит на запрос: долгий
+# внешний вызов не убивает воркер. Пул БД (DB_POOL_SIZE + DB_MAX_OVERFLOW)
+# стоит держать не меньше числа потоков, которые обращаются к базе.
+threads = int(os.environ.get('WEB_THREADS', '1'))
+
+
+def post_fork(server, worker):
+    # Без preload_app модуль приложения ещё не импортирован, службы
+    # запустятся при импорте в воркере
+    if preload_app:
+        from app_lifecycle import post_fork_setup
+        post_fork_setup()
@@ -0,0 +1,238 @@
+# instrument_resolver.py
+
+import logging
+import re
+import threading
+from collections import namedtuple
+
+from rapidfuzz import fuzz, process
+
+from models import Instrument
+from poll_functions import YFINANCE_TICKERS
+
+logger = logging.getLogger(__name__)
+
+# Результат разрешения: лёгкая запись вместо ORM-объекта, чтобы индекс
+# можно было безопасно переиспользовать между запросами/сессиями.
+ResolvedInstrument = namedtuple('ResolvedInstrument', ['id', 'name', 'score'])
+
+# Минимальный fuzzy-score (0..100), при котором совпадение считается уверенным,
+# и минимальный отрыв лучшего инструмента от второго.
+FUZZY_ACCEPT_SCORE = 86
+FUZZY_MIN_MARGIN = 6
+# Сколько кандидатов показывать в отчёте о неоднозначности.
+AMBIGUITY_REPORT_SIZE = 5
+
+# Многоязычные синонимы -> точное имя инструмента в БД.
+# Ключи нормализуются так же, как пользовательский ввод (см. normalize_instrument_name).
+SYNONYMS = {
+    # Товары
+    "серебро": "Silver", "xag": "Silver", "xag/usd": "Silver", "silver": "Silver",
+    "золото": "Gold", "xau": "Gold", "xau/usd": "Gold", "gold": "Gold",
+    "нефть": "Crude Oil", "oil": "Crude Oil", "wti": "Crude Oil", "brent": "Crude Oil",
+    "газ": "Natural Gas", "gas": "Natural Gas", "natgas": "Natural Gas",
+    "медь": "Copper", "кукуруза": "Corn", "пшеница": "Wheat", "соя": "Soybean",
+    "кофе": "Coffee", "сахар": "Sugar",
+    # Форекс
+    "euro": "EUR/USD", "евро": "EUR/USD", "eurodollar": "EUR/USD", "fiber": "EUR/USD",
+    "фунт": "GBP/USD", "pound": "GBP/USD", "cable": "GBP/USD",
+    "иена": "USD/JPY", "йена": "USD/JPY", "yen": "USD/JPY",
+    "франк": "USD/CHF", "swissy": "USD/CHF",
+    "aussie": "AUD/USD", "австралиец": "AUD/USD",
+    "loonie": "USD/CAD", "луни": "USD/CAD",
+    "kiwi": "NZD/USD", "киви": "NZD/USD",
+    # Индексы
+    "sp500": "S&P 500", "spx": "S&P 500", "snp": "S&P 500", "es": "S&P 500",
+    "доу": "Dow Jones", "dow": "Dow Jones", "djia": "Dow Jones",
+    "nasdaq100": "NASDAQ", "насдак": "NASDAQ", "nq": "NASDAQ",
+    "дакс": "DAX", "nikkei": "Nikkei 225", "никкей": "Nikkei 225",
+    "hangseng": "Hang Seng", "ftse": "FTSE 100", "cac": "CAC 40",
+    "stoxx": "Euro Stoxx 50", "eurostoxx": "Euro Stoxx 50",
+    # Криптовалюты
+    "bitcoin": "BTC-USD", "биткоин": "BTC-USD", "биток": "BTC-USD", "xbt": "BTC-USD",
+    "ethereum": "ETH-USD", "эфир": "ETH-USD", "эфириум": "ETH-USD", "ether": "ETH-USD",
+    "litecoin": "LTC-USD", "лайткоин": "LTC-USD",
+    "ripple": "XRP-USD", "рипл": "XRP-USD",
+    "solana": "SOL-USD", "солана": "SOL-USD",
+    "cardano": "ADA-USD", "кардано": "ADA-USD",
+    "dogecoin": "DOGE-USD", "доги": "DOGE-USD", "додж": "DOGE-USD",
+    "polkadot": "DOT-USD", "polygon": "MATIC-USD", "avalanche": "AVAX-USD",
+    "chainlink": "LINK-USD", "uniswap": "UNI-USD", "cosmos": "ATOM-USD",
+    "tron": "TRX-USD", "stellar": "XLM-USD", "shiba": "SHIB-USD",
+}
+
+_NORMALIZE_RE = re.compile(r"[\s/\-_=^.,:;'\"()]+")
+
+
+def normalize_instrument_name(value: str) -> str:
+    """
+    Приводит название инструмента к каноническому виду для поиска:
+    нижний регистр, 'ё' -> 'е', без пробелов и разделителей ('/', '-', '_' и т.п.).
+    'EUR/USD', 'eur usd' и 'EURUSD' дают одно и то же значение 'eurusd'.
+    """
+    if not value:
+        return ''
+    value = value.strip().lower().replace('ё', 'е')
+    return _NORMALIZE_RE.sub('', value)
+
+
+class InstrumentResolver:
+    """
+    In-memory index for resolving free-form instrument names (as typed by the
+    user or produced by the assistant) to Instrument rows.
+
+    The index is built once from the instrument table and covers normalized
+    names, yfinance tickers, crypto base symbols and multilingual synonyms.
+    Lookups go exact alias -> unique substring -> rapidfuzz scoring; anything
+    that is not a confident match raises ValueError with a ranked report of
+    the best candidates.
+    """
+
+    def __init__(self, instruments):
+        # instruments: iterable of (id, name)
+        self._by_id = {}
+        self._aliases = {}  # normalized alias -> instrument id
+        for instrument_id, name in instruments:
+            self._by_id[instrument_id] = name
+        name_to_id = {name: instrument_id for instrument_id, name in self._by_id.items()}
+
+        for instrument_id, name in self._by_id.items():
+            self._add_alias(name, instrument_id)
+            ticker = YFINANCE_TICKERS.get(name)
+            if ticker:
+                self._add_alias(ticker, instrument_id)
+                # 'EURUSD=X' -> 'eurusd' (суффикс yfinance не несёт смысла)
+                if ticker.upper().endswith('=X'):
+                    self._add_alias(ticker[:-2], instrument_id)
+            # 'BTC-USD' -> 'btc'
+            if name.upper().endswith('-USD'):
+                self._add_alias(name[:-4], instrument_id)
+
+        for synonym, target in SYNONYMS.items():
+            target_id = name_to_id.get(target)
+            if target_id is not None:
+                self._add_alias(synonym, target_id)
+
+        self._alias_keys = list(self._aliases.keys())
+        logger.info(
+            f"Instrument resolver index built: {len(self._by_id)} instruments, "
+            f"{len(self._alias_keys)} aliases."
+        )
+
+    def _add_alias(self, alias, instrument_id):
+        key = normalize_instrument_name(alias)
+        if not key:
+            return
+        existing = self._aliases.get(key)
+        if existing is not None and existing != instrument_id:
+            # Конфликтующий алиас — оставляем первый (точные имена добавляются раньше синонимов)
+            logger.debug(f"Alias '{key}' already maps to instrument {existing}, skipping {instrument_id}.")
+            return
+        self._aliases[key] = instrument_id
+
+    @classmethod
+    def from_db(cls):
+        rows = Instrument.query.with_entities(Instrument.id, Instrument.name).all()
+        return cls(rows)
+
+    def _resolved(self, instrument_id, score):
+        return ResolvedInstrument(instrument_id, self._by_id[instrument_id], score)
+
+    def rank(self, user_input: str, limit: int = AMBIGUITY_REPORT_SIZE):
+        """
+        Returns up to `limit` candidates ordered by descending fuzzy score,
+        one entry per instrument.
+        """
+        query = normalize_instrument_name(user_input)
+        if not query or not self._alias_keys:
+            return []
+        best = {}
+        for alias, score, _ in process.extract(
+            query, self._alias_keys, scorer=fuzz.WRatio, limit=limit * 4
+        ):
+            instrument_id = self._aliases[alias]
+            if score > best.get(instrument_id, -1):
+                best[instrument_id] = score
+        ranked = sorted(best.items(), key=lambda item: item[1], reverse=True)[:limit]
+        return [self._resolved(instrument_id, round(score, 1)) for instrument_id, score in ranked]
+
+    def resolve(self, user_input: str) -> ResolvedInstrument:
+        """
+        Resolves one instrument name. Raises ValueError when the name is
+        unknown or ambiguous.
+        """
+        query = normalize_instrument_name(user_input)
+        if not query:
+            raise ValueError("Instrument name is empty.")
+
+        # 1) Точное совпадение с именем, тикером или синонимом
+        instrument_id = self._aliases.get(query)
+        if instrument_id is not None:
+            return self._resolved(instrument_id, 100.0)
+
+        # 2) Частичное совпадение (как раньше), но по всем алиасам
+        substring_ids = {iid for alias, iid in self._aliases.items() if query in alias}
+        if len(substring_ids) == 1:
+            return self._resolved(substring_ids.pop(), 100.0)
+
+        # 3) Fuzzy scoring
+        ranked = self.rank(user_input)
+        if ranked:
+            top = ranked[0]
+            runner_up = ranked[1].score if len(ranked) > 1 else 0.0
+            if top.score >= FUZZY_ACCEPT_SCORE and top.score - runner_up >= FUZZY_MIN_MARGIN:
+                return top
+
+        if len(substring_ids) > 1 or (ranked and ranked[0].score >= FUZZY_ACCEPT_SCORE):
+            if substring_ids:
+                candidates = [c for c in ranked if c.id in substring_ids] or ranked
+            else:
+                candidates = ranked
+            report = ", ".join(f"{c.name} ({c.score:.0f})" for c in candidates)
+            raise ValueError(f"Ambiguous instrument '{user_input}'. Matches: {report}")
+
+        if ranked:
+            report = ", ".join(f"{c.name} ({c.score:.0f})" for c in ranked[:3])
+            raise ValueError(f"Instrument '{user_input}' not found in DB. Did you mean: {report}?")
+        raise ValueError(f"Instrument '{user_input}' not found in DB.")
+
+    def resolve_many(self, names):
+        """
+        Resolves a batch of names in one pass (each distinct name is looked up once).
+        Returns {name: ResolvedInstrument | ValueError}.
+        """
+        results = {}
+        for name in names:
+            if name in results:
+                continue
+            try:
+                results[name] = self.resolve(name or '')
+            except ValueError as e:
+                results[name] = e
+        return results
+
+
+_resolver = None
+_resolver_lock = threading.Lock()
+
+
+def get_instrument_resolver() -> InstrumentResolver:
+    """
+    Returns the process-wide resolver, building the index on first use.
+    """
+    global _resolver
+    if _resolver is None:
+        with _resolver_lock:
+            if _resolver is None:
+                _resolver = InstrumentResolver.from_db()
+    return _resolver
+
+
+def reset_instrument_resolver():
+    """
+    Drops the cached index; the next lookup rebuilds it from the DB.
+    Call after instruments are added or renamed.
+    """
+    global _resolver
+    with _resolver_lock:
+        _resolver = None
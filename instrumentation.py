@@ -0,0 +1,202 @@
+# instrumentation.py
+
+import logging
+import os
+import re
+import threading
+import time
+from contextlib import contextmanager
+from urllib.parse import urlparse
+
+from sqlalchemy import event
+
+logger = logging.getLogger(__name__)
+
+DML_PREFIXES = ('INSERT', 'UPDATE', 'DELETE')
+# Виды внешних вызовов: JSON-RPC (web3), OpenAI, прочий HTTP
+EXTERNAL_KINDS = ('rpc', 'openai', 'http')
+
+_local = threading.local()
+_instrumented_engines = set()
+_http_installed = False
+_install_lock = threading.Lock()
+
+_WHITESPACE_RE = re.compile(r'\s+')
+_PARAM_LIST_RE = re.compile(r'\((?:\s*%\([^)]+\)s\s*,?)+\)')
+_NUMBER_RE = re.compile(r'\b\d+\b')
+
+
+def normalize_statement(statement):
+    """
+    Приводит SQL к «форме» запроса: одинаковые запросы с разными
+    параметрами / длиной IN-списка дают одну строку (для поиска N+1).
+    """
+    statement = _WHITESPACE_RE.sub(' ', statement).strip()
+    statement = _PARAM_LIST_RE.sub('(?)', statement)
+    return _NUMBER_RE.sub('?', statement)
+
+
+class Collector:
+    """
+    Счётчики работы, выполненной в текущем потоке: SQL-запросы, затронутые
+    строки (INSERT/UPDATE/DELETE) и исходящие HTTP-вызовы (requests —
+    через него ходят web3, openai и прямые вызовы API).
+    """
+
+    def __init__(self, track_statements=False):
+        self.sql_queries = 0
+        self.sql_time_ms = 0.0
+        self.rows_touched = 0
+        self.external_calls = 0
+        self.external_time_ms = 0.0
+        self.external_by_host = {}
+        self.external_by_kind = {}  # kind -> [calls, time_ms]
+        # Число запросов каждой «формы» (для детектора N+1)
+        self.statement_counts = {} if track_statements else None
+
+    def as_dict(self):
+        return {
+            'sql_queries': self.sql_queries,
+            'sql_time_ms': round(self.sql_time_ms, 2),
+            'rows_touched': self.rows_touched,
+            'external_calls': self.external_calls,
+            'external_time_ms': round(self.external_time_ms, 2),
+            'external_by_host': dict(self.external_by_host),
+        }
+
+    def most_repeated_statement(self):
+        """
+        (statement, count) самого частого запроса или (None, 0).
+        """
+        if not self.statement_counts:
+            return None, 0
+        statement = max(self.statement_counts, key=self.statement_counts.get)
+        return statement, self.statement_counts[statement]
+
+
+def current_collector():
+    return getattr(_local, 'collector', None)
+
+
+def activate(collector):
+    """
+    Делает collector текущим для потока, возвращает предыдущий
+    (для хуков before/teardown, где контекстный менеджер неудобен).
+    """
+    previous = current_collector()
+    _local.collector = collector
+    return previous
+
+
+def deactivate(previous):
+    _local.collector = previous
+
+
+@contextmanager
+def collect(collector=None):
+    """
+    Включает сбор счётчиков в текущем потоке на время блока.
+    """
+    collector = collector or Collector()
+    previous = activate(collector)
+    try:
+        yield collector
+    finally:
+        deactivate(previous)
+
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    conn.info['query_started'] = time.perf_counter()
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    collector = current_collector()
+    if collector is None:
+        return
+    started = conn.info.get('query_started', time.perf_counter())
+    collector.sql_queries += 1
+    collector.sql_time_ms += (time.perf_counter() - started) * 1000
+    # Сравниваем по тексту, чтобы учитывать и text()/сырые запросы
+    if statement.lstrip()[:6].upper() in DML_PREFIXES and cursor.rowcount and cursor.rowcount > 0:
+        collector.rows_touched += cursor.rowcount
+    if collector.statement_counts is not None:
+        shape = normalize_statement(statement)
+        collector.statement_counts[shape] = collector.statement_counts.get(shape, 0) + 1
+
+
+def install_sql_hooks(engine):
+    """
+    Подписывается на события движка (один раз на engine).
+    """
+    if id(engine) in _instrumented_engines:
+        return
+    with _install_lock:
+        if id(engine) in _instrumented_engines:
+            return
+        event.listen(engine, 'before_cursor_execute', _before_cursor_execute)
+        event.listen(engine, 'after_cursor_execute', _after_cursor_execute)
+        _instrumented_engines.add(id(engine))
+
+
+def record_external_call(host, elapsed_ms, kind='http', collector=None):
+    """
+    Учитывает внешний вызов, сделанный не через requests
+    (collector — сборщик запроса, если вызов сделан из другого потока).
+    """
+    collector = collector or current_collector()
+    if collector is None:
+        return
+    collector.external_calls += 1
+    collector.external_time_ms += elapsed_ms
+    collector.external_by_host[host] = collector.external_by_host.get(host, 0) + 1
+    totals = collector.external_by_kind.setdefault(kind, [0, 0.0])
+    totals[0] += 1
+    totals[1] += elapsed_ms
+
+
+def _openai_hosts():
+    hosts = {'api.openai.com'}
+    api_base = os.environ.get('OPENAI_API_BASE')
+    if api_base:
+        hosts.add(urlparse(api_base).hostname)
+    return hosts
+
+
+def external_call_kind(request, host):
+    # requests.PreparedRequest.body или httpx.Request.content
+    body = request.body if hasattr(request, 'body') else request.content
+    if isinstance(body, str):
+        body = body.encode()
+    if isinstance(body, bytes) and b'"jsonrpc"' in body:
+        return 'rpc'
+    if host in _openai_hosts():
+        return 'openai'
+    return 'http'
+
+
+def install_http_hooks():
+    """
+    Оборачивает requests.Session.send (один раз на процесс).
+    """
+    global _http_installed
+    with _install_lock:
+        if _http_installed:
+            return
+        import requests
+
+        original_send = requests.Session.send
+
+        def send(session, request, **kwargs):
+            if current_collector() is None:
+                return original_send(session, request, **kwargs)
+            started = time.perf_counter()
+            try:
+                return original_send(session, request, **kwargs)
+            finally:
+                host = urlparse(request.url).hostname or ''
+                record_external_call(
+                    host, (time.perf_counter() - started) * 1000, external_call_kind(request, host)
+                )
+
+        requests.Session.send = send
+        _http_installed = True
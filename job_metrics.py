@@ -0,0 +1,148 @@
+# job_metrics.py
+
+import logging
+from datetime import datetime, timedelta
+
+from sqlalchemy import case, func
+
+from models import db, JobRun
+
+logger = logging.getLogger(__name__)
+
+# Окно, за которое считаются агрегаты (часы)
+DEFAULT_WINDOW_HOURS = 24
+FINISHED_STATUSES = ('success', 'failed')
+
+
+def _epoch(value):
+    return (value - datetime(1970, 1, 1)).total_seconds() if value else None
+
+
+def job_stats(intervals=None, window_hours=DEFAULT_WINDOW_HOURS):
+    """
+    Сводка по заданиям из job_run (общая для кластера, т.к. выполняет
+    только лидер): число запусков по статусам, длительности, перерасход
+    интервала и счётчики последнего завершённого запуска.
+    """
+    since = datetime.utcnow() - timedelta(hours=window_hours)
+    jobs = {}
+
+    def job_entry(job_id):
+        return jobs.setdefault(job_id, {
+            'job_id': job_id,
+            'interval_seconds': (intervals or {}).get(job_id),
+            'runs': {},
+            'avg_duration_ms': None,
+            'max_duration_ms': None,
+            'overruns': 0,
+            'running': 0,
+            'last_run': None,
+            'last_success_at': None,
+            'last_success_ts': None,
+        })
+
+    rows = db.session.query(
+        JobRun.job_id, JobRun.status, func.count(JobRun.id),
+        func.sum(case((JobRun.overran, 1), else_=0))
+    ).filter(JobRun.started_at >= since).group_by(JobRun.job_id, JobRun.status).all()
+    for job_id, status, count, overruns in rows:
+        entry = job_entry(job_id)
+        entry['runs'][status] = count
+        entry['overruns'] += int(overruns or 0)
+        if status == 'running':
+            entry['running'] = count
+
+    durations = db.session.query(
+        JobRun.job_id, func.avg(JobRun.duration_ms), func.max(JobRun.duration_ms)
+    ).filter(
+        JobRun.started_at >= since, JobRun.status.in_(FINISHED_STATUSES)
+    ).group_by(JobRun.job_id).all()
+    for job_id, avg_ms, max_ms in durations:
+        entry = job_entry(job_id)
+        entry['avg_duration_ms'] = float(avg_ms) if avg_ms is not None else None
+        entry['max_duration_ms'] = float(max_ms) if max_ms is not None else None
+
+    # Последний завершённый запуск каждого задания (DISTINCT ON)
+    last_runs = JobRun.query.filter(
+        JobRun.status.in_(FINISHED_STATUSES)
+    ).order_by(JobRun.job_id, JobRun.started_at.desc()).distinct(JobRun.job_id).all()
+    for run in last_runs:
+        job_entry(run.job_id)['last_run'] = {
+            'status': run.status,
+            'started_at': run.started_at.isoformat(),
+            'finished_at': run.finished_at.isoformat() if run.finished_at else None,
+            'duration_ms': run.duration_ms,
+            'overran': run.overran,
+            'sql_queries': run.sql_queries,
+            'rows_touched': run.rows_touched,
+            'external_calls': run.external_calls,
+            'external_time_ms': run.external_time_ms,
+            'host': run.host,
+            'pid': run.pid,
+        }
+
+    for job_id, last_success in db.session.query(
+        JobRun.job_id, func.max(JobRun.finished_at)
+    ).filter(JobRun.status == 'success').group_by(JobRun.job_id).all():
+        entry = job_entry(job_id)
+        entry['last_success_at'] = last_success.isoformat() if last_success else None
+        entry['last_success_ts'] = _epoch(last_success)
+
+    for job_id in intervals or {}:
+        job_entry(job_id)
+    return sorted(jobs.values(), key=lambda entry: entry['job_id'])
+
+
+def _label(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def prometheus_text(stats, is_leader=None, window_hours=DEFAULT_WINDOW_HOURS):
+    """
+    Те же данные в текстовом формате Prometheus.
+    """
+    lines = []
+
+    def metric(name, kind, help_text, samples):
+        lines.append(f"# HELP {name} {help_text}")
+        lines.append(f"# TYPE {name} {kind}")
+        for labels, value in samples:
+            if value is None:
+                continue
+            label_text = ','.join(f'{key}="{_label(val)}"' for key, val in labels.items())
+            series = f"{name}{{{label_text}}}" if label_text else name
+            lines.append(f"{series} {float(value)}")
+
+    metric('scheduler_job_runs', 'gauge', f"Job runs recorded in the last {window_hours}h by status.", [
+        ({'job': s['job_id'], 'status': status}, count)
+        for s in stats for status, count in sorted(s['runs'].items())
+    ])
+    metric('scheduler_job_overruns', 'gauge',
+           f"Runs in the last {window_hours}h that exceeded the job interval or were skipped because the previous run was still going.",
+           [({'job': s['job_id']}, s['overruns']) for s in stats])
+    metric('scheduler_job_running', 'gauge', "Runs currently marked as running.",
+           [({'job': s['job_id']}, s['running']) for s in stats])
+    metric('scheduler_job_interval_seconds', 'gauge', "Configured interval between runs.",
+           [({'job': s['job_id']}, s['interval_seconds']) for s in stats])
+    metric('scheduler_job_duration_seconds_avg', 'gauge', f"Average run duration over the last {window_hours}h.",
+           [({'job': s['job_id']}, s['avg_duration_ms'] / 1000 if s['avg_duration_ms'] is not None else None) for s in stats])
+    metric('scheduler_job_duration_seconds_max', 'gauge', f"Longest run duration over the last {window_hours}h.",
+           [({'job': s['job_id']}, s['max_duration_ms'] / 1000 if s['max_duration_ms'] is not None else None) for s in stats])
+
+    last = [(s['job_id'], s['last_run']) for s in stats if s['last_run']]
+    metric('scheduler_job_last_duration_seconds', 'gauge', "Duration of the last finished run.",
+           [({'job': job}, run['duration_ms'] / 1000 if run['duration_ms'] is not None else None) for job, run in last])
+    metric('scheduler_job_last_failed', 'gauge', "1 if the last finished run failed.",
+           [({'job': job}, 1 if run['status'] == 'failed' else 0) for job, run in last])
+    metric('scheduler_job_last_rows_touched', 'gauge', "Rows inserted/updated/deleted by the last finished run.",
+           [({'job': job}, run['rows_touched']) for job, run in last])
+    metric('scheduler_job_last_sql_queries', 'gauge', "SQL statements executed by the last finished run.",
+           [({'job': job}, run['sql_queries']) for job, run in last])
+    metric('scheduler_job_last_external_calls', 'gauge', "Outbound HTTP calls made by the last finished run.",
+           [({'job': job}, run['external_calls']) for job, run in last])
+    metric('scheduler_job_last_success_timestamp_seconds', 'gauge', "Unix time of the last successful run.",
+           [({'job': s['job_id']}, s['last_success_ts']) for s in stats])
+    if is_leader is not None:
+        metric('scheduler_leader', 'gauge', "1 if the process serving this scrape is the scheduler leader.",
+               [({}, 1 if is_leader else 0)])
+    return '\n'.join(lines) + '\n'
@@ -0,0 +1,490 @@
+# job_runner.py
+"""
+Запуск заданий APScheduler ровно один раз на кластер.
+
+Планировщик стартует в каждом процессе (воркеры gunicorn, инстансы), но
+задания выполняет только лидер — процесс, удерживающий сессионную
+advisory-блокировку Postgres на отдельном соединении. Если лидер умирает,
+соединение закрывается, блокировка освобождается и её забирает другой
+процесс при следующей проверке. Дополнительно каждое выполнение берёт
+advisory-блокировку своего задания, чтобы два запуска одного задания
+не пересекались даже при смене лидера, и под ней проверяет по job_run, не
+запускалось ли задание (на любом процессе) в пределах своего интервала:
+у каждого процесса свои таймеры, а флаг лидерства обновляется раз в
+LEADER_CHECK_SECONDS, поэтому новый (или ещё не знающий о смене) лидер мог бы
+повторить только что выполненное задание (выплаты, начисления). Каждое выполнение пишется в job_run
+со счётчиками (SQL-запросы, затронутые строки, внешние вызовы) и флагом
+overran, если длилось дольше своего интервала; пропуски APScheduler
+(misfire, max_instances) пишутся как 'missed'/'skipped'.
+
+Задания работают через свой движок (engine), а не через пул HTTP-запросов:
+на время задания db.session потока привязывается к нему. Блокировки берутся
+через lock_engine (прямое соединение в обход pgbouncer, см. db_engines.py).
+
+Проверка с несколькими локальными процессами:
+
+    python job_runner.py demo --database-url postgresql://... [--processes 3]
+                              [--seconds 30] [--interval 2] [--kill-leader]
+"""
+
+import argparse
+import hashlib
+import logging
+import multiprocessing
+import os
+import signal
+import socket
+import threading
+import time
+import traceback
+from datetime import datetime, timedelta, timezone
+
+from apscheduler.events import EVENT_JOB_MAX_INSTANCES, EVENT_JOB_MISSED
+from sqlalchemy import func, select, text
+
+from db_engines import session_bound_to
+from instrumentation import collect, install_http_hooks, install_sql_hooks
+from models import db, JobRun
+
+logger = logging.getLogger(__name__)
+
+LEADER_LOCK_NAME = 'apscheduler-leader'
+# Как часто процессы пытаются стать лидером / лидер проверяет своё соединение
+LEADER_CHECK_SECONDS = float(os.environ.get('SCHEDULER_LEADER_CHECK_SECONDS', '15'))
+# false — задания выполняются в каждом процессе (как раньше), но не параллельно
+LEADER_ELECTION = os.environ.get('SCHEDULER_LEADER_ELECTION', 'true').lower() == 'true'
+# Запуск пропускается, если задание уже стартовало меньше чем
+# JOB_MIN_GAP_RATIO * интервал назад (0 — не проверять)
+JOB_MIN_GAP_RATIO = float(os.environ.get('SCHEDULER_JOB_MIN_GAP_RATIO', '0.9'))
+# Сколько дней хранить историю запусков
+JOB_RUN_HISTORY_DAYS = int(os.environ.get('JOB_RUN_HISTORY_DAYS', '14'))
+
+
+def advisory_lock_key(name):
+    """
+    Стабильный 64-битный ключ pg_advisory_lock из имени.
+    """
+    return int.from_bytes(hashlib.sha1(name.encode()).digest()[:8], 'big', signed=True)
+
+
+def trigger_interval_seconds(trigger):
+    """
+    Интервал между запусками: для interval-триггера — сам интервал,
+    для cron — расстояние между двумя ближайшими срабатываниями.
+    """
+    interval = getattr(trigger, 'interval', None)
+    if interval is not None:
+        return interval.total_seconds()
+    try:
+        now = datetime.now(timezone.utc)
+        first = trigger.get_next_fire_time(None, now)
+        second = trigger.get_next_fire_time(first, first) if first else None
+        if first and second:
+            return (second - first).total_seconds()
+    except Exception as e:
+        logger.debug(f"Could not compute trigger interval: {e}")
+    return None
+
+
+class JobRunner:
+    """
+    Обёртка над BackgroundScheduler: add_job() принимает те же аргументы,
+    что scheduler.add_job, и регистрирует задание, выполняющееся только
+    на лидере, в app context, с записью в историю запусков.
+    engine / lock_engine — Engine или функция без аргументов, возвращающая
+    его (движки создаются лениво, в процессе, где выполняются задания).
+    """
+
+    def __init__(self, app=None, scheduler=None, engine=None, lock_engine=None,
+                 leader_election=LEADER_ELECTION, check_interval=LEADER_CHECK_SECONDS):
+        self.app = app
+        self.scheduler = scheduler
+        self._engine = engine
+        self._lock_engine = lock_engine
+        self.leader_election = leader_election
+        self.check_interval = check_interval
+        self.host = socket.gethostname()
+        self._leader_conn = None
+        self._is_leader = False
+        self._pid = None
+        self._thread = None
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self.intervals = {}  # job_id -> интервал в секундах (для флага overran)
+        install_http_hooks()
+        if scheduler is not None:
+            scheduler.add_listener(self._on_scheduler_event, EVENT_JOB_MISSED | EVENT_JOB_MAX_INSTANCES)
+
+    # --- База ---
+
+    @property
+    def engine(self):
+        if callable(self._engine):
+            return self._engine()
+        if self._engine is not None:
+            return self._engine
+        with self.app.app_context():
+            return db.engine
+
+    @property
+    def lock_engine(self):
+        if callable(self._lock_engine):
+            return self._lock_engine()
+        return self._lock_engine if self._lock_engine is not None else self.engine
+
+    def _supports_locks(self):
+        return self.lock_engine.dialect.name == 'postgresql'
+
+    def _lock_connection(self):
+        # Отдельное соединение вне транзакции: сессионная блокировка живёт,
+        # пока живёт соединение, и не держит «idle in transaction»
+        return self.lock_engine.connect().execution_options(isolation_level='AUTOCOMMIT')
+
+    # --- Выборы лидера ---
+
+    def start(self):
+        """
+        Запускает поток выборов в текущем процессе (после fork — заново).
+        """
+        pid = os.getpid()
+        with self._lock:
+            if self._pid == pid:
+                return
+            # Соединение, унаследованное от родителя, не закрываем — это
+            # закрыло бы сокет и в родительском процессе
+            self._leader_conn = None
+            self._is_leader = False
+            self._pid = pid
+            self._stop.clear()
+            if not self.leader_election or not self._supports_locks():
+                return
+            self._thread = threading.Thread(target=self._election_loop, name='scheduler-election', daemon=True)
+            self._thread.start()
+
+    def is_leader(self):
+        if not self.leader_election:
+            return True
+        self.start()
+        if not self._supports_locks():
+            return True
+        return self._is_leader
+
+    def _election_loop(self):
+        while not self._stop.is_set():
+            try:
+                if self._is_leader:
+                    self._leader_conn.execute(text('SELECT 1'))
+                else:
+                    self._try_acquire_leadership()
+            except Exception as e:
+                if self._is_leader:
+                    logger.error(f"Scheduler leader connection lost, stepping down: {e}")
+                else:
+                    logger.warning(f"Scheduler leader election failed: {e}")
+                self._drop_leadership()
+            self._stop.wait(self.check_interval)
+
+    def _try_acquire_leadership(self):
+        conn = self._lock_connection()
+        acquired = conn.execute(
+            text('SELECT pg_try_advisory_lock(:key)'), {'key': advisory_lock_key(LEADER_LOCK_NAME)}
+        ).scalar()
+        if acquired:
+            self._leader_conn = conn
+            self._is_leader = True
+            logger.info(f"Scheduler leader: {self.host} pid {os.getpid()}.")
+        else:
+            conn.close()
+
+    def _drop_leadership(self):
+        self._is_leader = False
+        conn, self._leader_conn = self._leader_conn, None
+        if conn is not None:
+            # invalidate закрывает само DBAPI-соединение (и снимает блокировку
+            # на сервере), а не возвращает его с блокировкой в пул
+            try:
+                conn.invalidate()
+                conn.close()
+            except Exception:
+                pass
+
+    def shutdown(self):
+        self._stop.set()
+        if self._pid == os.getpid():
+            self._drop_leadership()
+
+    # --- Задания ---
+
+    def add_job(self, id, func, **kwargs):
+        job = self.scheduler.add_job(id=id, func=self.wrap(id, func), **kwargs)
+        self.intervals[id] = trigger_interval_seconds(job.trigger)
+        return job
+
+    def wrap(self, job_id, func):
+        def run_job():
+            if not self.is_leader():
+                logger.debug(f"Job '{job_id}' skipped: not the scheduler leader.")
+                return
+            self.run(job_id, func)
+        run_job.__name__ = getattr(func, '__name__', 'job')
+        return run_job
+
+    def run(self, job_id, func):
+        """
+        Выполняет задание под его advisory-блокировкой и пишет историю
+        со счётчиками (SQL, затронутые строки, внешние вызовы).
+        """
+        interval = self.intervals.get(job_id)
+        lock_conn = None
+        if self._supports_locks():
+            lock_conn = self._lock_connection()
+            locked = lock_conn.execute(
+                text('SELECT pg_try_advisory_lock(:key)'), {'key': advisory_lock_key(f'job:{job_id}')}
+            ).scalar()
+            if not locked:
+                lock_conn.close()
+                logger.warning(f"Job '{job_id}' is already running elsewhere, skipping this run.")
+                self._record_event(job_id, 'skipped', 'previous run still holds the job lock')
+                return
+
+        last_started = self._last_run_within_interval(job_id, interval)
+        if last_started is not None:
+            logger.info(
+                f"Job '{job_id}' skipped: already started at {last_started} UTC, "
+                f"within its {interval:.0f}s interval."
+            )
+            self._release_job_lock(lock_conn, job_id)
+            return
+
+        engine = self.engine
+        install_sql_hooks(engine)
+        run_id = self._insert_run(
+            job_id=job_id, host=self.host, pid=os.getpid(), started_at=datetime.utcnow(),
+            status='running', interval_seconds=interval
+        )
+        started = time.perf_counter()
+        status, error = 'success', None
+        with collect() as counters:
+            try:
+                if self.app is not None:
+                    with self.app.app_context(), session_bound_to(db, engine):
+                        func()
+                else:
+                    func()
+            except Exception as e:
+                status, error = 'failed', traceback.format_exc()
+                logger.error(f"Error executing job '{job_id}': {e}")
+                logger.error(error)
+        duration_ms = (time.perf_counter() - started) * 1000
+        overran = interval is not None and duration_ms > interval * 1000
+        if overran:
+            logger.warning(f"Job '{job_id}' took {duration_ms / 1000:.1f}s, longer than its {interval:.0f}s interval.")
+        try:
+            self._update_run(
+                run_id, finished_at=datetime.utcnow(), duration_ms=duration_ms, status=status, error=error,
+                overran=overran, sql_queries=counters.sql_queries, rows_touched=counters.rows_touched,
+                external_calls=counters.external_calls, external_time_ms=counters.external_time_ms
+            )
+        finally:
+            self._release_job_lock(lock_conn, job_id)
+        logger.info(
+            f"Job '{job_id}' finished: {status} in {duration_ms:.0f} ms, "
+            f"{counters.sql_queries} queries, {counters.rows_touched} rows, {counters.external_calls} external calls."
+        )
+
+    def _release_job_lock(self, lock_conn, job_id):
+        if lock_conn is None:
+            return
+        try:
+            lock_conn.execute(text('SELECT pg_advisory_unlock(:key)'), {'key': advisory_lock_key(f'job:{job_id}')})
+        finally:
+            lock_conn.close()
+
+    def _last_run_within_interval(self, job_id, interval):
+        """
+        Начало последнего запуска задания (на любом процессе), если оно было
+        меньше JOB_MIN_GAP_RATIO * interval назад, иначе None. Вызывается под
+        блокировкой задания, поэтому запись предыдущего запуска уже видна.
+        """
+        if not interval or JOB_MIN_GAP_RATIO <= 0:
+            return None
+        table = JobRun.__table__
+        cutoff = datetime.utcnow() - timedelta(seconds=interval * JOB_MIN_GAP_RATIO)
+        try:
+            with self.engine.connect() as conn:
+                return conn.execute(
+                    select(func.max(table.c.started_at)).where(
+                        table.c.job_id == job_id,
+                        table.c.started_at > cutoff,
+                        table.c.status.in_(('running', 'success', 'failed'))
+                    )
+                ).scalar()
+        except Exception as e:
+            logger.warning(f"Could not check previous runs of job '{job_id}': {e}")
+            return None
+
+    def _on_scheduler_event(self, event):
+        # Пропуски APScheduler: misfire (не успели вовремя) или предыдущий запуск
+        # ещё идёт (max_instances). Пишет только лидер — остальные задания не выполняют
+        if not self.is_leader():
+            return
+        if event.code == EVENT_JOB_MISSED:
+            self._record_event(event.job_id, 'missed', f"misfire, scheduled at {event.scheduled_run_time}")
+        else:
+            self._record_event(event.job_id, 'skipped', 'previous run still in progress (max_instances)')
+
+    def _record_event(self, job_id, status, note):
+        now = datetime.utcnow()
+        self._insert_run(
+            job_id=job_id, host=self.host, pid=os.getpid(), started_at=now, finished_at=now,
+            status=status, error=note, interval_seconds=self.intervals.get(job_id),
+            overran=status == 'skipped'
+        )
+
+    def _insert_run(self, **values):
+        # История пишется отдельным соединением, не через db.session задания
+        try:
+            with self.engine.begin() as conn:
+                return conn.execute(
+                    JobRun.__table__.insert().values(**values).returning(JobRun.__table__.c.id)
+                ).scalar()
+        except Exception as e:
+            logger.warning(f"Could not record run of job '{values.get('job_id')}': {e}")
+            return None
+
+    def _update_run(self, run_id, **values):
+        if run_id is None:
+            return
+        try:
+            with self.engine.begin() as conn:
+                conn.execute(
+                    JobRun.__table__.update().where(JobRun.__table__.c.id == run_id).values(**values)
+                )
+        except Exception as e:
+            logger.warning(f"Could not record finish of job run {run_id}: {e}")
+
+    def purge_history(self, days=JOB_RUN_HISTORY_DAYS):
+        cutoff = datetime.utcnow() - timedelta(days=days)
+        with self.engine.begin() as conn:
+            deleted = conn.execute(
+                JobRun.__table__.delete().where(JobRun.__table__.c.started_at < cutoff)
+            ).rowcount
+        if deleted:
+            logger.info(f"Purged {deleted} job run records older than {days} days.")
+        return deleted
+
+
+def recent_runs(limit=100, job_id=None):
+    """
+    Последние запуски заданий (для админки).
+    """
+    query = JobRun.query.order_by(JobRun.started_at.desc())
+    if job_id:
+        query = query.filter_by(job_id=job_id)
+    return query.limit(limit).all()
+
+
+# --- Проверка несколькими процессами ---
+
+DEMO_JOB_ID = 'demo-tick'
+
+
+def _demo_tick():
+    time.sleep(0.5)
+
+
+def _demo_process(database_url, interval, check_interval):
+    from apscheduler.schedulers.background import BackgroundScheduler
+    from sqlalchemy import create_engine
+
+    logging.basicConfig(level=logging.INFO, format=f'%(asctime)s [{os.getpid()}] %(message)s')
+    engine = create_engine(database_url)
+    runner = JobRunner(scheduler=BackgroundScheduler(), engine=engine,
+                       leader_election=True, check_interval=check_interval)
+    runner.add_job(id=DEMO_JOB_ID, func=_demo_tick, trigger='interval', seconds=interval)
+    runner.start()
+    runner.scheduler.start()
+    while True:
+        time.sleep(1)
+
+
+def _demo_runs(engine, since):
+    table = JobRun.__table__
+    with engine.connect() as conn:
+        return conn.execute(
+            table.select().where(
+                table.c.job_id == DEMO_JOB_ID, table.c.started_at >= since,
+                table.c.status.in_(('running', 'success', 'failed'))
+            ).order_by(table.c.started_at)
+        ).fetchall()
+
+
+def demo(database_url, processes, seconds, interval, kill_leader):
+    from sqlalchemy import create_engine
+
+    engine = create_engine(database_url)
+    JobRun.__table__.create(engine, checkfirst=True)
+    since = datetime.utcnow()
+    check_interval = max(interval / 2, 0.5)
+
+    ctx = multiprocessing.get_context('spawn')
+    children = [
+        ctx.Process(target=_demo_process, args=(database_url, interval, check_interval), daemon=True)
+        for _ in range(processes)
+    ]
+    for child in children:
+        child.start()
+
+    killed, killed_at = None, None
+    try:
+        time.sleep(seconds / 2 if kill_leader else seconds)
+        if kill_leader:
+            runs = _demo_runs(engine, since)
+            if runs:
+                killed, killed_at = runs[-1].pid, datetime.utcnow()
+                print(f"Killing leader pid {killed}")
+                os.kill(killed, signal.SIGKILL)
+            time.sleep(seconds / 2)
+    finally:
+        for child in children:
+            if child.is_alive():
+                child.terminate()
+        for child in children:
+            child.join()
+
+    runs = _demo_runs(engine, since)
+    overlaps = sum(
+        1 for prev, cur in zip(runs, runs[1:])
+        if prev.finished_at is None or cur.started_at < prev.finished_at
+    )
+    per_pid = {}
+    for run in runs:
+        per_pid[run.pid] = per_pid.get(run.pid, 0) + 1
+    expected = int(seconds / interval)
+    print(f"{processes} processes, interval {interval}s, {seconds}s: {len(runs)} runs (about {expected} expected)")
+    print(f"  runs per pid: {per_pid}")
+    print(f"  overlapping runs: {overlaps}")
+    if killed:
+        print(f"  runs by other processes after the kill: {sum(1 for run in runs if run.started_at > killed_at)}")
+    return overlaps == 0 and len(runs) <= expected + 1
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Cluster-wide APScheduler job runner")
+    sub = parser.add_subparsers(dest='command', required=True)
+
+    dm = sub.add_parser('demo', help="run a job in several processes and check it executes once per tick")
+    dm.add_argument('--database-url', default=os.environ.get('DATABASE_URL'), required=not os.environ.get('DATABASE_URL'))
+    dm.add_argument('--processes', type=int, default=3)
+    dm.add_argument('--seconds', type=float, default=30)
+    dm.add_argument('--interval', type=float, default=2)
+    dm.add_argument('--kill-leader', action='store_true', help="SIGKILL the leader halfway to test failover")
+
+    args = parser.parse_args()
+    if args.command == 'demo':
+        ok = demo(args.database_url, args.processes, args.seconds, args.interval, args.kill_leader)
+        raise SystemExit(0 if ok else 1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,164 @@
+# lazy_imports.py
+"""
+Отложенная загрузка тяжёлых подсистем (torch, matplotlib, numpy, web3, openai...).
+
+lazy_import('numpy') возвращает фасад модуля: настоящий import выполняется
+при первом обращении к атрибуту (np.asarray(...)), а не при импорте app.py.
+LazyObject(factory) — то же для объектов, создание которых дорого или
+требует сети (подключение к RPC, контракты, клиент S3).
+
+Время загрузки и прирост RSS каждой подсистемы пишутся в import_stats
+('python startup_bench.py --app' показывает, что загрузилось при старте).
+"""
+
+import importlib
+import logging
+import os
+import resource
+import sys
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+# Модуль -> {'seconds', 'rss_delta_mb', 'loaded_at', 'pid'} для загруженных через фасады
+import_stats = {}
+
+_lock = threading.RLock()
+_import_hooks = {}  # модуль -> [callback(module)]
+_facades = {}
+
+
+def current_rss_bytes():
+    """
+    Текущий RSS процесса (Linux — /proc, иначе пиковый ru_maxrss).
+    """
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmRSS:'):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak if sys.platform == 'darwin' else peak * 1024
+
+
+def on_import(name, callback):
+    """
+    Вызывает callback(module) после загрузки модуля (сразу, если модуль уже
+    импортирован): настройка matplotlib backend, openai.api_key и т.п.
+    """
+    with _lock:
+        if name in sys.modules:
+            callback(sys.modules[name])
+        else:
+            _import_hooks.setdefault(name, []).append(callback)
+
+
+def load_module(name):
+    """
+    import name с записью времени и RSS первой загрузки.
+    """
+    module = sys.modules.get(name)
+    if module is not None and name in import_stats:
+        return module
+    with _lock:
+        if name in import_stats:
+            return sys.modules[name]
+        already_loaded = name in sys.modules
+        rss_before = current_rss_bytes()
+        started = time.perf_counter()
+        module = importlib.import_module(name)
+        for callback in _import_hooks.pop(name, []):
+            callback(module)
+        elapsed = time.perf_counter() - started
+        import_stats[name] = {
+            'seconds': round(elapsed, 4),
+            'rss_delta_mb': round((current_rss_bytes() - rss_before) / (1024 * 1024), 1),
+            'loaded_at': time.time(),
+            'pid': os.getpid(),
+            'already_imported': already_loaded,
+        }
+        if not already_loaded:
+            logger.info(f"Loaded '{name}' on first use in {elapsed * 1000:.0f} ms.")
+        return module
+
+
+class LazyObject:
+    """
+    Прокси, создающий объект factory() при первом обращении к атрибуту
+    или вызове. Ошибка создания не кэшируется дольше retry_seconds:
+    следующая попытка (например, переподключение к RPC) будет после паузы.
+    Объект, созданный до fork (gunicorn --preload), в дочернем процессе
+    создаётся заново: его сокеты и потоки принадлежат родителю.
+    """
+
+    def __init__(self, factory, name, retry_seconds=0):
+        self.__dict__.update(
+            _lazy_factory=factory, _lazy_name=name, _lazy_retry=retry_seconds,
+            _lazy_lock=threading.Lock(), _lazy_failed_at=0.0, _lazy_error=None,
+        )
+
+    def _lazy_resolve(self):
+        target = self.__dict__.get('_lazy_target')
+        if target is not None and self.__dict__.get('_lazy_pid') == os.getpid():
+            return target
+        with self._lazy_lock:
+            target = self.__dict__.get('_lazy_target')
+            if target is not None and self.__dict__.get('_lazy_pid') == os.getpid():
+                return target
+            if self._lazy_error is not None and time.monotonic() - self._lazy_failed_at < self._lazy_retry:
+                raise self._lazy_error
+            try:
+                target = self._lazy_factory()
+            except Exception as e:
+                self.__dict__.update(_lazy_error=e, _lazy_failed_at=time.monotonic())
+                raise
+            self.__dict__.update(_lazy_target=target, _lazy_pid=os.getpid(), _lazy_error=None)
+            return target
+
+    def __getattr__(self, attr):
+        return getattr(self._lazy_resolve(), attr)
+
+    def __setattr__(self, attr, value):
+        setattr(self._lazy_resolve(), attr, value)
+
+    def __call__(self, *args, **kwargs):
+        return self._lazy_resolve()(*args, **kwargs)
+
+    def __dir__(self):
+        return dir(self._lazy_resolve())
+
+    def __repr__(self):
+        state = 'loaded' if '_lazy_target' in self.__dict__ else 'not loaded'
+        return f"<lazy {self._lazy_name} ({state})>"
+
+
+def resolve(obj):
+    """
+    Настоящий объект за фасадом (или сам obj, если это не фасад).
+    """
+    return obj._lazy_resolve() if isinstance(obj, LazyObject) else obj
+
+
+def is_loaded(obj):
+    return not isinstance(obj, LazyObject) or obj.__dict__.get('_lazy_pid') == os.getpid()
+
+
+def lazy_import(name):
+    """
+    Фасад модуля name (один на процесс).
+    """
+    with _lock:
+        facade = _facades.get(name)
+        if facade is None:
+            facade = _facades[name] = LazyObject(lambda: load_module(name), name)
+        return facade
+
+
+def lazy_attribute(module_name, attr):
+    """
+    Фасад атрибута модуля: lazy_attribute('web3', 'Web3').
+    """
+    return LazyObject(lambda: getattr(load_module(module_name), attr), f'{module_name}.{attr}')
@@ -25,6 +25,8 @@ class User(db.Model):
     auth_token_creation_time = db.Column(db.DateTime, nullable=True)
     registered_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
     assistant_premium = db.Column(db.Boolean, default=False)
+    # Версия журнала для кэша контекста ассистента (assistant_context.bump_trade_stats_version)
+    trade_data_version = db.Column(db.Integer, nullable=False, default=0, server_default='0')
     game_scores = db.relationship('UserGameScore', back_populates='user', lazy=True)
     wallet_address = db.Column(db.String(42), unique=True, nullable=True)  # Основной кошелёк
     private_key = db.Column(db.String(128), nullable=True)  # Приватный ключ основного кошелька
@@ -271,3 +273,82 @@ class UserGameScore(db.Model):
     last_played_date = db.Column(db.Date)
 
     user = db.relationship('User', back_populates='game_scores')
+
+class ChatConversation(db.Model):
+    __tablename__ = 'chat_conversation'
+    id = db.Column(db.String(32), primary_key=True)  # uuid4().hex, хранится в session['chat_conversation_id']
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False, index=True)
+    messages = db.Column(db.JSON, nullable=False, default=list)
+    created_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+    updated_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+    expires_at = db.Column(db.DateTime, nullable=False, index=True)
+
+    user = db.relationship('User')
+
+class ChartAnalysisCache(db.Model):
+    __tablename__ = 'chart_trend_cache'
+    content_hash = db.Column(db.String(64), primary_key=True)  # sha256 пикселей входа модели 128x128
+    model_version = db.Column(db.String(64), primary_key=True)  # бэкенд + md5 файла модели
+    phash = db.Column(db.String(64), nullable=False, index=True)  # dHash 16x16 (256 бит)
+    trend_label = db.Column(db.String(20), nullable=False)
+    hits = db.Column(db.Integer, nullable=False, default=0)
+    created_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+    last_used_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow, index=True)
+
+class PollPredictionAggregate(db.Model):
+    __tablename__ = 'poll_prediction_aggregate'
+    poll_id = db.Column(db.Integer, db.ForeignKey('poll.id'), primary_key=True)
+    instrument_id = db.Column(db.Integer, db.ForeignKey('instrument.id'), primary_key=True)
+    count = db.Column(db.Integer, nullable=False, default=0)
+    total = db.Column(db.Float, nullable=False, default=0.0)      # сумма прогнозов
+    total_sq = db.Column(db.Float, nullable=False, default=0.0)   # сумма квадратов
+    min_price = db.Column(db.Float, nullable=True)
+    max_price = db.Column(db.Float, nullable=True)
+    # Корзины фиксированной ширины: [bucket_low, bucket_low + bucket_width * len(buckets))
+    bucket_low = db.Column(db.Float, nullable=False)
+    bucket_width = db.Column(db.Float, nullable=False)
+    buckets = db.Column(db.JSON, nullable=False)
+    underflow = db.Column(db.Integer, nullable=False, default=0)
+    overflow = db.Column(db.Integer, nullable=False, default=0)
+    real_price = db.Column(db.Float, nullable=True)  # последняя известная реальная цена
+    updated_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+
+class PollPayout(db.Model):
+    __tablename__ = 'poll_payout'
+    id = db.Column(db.Integer, primary_key=True)
+    poll_id = db.Column(db.Integer, db.ForeignKey('poll.id'), nullable=False, index=True)
+    instrument_id = db.Column(db.Integer, db.ForeignKey('instrument.id'), nullable=False)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
+    amount = db.Column(db.Float, nullable=False)
+    deviation = db.Column(db.Float, nullable=True)
+    # 'pending' -> 'processing' -> 'sent' | 'failed' | 'skipped'
+    status = db.Column(db.String(20), nullable=False, default='pending', index=True)
+    attempts = db.Column(db.Integer, nullable=False, default=0)
+    error = db.Column(db.String(255), nullable=True)
+    created_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+    processed_at = db.Column(db.DateTime, nullable=True)
+
+    __table_args__ = (
+        db.UniqueConstraint('poll_id', 'instrument_id', name='unique_poll_instrument_payout'),
+    )
+
+    user = db.relationship('User')
+
+class JobRun(db.Model):
+    __tablename__ = 'job_run'
+    id = db.Column(db.Integer, primary_key=True)
+    job_id = db.Column(db.String(100), nullable=False, index=True)
+    host = db.Column(db.String(255), nullable=True)
+    pid = db.Column(db.Integer, nullable=True)
+    started_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow, index=True)
+    finished_at = db.Column(db.DateTime, nullable=True)
+    duration_ms = db.Column(db.Float, nullable=True)
+    # 'running' -> 'success' | 'failed'; 'skipped' (уже выполняется), 'missed' (misfire APScheduler)
+    status = db.Column(db.String(20), nullable=False, default='running', index=True)
+    error = db.Column(db.Text, nullable=True)
+    interval_seconds = db.Column(db.Float, nullable=True)
+    overran = db.Column(db.Boolean, nullable=False, default=False)  # длительность > интервала
+    sql_queries = db.Column(db.Integer, nullable=True)
+    rows_touched = db.Column(db.Integer, nullable=True)
+    external_calls = db.Column(db.Integer, nullable=True)
+    external_time_ms = db.Column(db.Float, nullable=True)
@@ -0,0 +1,207 @@
+# poll_aggregates.py
+
+import logging
+import math
+from datetime import datetime
+
+from sqlalchemy import func
+from sqlalchemy.dialects.postgresql import insert
+
+from models import db, UserPrediction, PollPredictionAggregate
+
+logger = logging.getLogger(__name__)
+
+# Число корзин фиксированной ширины; диапазон совпадает с допустимым при
+# голосовании (±20% от реальной цены на момент первого прогноза)
+BUCKET_COUNT = 40
+BUCKET_RANGE = 0.2
+
+
+def _bucket_layout(center):
+    center = abs(center) or 1.0
+    low = center * (1 - BUCKET_RANGE)
+    width = center * 2 * BUCKET_RANGE / BUCKET_COUNT
+    return low, width
+
+
+def _bucket_index(agg, price):
+    """
+    Индекс корзины; -1 — ниже диапазона, BUCKET_COUNT — выше.
+    """
+    index = int(math.floor((price - agg.bucket_low) / agg.bucket_width))
+    if index < 0:
+        return -1
+    return min(index, len(agg.buckets))
+
+
+def _locked_aggregate(poll_id, instrument_id, center):
+    """
+    Создаёт строку агрегата при необходимости и берёт её под FOR UPDATE
+    (голоса по одной паре poll/instrument сериализуются на этой строке).
+    Возвращает (aggregate, created).
+    """
+    low, width = _bucket_layout(center)
+    result = db.session.execute(
+        insert(PollPredictionAggregate.__table__).values(
+            poll_id=poll_id, instrument_id=instrument_id, count=0, total=0.0, total_sq=0.0,
+            bucket_low=low, bucket_width=width, buckets=[0] * BUCKET_COUNT,
+            underflow=0, overflow=0, updated_at=datetime.utcnow()
+        ).on_conflict_do_nothing(index_elements=['poll_id', 'instrument_id'])
+    )
+    aggregate = PollPredictionAggregate.query.filter_by(
+        poll_id=poll_id, instrument_id=instrument_id
+    ).populate_existing().with_for_update().one()
+    return aggregate, result.rowcount == 1
+
+
+def _fill_from_predictions(agg):
+    """
+    Пересчитывает агрегат из user_prediction SQL-агрегатами (без загрузки строк).
+    """
+    count, total, total_sq, min_price, max_price, real_price = db.session.query(
+        func.count(UserPrediction.id),
+        func.coalesce(func.sum(UserPrediction.predicted_price), 0.0),
+        func.coalesce(func.sum(UserPrediction.predicted_price * UserPrediction.predicted_price), 0.0),
+        func.min(UserPrediction.predicted_price),
+        func.max(UserPrediction.predicted_price),
+        func.max(UserPrediction.real_price)
+    ).filter_by(poll_id=agg.poll_id, instrument_id=agg.instrument_id).one()
+
+    high = agg.bucket_low + agg.bucket_width * BUCKET_COUNT
+    buckets = [0] * BUCKET_COUNT
+    underflow = overflow = 0
+    # width_bucket: 0 — ниже low, BUCKET_COUNT + 1 — не ниже high
+    for bucket, bucket_count in db.session.query(
+        func.width_bucket(UserPrediction.predicted_price, agg.bucket_low, high, BUCKET_COUNT),
+        func.count(UserPrediction.id)
+    ).filter_by(poll_id=agg.poll_id, instrument_id=agg.instrument_id).group_by(1).all():
+        if bucket == 0:
+            underflow += bucket_count
+        elif bucket > BUCKET_COUNT:
+            overflow += bucket_count
+        else:
+            buckets[bucket - 1] += bucket_count
+
+    agg.count = count
+    agg.total = float(total)
+    agg.total_sq = float(total_sq)
+    agg.min_price = min_price
+    agg.max_price = max_price
+    agg.buckets = buckets
+    agg.underflow = underflow
+    agg.overflow = overflow
+    if real_price is not None:
+        agg.real_price = real_price
+    agg.updated_at = datetime.utcnow()
+
+
+def record_prediction(poll_id, instrument_id, predicted_price, reference_price):
+    """
+    Учитывает новый прогноз в агрегате. Вызывается в той же транзакции, что
+    и вставка UserPrediction (после flush), коммитит вызывающий код.
+    Если строки агрегата ещё не было, она строится из уже сохранённых прогнозов.
+    """
+    aggregate, created = _locked_aggregate(poll_id, instrument_id, reference_price)
+    if created:
+        _fill_from_predictions(aggregate)
+    else:
+        price = float(predicted_price)
+        aggregate.count += 1
+        aggregate.total += price
+        aggregate.total_sq += price * price
+        aggregate.min_price = price if aggregate.min_price is None else min(aggregate.min_price, price)
+        aggregate.max_price = price if aggregate.max_price is None else max(aggregate.max_price, price)
+        index = _bucket_index(aggregate, price)
+        if index < 0:
+            aggregate.underflow += 1
+        elif index >= len(aggregate.buckets):
+            aggregate.overflow += 1
+        else:
+            buckets = list(aggregate.buckets)
+            buckets[index] += 1
+            aggregate.buckets = buckets
+        aggregate.updated_at = datetime.utcnow()
+    if reference_price is not None:
+        aggregate.real_price = reference_price
+    return aggregate
+
+
+def set_real_prices(poll_id, prices_by_instrument):
+    """
+    Обновляет real_price в агрегатах опроса (джоб обновления реальных цен).
+    """
+    for instrument_id, price in prices_by_instrument.items():
+        PollPredictionAggregate.query.filter_by(
+            poll_id=poll_id, instrument_id=instrument_id
+        ).update({'real_price': price}, synchronize_session=False)
+
+
+def rebuild_aggregates(poll_id=None):
+    """
+    Полный пересчёт агрегатов из user_prediction (для существующих опросов
+    или после ручных правок). Возвращает число пересчитанных пар.
+    """
+    query = db.session.query(
+        UserPrediction.poll_id,
+        UserPrediction.instrument_id,
+        func.avg(UserPrediction.predicted_price)
+    )
+    if poll_id is not None:
+        query = query.filter(UserPrediction.poll_id == poll_id)
+    groups = query.group_by(UserPrediction.poll_id, UserPrediction.instrument_id).all()
+
+    for group_poll_id, instrument_id, avg_price in groups:
+        aggregate, _ = _locked_aggregate(group_poll_id, instrument_id, float(avg_price))
+        aggregate.bucket_low, aggregate.bucket_width = _bucket_layout(float(avg_price))
+        _fill_from_predictions(aggregate)
+        db.session.commit()
+    logger.info(f"Rebuilt {len(groups)} poll prediction aggregates.")
+    return len(groups)
+
+
+def aggregate_stats(agg):
+    """
+    Статистика по агрегату: консенсус (среднее), стандартное отклонение, min/max.
+    """
+    if not agg.count:
+        return {'count': 0, 'consensus_price': None, 'std': None, 'min': None, 'max': None}
+    mean = agg.total / agg.count
+    variance = max(agg.total_sq / agg.count - mean * mean, 0.0)
+    return {
+        'count': agg.count,
+        'consensus_price': mean,
+        'std': math.sqrt(variance),
+        'min': agg.min_price,
+        'max': agg.max_price,
+        'real_price': agg.real_price,
+    }
+
+
+def aggregate_histogram(agg):
+    """
+    (counts, edges) для отрисовки: пустые корзины по краям отрезаются,
+    выходы за диапазон добавляются крайними столбцами до min/max.
+    """
+    buckets = list(agg.buckets)
+    high = agg.bucket_low + agg.bucket_width * len(buckets)
+    nonzero = [i for i, c in enumerate(buckets) if c]
+    counts, edges = [], []
+    if nonzero:
+        first, last = nonzero[0], nonzero[-1]
+        counts = buckets[first:last + 1]
+        edges = [agg.bucket_low + agg.bucket_width * i for i in range(first, last + 2)]
+    if agg.underflow:
+        if not edges:
+            edges = [agg.bucket_low]
+        counts.insert(0, agg.underflow)
+        edges.insert(0, min(agg.min_price, edges[0] - agg.bucket_width))
+    if agg.overflow:
+        if not edges:
+            edges = [high]
+        elif not nonzero:
+            # Только выходы за диапазон с обеих сторон — пустой промежуток между ними
+            counts.append(0)
+            edges.append(high)
+        counts.append(agg.overflow)
+        edges.append(max(agg.max_price, edges[-1] + agg.bucket_width))
+    return counts, edges
@@ -3,7 +3,9 @@
 import random
 import traceback
 from datetime import datetime, timedelta
-import yfinance as yf
+from lazy_imports import lazy_import
+from sqlalchemy import case, func
+from sqlalchemy.dialects.postgresql import insert
 from models import (
     Poll,
     PollInstrument,
@@ -12,10 +14,16 @@ from models import (
     InstrumentCategory,
     db,
     Config,
-    User
+    User,
+    PollPayout
 )
 from flask import current_app
 from best_setup_voting import send_token_reward as voting_send_token_reward
+from poll_aggregates import set_real_prices
+from telegram_notify import send_notification
+
+# yfinance (и pandas) загружаются при первом запросе цены
+yf = lazy_import('yfinance')
 
 # Mapping of instruments to yfinance tickers
 YFINANCE_TICKERS = {
@@ -128,15 +136,19 @@ def update_real_prices_for_active_polls():
         current_app.logger.info(f"[update_real_prices_for_active_polls] Total active polls: {len(active_polls)}")
 
         for poll in active_polls:
+            # Одна цена на инструмент (не на каждый прогноз)
+            prices = {}
             for prediction in poll.predictions:
-                instrument_name = prediction.instrument.name
-                real_price = get_real_price(instrument_name)
+                if prediction.instrument_id not in prices:
+                    prices[prediction.instrument_id] = get_real_price(prediction.instrument.name)
+                real_price = prices[prediction.instrument_id]
                 if real_price is not None:
                     prediction.real_price = real_price
                     if prediction.predicted_price != 0:
                         prediction.deviation = ((real_price - prediction.predicted_price) / prediction.predicted_price) * 100
                     else:
                         prediction.deviation = None
+            set_real_prices(poll.id, {iid: price for iid, price in prices.items() if price is not None})
         db.session.commit()
         current_app.logger.info("[update_real_prices_for_active_polls] Update completed.")
     except Exception as e:
@@ -210,10 +222,85 @@ def start_new_poll():
     current_app.logger.info(f"Created poll {poll.id} for 10 minutes, instruments: {[i.name for i in chosen_instruments]}")
 
 
+def refresh_poll_real_prices(poll):
+    """
+    Обновляет real_price/deviation всех прогнозов опроса: одна цена на инструмент
+    и один UPDATE на инструмент (deviation считается в SQL).
+    """
+    prices = {}
+    for pi in poll.poll_instruments:
+        rp = get_real_price(pi.instrument.name)
+        if rp is None:
+            continue
+        prices[pi.instrument_id] = rp
+        UserPrediction.query.filter_by(poll_id=poll.id, instrument_id=pi.instrument_id).update({
+            UserPrediction.real_price: rp,
+            UserPrediction.deviation: case(
+                (UserPrediction.predicted_price != 0,
+                 (rp - UserPrediction.predicted_price) / UserPrediction.predicted_price * 100),
+                else_=None
+            )
+        }, synchronize_session=False)
+    set_real_prices(poll.id, prices)
+    return prices
+
+
+def score_poll_winners(poll_id):
+    """
+    Стадия подсчёта: победители по всем инструментам опроса одним запросом.
+    Для каждого инструмента — прогноз с минимальным |deviation|; при равенстве
+    победитель выбирается случайно (random() вторым ключом сортировки).
+    Возвращает список (instrument_id, user_id, deviation).
+    """
+    ranked = db.session.query(
+        UserPrediction.instrument_id.label('instrument_id'),
+        UserPrediction.user_id.label('user_id'),
+        UserPrediction.deviation.label('deviation'),
+        func.row_number().over(
+            partition_by=UserPrediction.instrument_id,
+            order_by=(func.abs(UserPrediction.deviation), func.random())
+        ).label('rn')
+    ).join(
+        PollInstrument,
+        (PollInstrument.poll_id == UserPrediction.poll_id) &
+        (PollInstrument.instrument_id == UserPrediction.instrument_id)
+    ).filter(
+        UserPrediction.poll_id == poll_id,
+        UserPrediction.deviation.isnot(None)
+    ).subquery()
+
+    return db.session.query(
+        ranked.c.instrument_id, ranked.c.user_id, ranked.c.deviation
+    ).filter(ranked.c.rn == 1).all()
+
+
+def enqueue_poll_payouts(poll_id, winners, reward_per_winner):
+    """
+    Передаёт победителей в стадию выплат: строки poll_payout со статусом 'pending'.
+    Повторный вызов для того же опроса дублей не создаёт.
+    """
+    if not winners:
+        return
+    now = datetime.utcnow()
+    db.session.execute(
+        insert(PollPayout.__table__).values([
+            {
+                'poll_id': poll_id, 'instrument_id': instrument_id, 'user_id': user_id,
+                'amount': reward_per_winner, 'deviation': deviation,
+                'status': 'pending', 'attempts': 0, 'created_at': now
+            }
+            for instrument_id, user_id, deviation in winners
+        ]).on_conflict_do_nothing(index_elements=['poll_id', 'instrument_id'])
+    )
+
+
 def process_poll_results():
     """
     Finish polls whose end_date <= now and select one winner for each instrument (minimum deviation).
     Reward: UJO tokens (25% of best_setup_pool_size).
+    Winners are scored in SQL and queued to poll_payout; the token transfer and
+    Telegram message happen in process_pending_payouts, so completing a poll
+    does not wait for chain confirmations.
     After completion, start a new poll.
     """
     try:
@@ -223,95 +310,41 @@ def process_poll_results():
             current_app.logger.info("No completed polls.")
             return
 
+        # 1) Calculate the guessing pool (25% of best_setup_pool_size)
+        pool_config = Config.query.filter_by(key='best_setup_pool_size').first()
+        if pool_config:
+            total_best_setup_pool = float(pool_config.value)
+        else:
+            total_best_setup_pool = 0.0
+
+        guessing_pool = total_best_setup_pool * 0.0625  # (adjusted) a quarter of the pool goes for guessing rewards
+
         for poll in ended_polls:
             # Update real_price/deviation once more
-            for pred in poll.predictions:
-                rp = get_real_price(pred.instrument.name)
-                if rp is not None:
-                    pred.real_price = rp
-                    if pred.predicted_price != 0:
-                        pred.deviation = ((rp - pred.predicted_price) / pred.predicted_price) * 100
-                    else:
-                        pred.deviation = None
+            refresh_poll_real_prices(poll)
 
+            winners = score_poll_winners(poll.id)
             poll.status = 'completed'
-            db.session.commit()
-
-            # CHANGES: now determine the winner(s) for each instrument based on minimum deviation,
-            # but choose exactly one at random (if several have the same deviation).
-            # Instead of premium, award UJO tokens (25% of best_setup_pool_size).
 
-            # 1) Calculate the guessing pool (25% of best_setup_pool_size)
-            pool_config = Config.query.filter_by(key='best_setup_pool_size').first()
-            if pool_config:
-                total_best_setup_pool = float(pool_config.value)
-            else:
-                total_best_setup_pool = 0.0
-
-            guessing_pool = total_best_setup_pool * 0.0625  # (adjusted) a quarter of the pool goes for guessing rewards
-
-            instrument_winners = []
-            for pi in poll.poll_instruments:
-                instr = pi.instrument
-                preds = UserPrediction.query.filter_by(poll_id=poll.id, instrument_id=instr.id).all()
-                valid = [p for p in preds if p.deviation is not None]
-                if not valid:
-                    continue
-
-                # Find the minimum deviation
-                min_dev = min(abs(p.deviation) for p in valid)
-                # Select all with that deviation
-                tied_preds = [p for p in valid if abs(p.deviation) == min_dev]
-                # Choose one at random among them
-                winner_prediction = random.choice(tied_preds)
-                instrument_winners.append(winner_prediction.user)
-
-            if instrument_winners:
+            if winners:
                 # How many instruments have winners?
-                count_instruments = len(instrument_winners)
+                count_instruments = len(winners)
                 if guessing_pool <= 0:
                     current_app.logger.info(
                         f"Poll {poll.id} completed. Winners exist, but pool is 0.0, reward = 0."
                     )
                 else:
                     reward_per_winner = guessing_pool / count_instruments
+                    enqueue_poll_payouts(poll.id, winners, reward_per_winner)
 
-                    # Distribute the reward
-                    for w in instrument_winners:
-                        if not w.wallet_address:
-                            current_app.logger.warning(
-                                f"User {w.id} does not have a wallet_address, skipping reward."
-                            )
-                            continue
-                        success = voting_send_token_reward(w.wallet_address, reward_per_winner)
-                        if success:
-                            current_app.logger.info(
-                                f"User {w.id} received {reward_per_winner:.4f} UJO for accurate prediction (poll {poll.id})."
-                            )
-                            # Send a message via Telegram:
-                            if w.telegram_id:
-                                try:
-                                    from routes import bot  # Import bot
-                                    bot.send_message(
-                                        chat_id=w.telegram_id,
-                                        text=(
-                                            f"Congratulations! You have won {reward_per_winner:.4f} UJO "
-                                            f"for your accurate prediction in poll {poll.id}."
-                                        )
-                                    )
-                                except Exception as e:
-                                    current_app.logger.error(f"Error sending TG notification: {e}")
-                        else:
-                            current_app.logger.error(
-                                f"Failed to send reward of {reward_per_winner:.4f} UJO to user {w.id}."
-                            )
-            
                 current_app.logger.info(
                     f"Poll {poll.id} completed. Total winners (by instrument count): {count_instruments}."
                 )
             else:
                 current_app.logger.info(f"Poll {poll.id} completed. No winners.")
 
+            db.session.commit()
+
         # Start a new poll (immediately, for testing)
         start_new_poll()
 
@@ -319,3 +352,73 @@ def process_poll_results():
         db.session.rollback()
         current_app.logger.error(f"Error in process_poll_results: {e}")
         current_app.logger.error(traceback.format_exc())
+
+
+def _claim_pending_payout():
+    """
+    Забирает одну выплату: SKIP LOCKED + статус 'processing' с коммитом до
+    отправки токенов, чтобы параллельные воркеры не заплатили дважды.
+    """
+    payout = PollPayout.query.filter_by(status='pending').order_by(
+        PollPayout.id
+    ).with_for_update(skip_locked=True).first()
+    if payout is None:
+        return None
+    payout.status = 'processing'
+    payout.attempts = (payout.attempts or 0) + 1
+    db.session.commit()
+    return payout
+
+
+def process_pending_payouts(limit=20):
+    """
+    Стадия выплат: отправка UJO победителям и уведомление в Telegram.
+    Запускается планировщиком; выплата, зависшая в 'processing' (падение
+    процесса во время транзакции), требует ручной проверки и не повторяется.
+    """
+    processed = 0
+    try:
+        while processed < limit:
+            payout = _claim_pending_payout()
+            if payout is None:
+                break
+            processed += 1
+            w = payout.user
+
+            if not w.wallet_address:
+                current_app.logger.warning(
+                    f"User {w.id} does not have a wallet_address, skipping reward."
+                )
+                payout.status = 'skipped'
+                payout.error = 'no wallet_address'
+                payout.processed_at = datetime.utcnow()
+                db.session.commit()
+                continue
+
+            success = voting_send_token_reward(w.wallet_address, payout.amount)
+            payout.processed_at = datetime.utcnow()
+            if success:
+                payout.status = 'sent'
+                db.session.commit()
+                current_app.logger.info(
+                    f"User {w.id} received {payout.amount:.4f} UJO for accurate prediction (poll {payout.poll_id})."
+                )
+                # Telegram notification is queued (rate-limited, sent in background)
+                if w.telegram_id:
+                    send_notification(
+                        w.telegram_id,
+                        f"Congratulations! You have won {payout.amount:.4f} UJO "
+                        f"for your accurate prediction in poll {payout.poll_id}."
+                    )
+            else:
+                payout.status = 'failed'
+                payout.error = 'token transfer failed'
+                db.session.commit()
+                current_app.logger.error(
+                    f"Failed to send reward of {payout.amount:.4f} UJO to user {w.id}."
+                )
+    except Exception as e:
+        db.session.rollback()
+        current_app.logger.error(f"Error in process_pending_payouts: {e}")
+        current_app.logger.error(traceback.format_exc())
+    return processed
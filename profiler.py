@@ -0,0 +1,283 @@
+# profiler.py
+"""
+Сэмплирующий профайлер для работающих воркеров (включается из админки).
+
+Два режима:
+  * duration — N секунд снимаются стеки всех потоков воркера;
+  * requests — стеки снимаются только во время следующих K запросов к endpoint.
+
+Сессия профилирования описывается файлом в PROFILE_DIR, поэтому её
+подхватывают все воркеры gunicorn на хосте (проверка — не чаще раза в
+секунду из before_request). Каждый воркер пишет свои стеки в отдельный
+файл, результат собирается из всех файлов сессии в формате collapsed
+stacks («frame;frame;frame count») — вход для flamegraph.pl / speedscope.
+Без активной сессии накладные расходы — одно сравнение на запрос.
+"""
+
+import json
+import logging
+import os
+import sys
+import tempfile
+import threading
+import time
+import uuid
+
+from flask import request
+
+logger = logging.getLogger(__name__)
+
+PROFILE_DIR = os.environ.get('PROFILE_DIR', os.path.join(tempfile.gettempdir(), 'trend-share-profiles'))
+DEFAULT_INTERVAL_MS = 5
+MIN_INTERVAL_MS = 1
+MAX_DURATION_SECONDS = 300
+# Режим requests ждёт запросов не дольше этого
+REQUESTS_MODE_TIMEOUT = 600
+SESSION_POLL_SECONDS = 1.0
+SESSION_FILE = 'session.json'
+# Результаты старше суток удаляются при старте новой сессии
+OUTPUT_MAX_AGE = 24 * 3600
+
+
+def _frame_label(frame):
+    code = frame.f_code
+    return f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})".replace(';', ',')
+
+
+def collapse_stack(frame, root=None):
+    labels = []
+    while frame is not None:
+        labels.append(_frame_label(frame))
+        frame = frame.f_back
+    if root:
+        labels.append(root)
+    return ';'.join(reversed(labels))
+
+
+class StackSampler:
+    """
+    Фоновый поток, снимающий sys._current_frames() каждые interval_ms.
+    thread_filter=None — все потоки, иначе только потоки из этого set
+    (его меняют хуки запросов в режиме requests).
+    """
+
+    def __init__(self, interval_ms, deadline, thread_filter=None, output_path=None):
+        self.interval = max(interval_ms, MIN_INTERVAL_MS) / 1000
+        self.deadline = deadline
+        self.thread_filter = thread_filter
+        self.output_path = output_path
+        self.counts = {}
+        self.samples = 0
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name='stack-sampler', daemon=True)
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread.is_alive() and self._thread is not threading.current_thread():
+            self._thread.join(timeout=1)
+
+    def _run(self):
+        own_id = threading.get_ident()
+        while not self._stop.is_set() and time.time() < self.deadline:
+            names = {thread.ident: thread.name for thread in threading.enumerate()}
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == own_id:
+                    continue
+                if self.thread_filter is not None and thread_id not in self.thread_filter:
+                    continue
+                stack = collapse_stack(frame, root=names.get(thread_id, str(thread_id)))
+                self.counts[stack] = self.counts.get(stack, 0) + 1
+            self.samples += 1
+            self._stop.wait(self.interval)
+        # По истечении срока результат пишется сразу — воркер может больше
+        # не получить ни одного запроса
+        if self.output_path:
+            self.write(self.output_path)
+
+    def collapsed(self):
+        return ''.join(f"{stack} {count}\n" for stack, count in sorted(list(self.counts.items())))
+
+    def write(self, path):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f'{path}.{threading.get_ident()}.tmp'
+        with open(tmp_path, 'w') as f:
+            f.write(self.collapsed())
+        os.replace(tmp_path, path)
+
+
+def _session_path():
+    return os.path.join(PROFILE_DIR, SESSION_FILE)
+
+
+def _output_path(session_id, pid):
+    return os.path.join(PROFILE_DIR, f'{session_id}.{pid}.collapsed')
+
+
+def _remove_old_outputs(max_age=OUTPUT_MAX_AGE):
+    now = time.time()
+    for name in os.listdir(PROFILE_DIR):
+        path = os.path.join(PROFILE_DIR, name)
+        if name.endswith('.collapsed') and now - os.path.getmtime(path) > max_age:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+
+class ProfilerControl:
+    """
+    Состояние профилирования в процессе: активная сессия, сэмплер и
+    счётчик профилированных запросов (режим requests).
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._next_check = 0.0
+        self._session = None
+        self._sampler = None
+        self._threads = set()
+        self._profiled = 0
+
+    # --- Управление (админка) ---
+
+    def start_session(self, seconds=None, endpoint=None, requests=None, interval_ms=DEFAULT_INTERVAL_MS):
+        if endpoint:
+            mode, timeout = 'requests', REQUESTS_MODE_TIMEOUT
+        else:
+            mode, timeout = 'duration', min(float(seconds or 10), MAX_DURATION_SECONDS)
+        session = {
+            'id': uuid.uuid4().hex[:12],
+            'mode': mode,
+            'endpoint': endpoint,
+            'requests': int(requests or 1),
+            'interval_ms': max(int(interval_ms), MIN_INTERVAL_MS),
+            'started_at': time.time(),
+            'expires_at': time.time() + timeout,
+        }
+        os.makedirs(PROFILE_DIR, exist_ok=True)
+        _remove_old_outputs()
+        tmp_path = f'{_session_path()}.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(session, f)
+        os.replace(tmp_path, _session_path())
+        self._next_check = 0.0
+        self._poll()
+        logger.info(f"Profiling session {session['id']} started: {session}")
+        return session
+
+    def stop_session(self):
+        try:
+            os.remove(_session_path())
+        except FileNotFoundError:
+            pass
+        with self._lock:
+            self._finish_locked()
+
+    def result(self, session_id):
+        """
+        Склеивает стеки всех воркеров сессии. Возвращает (text, workers).
+        """
+        with self._lock:
+            if self._session and self._session['id'] == session_id:
+                self._write_output_locked()
+        counts, workers = {}, 0
+        prefix = f'{session_id}.'
+        if os.path.isdir(PROFILE_DIR):
+            for name in os.listdir(PROFILE_DIR):
+                if not (name.startswith(prefix) and name.endswith('.collapsed')):
+                    continue
+                workers += 1
+                with open(os.path.join(PROFILE_DIR, name)) as f:
+                    for line in f:
+                        stack, _, count = line.rstrip('\n').rpartition(' ')
+                        if stack:
+                            counts[stack] = counts.get(stack, 0) + int(count)
+        text = ''.join(f"{stack} {count}\n" for stack, count in sorted(counts.items()))
+        return text, workers
+
+    # --- Хуки запроса ---
+
+    def before_request(self):
+        if time.monotonic() >= self._next_check:
+            self._poll()
+        session = self._session
+        if session is None or session['mode'] != 'requests' or request.endpoint != session['endpoint']:
+            return
+        with self._lock:
+            if self._profiled >= session['requests']:
+                return
+            self._profiled += 1
+            self._threads.add(threading.get_ident())
+            request.environ['profiler.session'] = session['id']
+
+    def teardown_request(self, exception=None):
+        if 'profiler.session' not in request.environ:
+            return
+        with self._lock:
+            self._threads.discard(threading.get_ident())
+            session = self._session
+            if session and not self._threads and self._profiled >= session['requests']:
+                self._finish_locked()
+
+    # --- Внутреннее ---
+
+    def _poll(self):
+        self._next_check = time.monotonic() + SESSION_POLL_SECONDS
+        try:
+            with open(_session_path()) as f:
+                session = json.load(f)
+        except (FileNotFoundError, ValueError):
+            session = None
+        with self._lock:
+            current = self._session
+            if session and session['expires_at'] <= time.time():
+                session = None
+            if current and (session is None or session['id'] != current['id']):
+                self._finish_locked()
+            if session and self._session is None and not self._already_done(session):
+                self._begin_locked(session)
+            elif self._session and self._sampler and self._sampler.deadline <= time.time():
+                self._finish_locked()
+
+    def _already_done(self, session):
+        return os.path.exists(_output_path(session['id'], os.getpid()))
+
+    def _begin_locked(self, session):
+        self._session = session
+        self._profiled = 0
+        self._threads = set()
+        thread_filter = self._threads if session['mode'] == 'requests' else None
+        self._sampler = StackSampler(
+            session['interval_ms'], session['expires_at'], thread_filter,
+            output_path=_output_path(session['id'], os.getpid())
+        )
+        self._sampler.start()
+
+    def _write_output_locked(self):
+        if self._sampler is None or self._session is None:
+            return
+        self._sampler.write(_output_path(self._session['id'], os.getpid()))
+
+    def _finish_locked(self):
+        if self._sampler is None:
+            self._session = None
+            return
+        self._sampler.stop()
+        self._write_output_locked()
+        logger.info(
+            f"Profiling session {self._session['id']} finished in pid {os.getpid()}: "
+            f"{self._sampler.samples} samples, {self._profiled} requests."
+        )
+        self._sampler = None
+        self._session = None
+
+
+profiler = ProfilerControl()
+
+
+def init_profiler(app):
+    app.before_request(profiler.before_request)
+    app.teardown_request(profiler.teardown_request)
@@ -0,0 +1,265 @@
+# read_replica.py
+"""
+Чтение с реплики для view, помеченных @replica_router.read_only.
+
+На время такого view db.session потока привязывается к движку реплики
+(REPLICA_DATABASE_URL), остальной код и все записи идут в primary.
+
+Read-your-writes: если запрос пользователя закоммитил изменения в primary,
+в его Flask-сессию пишется метка, и следующие REPLICA_STICKY_SECONDS секунд
+его read-only view читают из primary (реплика может отставать). Метка живёт
+в cookie, поэтому работает для всех воркеров и инстансов.
+
+Если реплика недоступна, view выполняется заново на primary, и реплика не
+используется REPLICA_RETRY_SECONDS секунд. Куда ушло чтение — метрика
+db_read_routing_total{endpoint,target,reason} в /metrics.
+
+Для отдельных запросов вне таких view — read_session():
+
+    with replica_router.read_session() as s:
+        rows = s.query(Poll).filter_by(status='completed').all()
+
+Проверка со вторым локальным Postgres вместо реплики:
+
+    python read_replica.py check --primary postgresql://...:5432/db --replica postgresql://...:5433/db
+"""
+
+import argparse
+import logging
+import os
+import time
+from contextlib import contextmanager
+from functools import wraps
+
+from flask import current_app, g, has_request_context, request, session
+from flask_sqlalchemy import SignallingSession
+from sqlalchemy import event, exc
+
+from db_engines import bound_session_options, get_replica_engine, session_bound_to
+from instrumentation import install_sql_hooks
+from models import db
+from request_metrics import request_metrics
+
+logger = logging.getLogger(__name__)
+
+# Сколько секунд после своей записи пользователь читает из primary
+REPLICA_STICKY_SECONDS = float(os.environ.get('REPLICA_STICKY_SECONDS', '10'))
+# Пауза перед повторной попыткой использовать реплику после ошибки соединения
+REPLICA_RETRY_SECONDS = float(os.environ.get('REPLICA_RETRY_SECONDS', '30'))
+STICKY_SESSION_KEY = '_db_primary_until'
+
+
+def _after_flush(db_session, flush_context):
+    db_session.info['replica_wrote'] = True
+
+
+def _after_commit(db_session):
+    if db_session.info.pop('replica_wrote', False) and has_request_context():
+        g._replica_wrote = True
+
+
+def _after_rollback(db_session):
+    db_session.info.pop('replica_wrote', None)
+
+
+class ReplicaRouter:
+    """
+    engine_factory — функция без аргументов, возвращающая движок реплики
+    или None (по умолчанию — get_replica_engine(current_app)).
+    """
+
+    def __init__(self, db, engine_factory=None, sticky_seconds=REPLICA_STICKY_SECONDS):
+        self.db = db
+        self.engine_factory = engine_factory or (lambda: get_replica_engine(current_app))
+        self.sticky_seconds = sticky_seconds
+        self._down_until = 0.0
+
+    def init_app(self, app):
+        if not event.contains(SignallingSession, 'after_commit', _after_commit):
+            event.listen(SignallingSession, 'after_flush', _after_flush)
+            event.listen(SignallingSession, 'after_commit', _after_commit)
+            event.listen(SignallingSession, 'after_rollback', _after_rollback)
+        app.after_request(self._remember_write)
+
+    # --- Выбор базы ---
+
+    def _remember_write(self, response):
+        if g.pop('_replica_wrote', False) and 'user_id' in session:
+            session[STICKY_SESSION_KEY] = time.time() + self.sticky_seconds
+        return response
+
+    def choose_engine(self):
+        """
+        (engine, reason): движок реплики или None, если читать нужно из primary.
+        """
+        if has_request_context() and session.get(STICKY_SESSION_KEY, 0) > time.time():
+            return None, 'sticky'
+        if time.monotonic() < self._down_until:
+            return None, 'replica_down'
+        engine = self.engine_factory()
+        if engine is None:
+            return None, 'no_replica'
+        install_sql_hooks(engine)
+        return engine, 'replica'
+
+    def _replica_failed(self, endpoint, error):
+        self._down_until = time.monotonic() + REPLICA_RETRY_SECONDS
+        logger.warning(
+            f"Replica read failed in '{endpoint}', using primary for {REPLICA_RETRY_SECONDS:.0f}s: {error}"
+        )
+
+    def _count(self, endpoint, target, reason):
+        request_metrics.inc('db_read_routing_total', (('endpoint', endpoint), ('target', target), ('reason', reason)))
+
+    # --- API ---
+
+    def read_only(self, view):
+        """
+        Декоратор view, который только читает из базы.
+        """
+        @wraps(view)
+        def decorated_function(*args, **kwargs):
+            endpoint = request.endpoint or view.__name__
+            engine, reason = self.choose_engine()
+            if engine is None:
+                self._count(endpoint, 'primary', reason)
+                return view(*args, **kwargs)
+            try:
+                with session_bound_to(self.db, engine):
+                    response = view(*args, **kwargs)
+            except exc.OperationalError as e:
+                # Реплика недоступна или отменила запрос (конфликт с recovery) —
+                # view только читает, его можно безопасно повторить на primary
+                self._replica_failed(endpoint, e)
+                self._count(endpoint, 'primary', 'replica_error')
+                return view(*args, **kwargs)
+            self._count(endpoint, 'replica', reason)
+            return response
+        return decorated_function
+
+    @contextmanager
+    def read_session(self):
+        """
+        Отдельная сессия для чтения (реплика или primary по тем же правилам),
+        db.session текущего потока не затрагивается.
+        """
+        engine, _ = self.choose_engine()
+        read_session = self.db.create_session(bound_session_options(self.db, engine or self.db.engine))()
+        try:
+            yield read_session
+        finally:
+            read_session.close()
+
+
+replica_router = ReplicaRouter(db)
+
+
+# --- Проверка со вторым Postgres ---
+
+SERVER_IDENTITY_SQL = "SELECT coalesce(host(inet_server_addr()), 'local') || ':' || current_setting('port')"
+
+
+def check(primary_url, replica_url, sticky_seconds=1.0):
+    from flask import Flask, jsonify
+    from flask_sqlalchemy import SQLAlchemy
+    from sqlalchemy import create_engine, text
+
+    app = Flask(__name__)
+    app.secret_key = 'replica-check'
+    app.config['SQLALCHEMY_DATABASE_URI'] = primary_url
+    app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+    check_db = SQLAlchemy(app)
+    replica_engine = create_engine(replica_url)
+    router = ReplicaRouter(check_db, engine_factory=lambda: replica_engine, sticky_seconds=sticky_seconds)
+    router.init_app(app)
+
+    class ReplicaCheckNote(check_db.Model):
+        id = check_db.Column(check_db.Integer, primary_key=True)
+        created_at = check_db.Column(check_db.Float, nullable=False)
+
+    # Строка со своим адресом в каждой базе: ORM-запрос показывает, куда он ушёл
+    # (text() маршрутизируется по bind, а модели — по binds, их проверяем отдельно)
+    class ReplicaCheckServer(check_db.Model):
+        id = check_db.Column(check_db.Integer, primary_key=True)
+        server = check_db.Column(check_db.String(100), nullable=False)
+
+    @app.route('/where')
+    @router.read_only
+    def where():
+        return jsonify({
+            'server': ReplicaCheckServer.query.one().server,
+            'sql_server': check_db.session.execute(text(SERVER_IDENTITY_SQL)).scalar(),
+        })
+
+    @app.route('/write', methods=['POST'])
+    def write():
+        check_db.session.add(ReplicaCheckNote(created_at=time.time()))
+        check_db.session.commit()
+        return jsonify({'ok': True})
+
+    with app.app_context():
+        check_db.create_all()
+        primary_id = check_db.session.execute(text(SERVER_IDENTITY_SQL)).scalar()
+        check_db.session.remove()
+    with replica_engine.connect() as conn:
+        replica_id = conn.execute(text(SERVER_IDENTITY_SQL)).scalar()
+    print(f"primary: {primary_id}, replica: {replica_id}")
+    if primary_id == replica_id:
+        print("Both URLs point at the same server address, routing cannot be told apart.")
+        return False
+    with app.app_context():
+        for engine, server in ((check_db.engine, primary_id), (replica_engine, replica_id)):
+            ReplicaCheckServer.__table__.drop(engine, checkfirst=True)
+            ReplicaCheckServer.__table__.create(engine)
+            with engine.begin() as conn:
+                conn.execute(ReplicaCheckServer.__table__.insert(), {'server': server})
+
+    client = app.test_client()
+    with client.session_transaction() as user_session:
+        user_session['user_id'] = 1
+
+    def served_by():
+        return client.get('/where').get_json()['server']
+
+    first = client.get('/where').get_json()
+    results = {
+        'read before write goes to replica (ORM query)': first['server'] == replica_id,
+        'read before write goes to replica (raw SQL)': first['sql_server'] == replica_id,
+    }
+    client.post('/write')
+    results['read right after own write goes to primary'] = served_by() == primary_id
+    time.sleep(sticky_seconds + 0.2)
+    results[f'read {sticky_seconds:g}s after write goes to replica'] = served_by() == replica_id
+
+    replica_engine.dispose()
+    replica_engine = create_engine('postgresql://127.0.0.1:1/unreachable', connect_args={'connect_timeout': 2})
+    results['unreachable replica falls back to primary'] = served_by() == primary_id
+
+    for name, ok in results.items():
+        print(f"  {'ok  ' if ok else 'FAIL'} {name}")
+    with app.app_context():
+        ReplicaCheckNote.__table__.drop(check_db.engine, checkfirst=True)
+        ReplicaCheckServer.__table__.drop(check_db.engine, checkfirst=True)
+    with create_engine(replica_url).connect() as conn:
+        ReplicaCheckServer.__table__.drop(conn, checkfirst=True)
+    return all(results.values())
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Read replica routing")
+    sub = parser.add_subparsers(dest='command', required=True)
+
+    ck = sub.add_parser('check', help="route reads between two Postgres instances and check stickiness/fallback")
+    ck.add_argument('--primary', default=os.environ.get('DATABASE_URL'), required=not os.environ.get('DATABASE_URL'))
+    ck.add_argument('--replica', default=os.environ.get('REPLICA_DATABASE_URL'),
+                    required=not os.environ.get('REPLICA_DATABASE_URL'))
+    ck.add_argument('--sticky-seconds', type=float, default=1.0)
+
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+    if args.command == 'check':
+        raise SystemExit(0 if check(args.primary, args.replica, args.sticky_seconds) else 1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,322 @@
+# request_metrics.py
+
+import atexit
+import fcntl
+import json
+import logging
+import os
+import threading
+import time
+import uuid
+
+from flask import g, request
+
+from instrumentation import Collector, EXTERNAL_KINDS, activate, deactivate, install_http_hooks, install_sql_hooks
+from models import db
+
+logger = logging.getLogger(__name__)
+
+# Границы корзин гистограмм длительности (секунды)
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+# Метрики с собственными корзинами (ожидание соединения из пула обычно < 1 мс)
+HISTOGRAM_BUCKETS = {
+    'db_pool_wait_seconds': (0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0, 30.0),
+}
+# Предупреждение N+1: столько одинаковых по форме запросов за один HTTP-запрос
+N_PLUS_ONE_THRESHOLD = int(os.environ.get('N_PLUS_ONE_THRESHOLD', '10'))
+# С несколькими воркерами gunicorn каждый пишет снимок метрик в этот каталог,
+# /metrics суммирует снимки всех воркеров (иначе метрики — только своего процесса).
+# Снимок завершившегося воркера переносится в retired.json, поэтому суммы
+# счётчиков не уменьшаются при перезапуске воркеров.
+METRICS_MULTIPROC_DIR = os.environ.get('METRICS_MULTIPROC_DIR', '').strip()
+SNAPSHOT_INTERVAL = 5.0
+SNAPSHOT_PREFIX = 'requests_'
+RETIRED_FILE = 'retired.json'
+RETIRED_LOCK_FILE = 'retired.lock'
+
+class RequestMetrics:
+    """
+    Метрики HTTP-запросов процесса: счётчики и гистограммы по endpoint.
+    Ключ серии — (имя метрики, кортеж пар меток); состояние сериализуется
+    в JSON для суммирования между воркерами.
+    """
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self._lock = threading.Lock()
+        self._counters = {}
+        self._histograms = {}  # key -> [count per bucket..., +Inf, sum]
+        self._last_snapshot = 0.0
+        self._instance = None  # (pid, случайный id) для имени снимка
+
+    def inc(self, name, labels, value=1.0):
+        key = (name, labels)
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0.0) + value
+
+    def buckets_for(self, name):
+        return HISTOGRAM_BUCKETS.get(name, self.buckets)
+
+    def observe(self, name, labels, value):
+        key = (name, labels)
+        buckets = self.buckets_for(name)
+        with self._lock:
+            series = self._histograms.get(key)
+            if series is None:
+                series = self._histograms[key] = [0] * (len(buckets) + 1) + [0.0]
+            for index, bound in enumerate(buckets):
+                if value <= bound:
+                    series[index] += 1
+                    break
+            else:
+                series[len(buckets)] += 1
+            series[-1] += value
+
+    def snapshot(self):
+        with self._lock:
+            return {
+                'counters': [[name, list(labels), value] for (name, labels), value in self._counters.items()],
+                'histograms': [[name, list(labels), list(series)] for (name, labels), series in self._histograms.items()],
+            }
+
+    # --- Несколько воркеров ---
+
+    def _snapshot_name(self):
+        # pid + случайный id процесса: воркер с переиспользованным pid
+        # не перезапишет снимок предыдущего владельца
+        pid = os.getpid()
+        if self._instance is None or self._instance[0] != pid:
+            self._instance = (pid, uuid.uuid4().hex[:12])
+        return f'{SNAPSHOT_PREFIX}{pid}_{self._instance[1]}.json'
+
+    def maybe_write_snapshot(self, force=False):
+        if not METRICS_MULTIPROC_DIR:
+            return
+        now = time.monotonic()
+        if not force and now - self._last_snapshot < SNAPSHOT_INTERVAL:
+            return
+        self._last_snapshot = now
+        try:
+            os.makedirs(METRICS_MULTIPROC_DIR, exist_ok=True)
+            path = os.path.join(METRICS_MULTIPROC_DIR, self._snapshot_name())
+            _write_json(path, self.snapshot())
+        except Exception as e:
+            logger.warning(f"Could not write metrics snapshot: {e}")
+
+    def collected_snapshots(self):
+        """
+        Снимок своего процесса + снимки живых воркеров и накопленное
+        завершившимися (retired.json) из METRICS_MULTIPROC_DIR.
+        """
+        snapshots = [self.snapshot()]
+        if not METRICS_MULTIPROC_DIR or not os.path.isdir(METRICS_MULTIPROC_DIR):
+            return snapshots
+        own = self._snapshot_name()
+        for name in os.listdir(METRICS_MULTIPROC_DIR):
+            if not name.startswith(SNAPSHOT_PREFIX) or not name.endswith('.json') or name == own:
+                continue
+            if not _snapshot_owner_alive(name):
+                self._retire(name)
+                continue
+            try:
+                with open(os.path.join(METRICS_MULTIPROC_DIR, name)) as f:
+                    snapshots.append(json.load(f))
+            except FileNotFoundError:
+                # Снимок только что перенёс в retired.json другой воркер
+                continue
+            except Exception as e:
+                logger.warning(f"Could not read metrics snapshot {name}: {e}")
+        retired = _read_retired()
+        if retired is not None:
+            snapshots.append(retired)
+        return snapshots
+
+    def _retire(self, name):
+        """
+        Прибавляет последний снимок завершившегося воркера к retired.json
+        и удаляет снимок. folded — уже перенесённые снимки: если процесс упал
+        между записью retired.json и удалением, снимок не учтётся дважды.
+        """
+        path = os.path.join(METRICS_MULTIPROC_DIR, name)
+        try:
+            with open(os.path.join(METRICS_MULTIPROC_DIR, RETIRED_LOCK_FILE), 'a') as lock:
+                fcntl.flock(lock, fcntl.LOCK_EX)
+                if not os.path.exists(path):
+                    return
+                retired = _read_retired() or {'counters': [], 'histograms': [], 'folded': []}
+                if name not in retired['folded']:
+                    with open(path) as f:
+                        snapshot = json.load(f)
+                    counters, histograms = merge_snapshots([retired, snapshot])
+                    retired = {
+                        'counters': [[key[0], list(key[1]), value] for key, value in counters.items()],
+                        'histograms': [[key[0], list(key[1]), series] for key, series in histograms.items()],
+                        'folded': [
+                            folded for folded in retired['folded']
+                            if os.path.exists(os.path.join(METRICS_MULTIPROC_DIR, folded))
+                        ] + [name],
+                    }
+                    _write_json(os.path.join(METRICS_MULTIPROC_DIR, RETIRED_FILE), retired)
+                os.remove(path)
+            logger.info(f"Metrics snapshot {name} of a finished worker folded into {RETIRED_FILE}.")
+        except Exception as e:
+            logger.warning(f"Could not retire metrics snapshot {name}: {e}")
+
+    def prometheus_text(self):
+        counters, histograms = merge_snapshots(self.collected_snapshots())
+
+        lines = []
+        for name, kind, help_text in METRIC_HELP:
+            series_keys = sorted(
+                key for key in (histograms if kind == 'histogram' else counters) if key[0] == name
+            )
+            if not series_keys:
+                continue
+            lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} {kind}")
+            for key in series_keys:
+                labels = key[1]
+                if kind == 'histogram':
+                    series = histograms[key]
+                    cumulative = 0
+                    for bound, count in zip(self.buckets_for(name) + ('+Inf',), series[:-1]):
+                        cumulative += count
+                        lines.append(f"{name}_bucket{_labels(labels + (('le', str(bound)),))} {cumulative}")
+                    lines.append(f"{name}_sum{_labels(labels)} {series[-1]}")
+                    lines.append(f"{name}_count{_labels(labels)} {cumulative}")
+                else:
+                    lines.append(f"{name}{_labels(labels)} {counters[key]}")
+        return '\n'.join(lines) + '\n'
+
+
+METRIC_HELP = (
+    ('http_request_duration_seconds', 'histogram', "Request latency by endpoint."),
+    ('http_requests_total', 'counter', "Requests by endpoint, method and status."),
+    ('http_request_sql_queries_total', 'counter', "SQL statements executed while serving requests."),
+    ('http_request_sql_seconds_total', 'counter', "Time spent in SQL while serving requests."),
+    ('http_request_external_calls_total', 'counter', "Outbound calls (rpc, openai, http) made while serving requests."),
+    ('http_request_external_seconds_total', 'counter', "Time spent in outbound calls while serving requests."),
+    ('http_request_n_plus_one_total', 'counter', "Requests that repeated one query shape more than the N+1 threshold."),
+    ('db_pool_wait_seconds', 'histogram', "Time to check a connection out of the SQLAlchemy pool, by pool."),
+    ('db_pool_timeouts_total', 'counter', "Pool checkouts that gave up after pool_timeout, by pool."),
+    ('db_read_routing_total', 'counter', "Read-only views by the database that served them and why."),
+)
+
+
+def merge_snapshots(snapshots):
+    """
+    Суммирует снимки: ({(имя, метки): значение}, {(имя, метки): корзины}).
+    """
+    counters, histograms = {}, {}
+    for snapshot in snapshots:
+        for name, labels, value in snapshot['counters']:
+            key = (name, tuple(tuple(pair) for pair in labels))
+            counters[key] = counters.get(key, 0.0) + value
+        for name, labels, series in snapshot['histograms']:
+            key = (name, tuple(tuple(pair) for pair in labels))
+            merged = histograms.get(key)
+            histograms[key] = series if merged is None else [a + b for a, b in zip(merged, series)]
+    return counters, histograms
+
+
+def _write_json(path, data):
+    tmp_path = f'{path}.{os.getpid()}.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump(data, f)
+    os.replace(tmp_path, path)
+
+
+def _read_retired():
+    try:
+        with open(os.path.join(METRICS_MULTIPROC_DIR, RETIRED_FILE)) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return None
+    except Exception as e:
+        logger.warning(f"Could not read {RETIRED_FILE}: {e}")
+        return None
+
+
+def _snapshot_owner_alive(name):
+    # requests_<pid>_<id>.json (и старый формат requests_<pid>.json)
+    try:
+        pid = int(name[len(SNAPSHOT_PREFIX):-len('.json')].split('_')[0])
+    except ValueError:
+        return True
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def _labels(pairs):
+    if not pairs:
+        return ''
+    escaped = (
+        f'{key}="' + str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') + '"'
+        for key, value in pairs
+    )
+    return '{' + ','.join(escaped) + '}'
+
+
+request_metrics = RequestMetrics()
+
+
+def _start_request():
+    install_sql_hooks(db.engine)
+    collector = Collector(track_statements=True)
+    g._metrics_collector = collector
+    g._metrics_previous = activate(collector)
+    g._metrics_started = time.perf_counter()
+
+
+def _remember_status(response):
+    g._metrics_status = response.status_code
+    return response
+
+
+def _finish_request(exception=None):
+    collector = g.pop('_metrics_collector', None)
+    if collector is None:
+        return
+    deactivate(g.pop('_metrics_previous', None))
+    elapsed = time.perf_counter() - g.pop('_metrics_started')
+    endpoint = request.endpoint or 'unmatched'
+    status = g.pop('_metrics_status', 500 if exception else 200)
+
+    by_endpoint = (('endpoint', endpoint),)
+    request_metrics.observe('http_request_duration_seconds', by_endpoint, elapsed)
+    request_metrics.inc('http_requests_total', by_endpoint + (('method', request.method), ('status', str(status))))
+    request_metrics.inc('http_request_sql_queries_total', by_endpoint, collector.sql_queries)
+    request_metrics.inc('http_request_sql_seconds_total', by_endpoint, collector.sql_time_ms / 1000)
+    for kind in EXTERNAL_KINDS:
+        calls, time_ms = collector.external_by_kind.get(kind, (0, 0.0))
+        if calls:
+            by_kind = by_endpoint + (('kind', kind),)
+            request_metrics.inc('http_request_external_calls_total', by_kind, calls)
+            request_metrics.inc('http_request_external_seconds_total', by_kind, time_ms / 1000)
+
+    statement, repeats = collector.most_repeated_statement()
+    if repeats > N_PLUS_ONE_THRESHOLD:
+        request_metrics.inc('http_request_n_plus_one_total', by_endpoint)
+        logger.warning(
+            f"Possible N+1 in '{endpoint}': {repeats} similar queries "
+            f"({collector.sql_queries} total, {collector.sql_time_ms:.0f} ms): {statement[:300]}"
+        )
+    request_metrics.maybe_write_snapshot()
+
+
+def init_request_metrics(app):
+    """
+    Регистрирует хуки запроса. teardown срабатывает и при исключениях, а для
+    stream_with_context — после отдачи последнего чанка.
+    """
+    install_http_hooks()
+    # Последние счётчики воркера попадают в снимок (а затем в retired.json) при выходе
+    atexit.register(request_metrics.maybe_write_snapshot, force=True)
+    app.before_request(_start_request)
+    app.after_request(_remember_status)
+    app.teardown_request(_finish_request)
@@ -0,0 +1,274 @@
+# response_cache.py
+
+import hashlib
+import json
+import logging
+import re
+import threading
+import time
+from collections import OrderedDict, namedtuple
+
+from flask import current_app
+
+from lazy_imports import lazy_import
+
+# Нужны только при ASSISTANT_CACHE_EMBEDDINGS — загружаются при первом эмбеддинге
+np = lazy_import('numpy')
+openai = lazy_import('openai')
+
+logger = logging.getLogger(__name__)
+
+# Значения по умолчанию (переопределяются через app.config['ASSISTANT_CACHE_*'])
+DEFAULT_CACHE_SIZE = 1000
+DEFAULT_CACHE_TTL = 6 * 3600
+DEFAULT_SIMILARITY_THRESHOLD = 0.95
+# Сколько последних реплик (без system) входит в ключ вместе с вопросом
+DEFAULT_CONTEXT_TURNS = 4
+EMBEDDING_MODEL = "text-embedding-ada-002"
+
+# Метка в начале ответа: модель сама помечает ответ как общий (не опирающийся
+# на сделки пользователя). Только такие ответы попадают в общий кэш
+GENERAL_ANSWER_TAG = '[GENERAL]'
+
+# Вопросы, которые могут привести к create_trades (или подтверждают его), в кэш не идут
+_TRADE_INTENT_RE = re.compile(
+    r"\b(add|create|confirm|yes|ok|okay|record|log)\b|"
+    r"(добав|созда|запиш|подтвер|\bда\b|\bок\b|сделк[уи] в журнал)",
+    re.IGNORECASE
+)
+# Вопросы о журнале самого пользователя (его сделки, статистика, сетапы) даже
+# не ищутся в кэше. Это только быстрый обход: модель в любом случае получает
+# контекст сделок, а в кэш идут лишь ответы с GENERAL_ANSWER_TAG
+_JOURNAL_RE = re.compile(
+    r"\b(my|mine|our|am i|i am|i'm)\b|\b(journal|portfolio|win ?rate|statistics|stats)\b|"
+    r"\bмо(й|я|и|е|ё|ю|их|ей|ем|им|ими)\b|\bнаш\w*|журнал|портфел|винрейт|статистик",
+    re.IGNORECASE
+)
+_PUNCT_RE = re.compile(r"[^\w\s]+", re.UNICODE)
+_SPACE_RE = re.compile(r"\s+")
+
+
+def normalize_question(text: str) -> str:
+    """
+    Нормализует вопрос для ключа кэша: нижний регистр, 'ё' -> 'е',
+    без пунктуации и лишних пробелов.
+    """
+    if not text:
+        return ''
+    text = text.lower().replace('ё', 'е')
+    text = _PUNCT_RE.sub(' ', text)
+    return _SPACE_RE.sub(' ', text).strip()
+
+
+def recent_turns(messages, turns=DEFAULT_CONTEXT_TURNS):
+    """
+    Последние turns реплик диалога без system-сообщений.
+    """
+    dialogue = [m for m in messages if m.get('role') != 'system']
+    return dialogue[-turns:] if turns > 0 else []
+
+
+def strip_general_tag(answer):
+    """
+    (answer без метки, помечен ли ответ как общий).
+    """
+    text = (answer or '').lstrip()
+    if text.startswith(GENERAL_ANSWER_TAG):
+        return text[len(GENERAL_ANSWER_TAG):].lstrip(), True
+    return answer, False
+
+
+def context_fingerprint(template, turns) -> str:
+    """
+    Отпечаток того, от чего зависит общий ответ: шаблон system prompt (без
+    контекста сделок пользователя) и короткое окно последних реплик. Один и тот
+    же общий вопрос разных пользователей в начале диалога даёт один ключ.
+    """
+    payload = json.dumps(
+        [hashlib.sha256((template or '').encode('utf-8')).hexdigest()] +
+        [(m.get('role'), m.get('content')) for m in turns],
+        ensure_ascii=False, sort_keys=True
+    )
+    return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+
+def is_cacheable_question(question: str, context_messages) -> bool:
+    """
+    Вопросы с намерением создать/подтвердить сделки, вопросы о журнале
+    пользователя, а также ответы на незавершённое предложение сделок
+    (ждущее 'confirm'), кэш обходят.
+    """
+    if not question or _TRADE_INTENT_RE.search(question) or _JOURNAL_RE.search(question):
+        return False
+    for msg in reversed(context_messages):
+        if msg.get('role') == 'assistant':
+            return 'NOT YET CREATED' not in (msg.get('content') or '')
+    return True
+
+
+# Результат промаха: передаётся в put()
+CacheToken = namedtuple('CacheToken', 'key fingerprint normalized embedding')
+
+
+class ResponseCache:
+    """
+    In-process LRU/TTL cache of general assistant answers, shared by all users.
+    Only answers the model tagged with GENERAL_ANSWER_TAG are stored.
+
+    Lookups are exact on (normalized question, context fingerprint), where the
+    fingerprint covers the static prompt template and the last few turns only;
+    when embeddings are enabled, a miss falls back to cosine similarity against
+    the cached questions that share the same context fingerprint.
+    """
+
+    def __init__(self, max_size=DEFAULT_CACHE_SIZE, ttl=DEFAULT_CACHE_TTL,
+                 similarity_threshold=DEFAULT_SIMILARITY_THRESHOLD, use_embeddings=False,
+                 context_turns=DEFAULT_CONTEXT_TURNS):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.similarity_threshold = similarity_threshold
+        self.use_embeddings = use_embeddings
+        self.context_turns = context_turns
+        # key -> (fingerprint, normalized question, answer, stored_at, embedding | None)
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.semantic_hits = 0
+        self.misses = 0
+        self.bypassed = 0
+
+    @classmethod
+    def from_config(cls, config):
+        return cls(
+            max_size=config.get('ASSISTANT_CACHE_SIZE', DEFAULT_CACHE_SIZE),
+            ttl=config.get('ASSISTANT_CACHE_TTL', DEFAULT_CACHE_TTL),
+            similarity_threshold=config.get('ASSISTANT_CACHE_SIMILARITY', DEFAULT_SIMILARITY_THRESHOLD),
+            use_embeddings=config.get('ASSISTANT_CACHE_EMBEDDINGS', False),
+            context_turns=config.get('ASSISTANT_CACHE_CONTEXT_TURNS', DEFAULT_CONTEXT_TURNS)
+        )
+
+    @staticmethod
+    def _key(normalized, fingerprint):
+        return hashlib.sha256(f"{fingerprint}|{normalized}".encode('utf-8')).hexdigest()
+
+    def _embed(self, normalized):
+        try:
+            response = openai.Embedding.create(model=EMBEDDING_MODEL, input=normalized)
+            vector = np.asarray(response["data"][0]["embedding"], dtype=np.float32)
+            norm = np.linalg.norm(vector)
+            return vector / norm if norm else None
+        except Exception as e:
+            logger.warning(f"Embedding request failed, semantic lookup skipped: {e}")
+            return None
+
+    def _expired(self, stored_at, now):
+        return now - stored_at > self.ttl
+
+    def _semantic_lookup(self, fingerprint, embedding, now):
+        # Локальный векторный индекс: матрица эмбеддингов вопросов с тем же контекстом
+        with self._lock:
+            candidates = [
+                (key, entry) for key, entry in self._entries.items()
+                if entry[0] == fingerprint and entry[4] is not None and not self._expired(entry[3], now)
+            ]
+        if not candidates:
+            return None
+        matrix = np.vstack([entry[4] for _, entry in candidates])
+        scores = matrix @ embedding
+        best = int(np.argmax(scores))
+        if scores[best] < self.similarity_threshold:
+            return None
+        key, entry = candidates[best]
+        with self._lock:
+            if key in self._entries:
+                self._entries.move_to_end(key)
+        logger.debug(f"Semantic cache hit (similarity {scores[best]:.3f}) for '{entry[1]}'.")
+        return entry[2]
+
+    def get(self, question, context_messages, template=''):
+        """
+        Возвращает (answer | None, token). token (CacheToken) передаётся в put()
+        после обращения к OpenAI; None означает, что вопрос кэш обходит.
+        template — шаблон system prompt без данных пользователя.
+        """
+        if not is_cacheable_question(question, context_messages):
+            with self._lock:
+                self.bypassed += 1
+            return None, None
+
+        normalized = normalize_question(question)
+        turns = recent_turns(context_messages, self.context_turns)
+        fingerprint = context_fingerprint(template, turns)
+        key = self._key(normalized, fingerprint)
+        now = time.time()
+
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                if self._expired(entry[3], now):
+                    del self._entries[key]
+                else:
+                    self._entries.move_to_end(key)
+                    self.hits += 1
+                    return entry[2], None
+
+        embedding = None
+        if self.use_embeddings:
+            embedding = self._embed(normalized)
+            if embedding is not None:
+                answer = self._semantic_lookup(fingerprint, embedding, now)
+                if answer is not None:
+                    with self._lock:
+                        self.hits += 1
+                        self.semantic_hits += 1
+                    return answer, None
+
+        with self._lock:
+            self.misses += 1
+        return None, CacheToken(key, fingerprint, normalized, embedding)
+
+    def put(self, token, answer):
+        """
+        answer — ответ без метки; вызывается только для ответов с GENERAL_ANSWER_TAG.
+        """
+        if token is None or not answer:
+            return
+        key, fingerprint, normalized, embedding = token
+        with self._lock:
+            self._entries[key] = (fingerprint, normalized, answer, time.time(), embedding)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'entries': len(self._entries),
+                'hits': self.hits,
+                'semantic_hits': self.semantic_hits,
+                'misses': self.misses,
+                'bypassed': self.bypassed,
+                'hit_rate': round(self.hits / lookups, 4) if lookups else 0.0,
+                'embeddings': self.use_embeddings,
+            }
+
+
+_cache = None
+_cache_lock = threading.Lock()
+
+
+def get_response_cache() -> ResponseCache:
+    """
+    Возвращает кэш процесса, создавая его из app.config при первом обращении.
+    """
+    global _cache
+    if _cache is None:
+        with _cache_lock:
+            if _cache is None:
+                _cache = ResponseCache.from_config(current_app.config)
+    return _cache
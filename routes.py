@@ -7,21 +7,20 @@ import os
 import logging
 import traceback
 import hashlib
-import matplotlib.pyplot as plt  # Import moved to the top
-import io
+import hmac
 import base64
 from datetime import datetime, timedelta
 
 from flask import (
     render_template, redirect, url_for, flash, request,
-    session, jsonify
+    session, jsonify, Response, stream_with_context
 )
 from werkzeug.utils import secure_filename
 from werkzeug.datastructures import FileStorage
 from flask_wtf.csrf import CSRFProtect
 from wtforms.validators import DataRequired, Optional
 
-from app import app, csrf, db, s3_client, logger, get_app_host, upload_file_to_s3, delete_file_from_s3, generate_s3_url, ADMIN_TELEGRAM_IDS
+from app import app, csrf, db, s3_client, logger, get_app_host, upload_file_to_s3, delete_file_from_s3, generate_s3_url, ADMIN_TELEGRAM_IDS, job_runner
 from models import *
 from forms import TradeForm, SetupForm, SubmitPredictionForm  # Import updated forms
 from telegram import (
@@ -32,47 +31,38 @@ from staking_logic import get_token_price_in_usd
 from teleapp_auth import get_secret_key, parse_webapp_data, validate_webapp_data
 from functools import wraps
 from best_setup_voting import send_token_reward as voting_send_token_reward
+from instrument_resolver import get_instrument_resolver
+from assistant_context import bump_trade_stats_version, get_trade_context
+from chat_store import ChatHistory
+from assistant_stream import ChatStreamCollector, sse_event, SSE_HEADERS
+from response_cache import GENERAL_ANSWER_TAG, get_response_cache, strip_general_tag
+from telegram_notify import notification_queue
+from telegram_ingest import UpdateIngestor
+from job_runner import recent_runs
+from job_metrics import job_stats, prometheus_text as jobs_prometheus_text
+from request_metrics import request_metrics
+from db_engines import created_engines, pool_status_text
+from profiler import profiler
+from read_replica import replica_router
+from trade_journal import (
+    bulk_create_trades, parse_import_payload, trades_from_json,
+    iter_journal_csv, write_journal_parquet, iter_file_chunks,
+    MAX_CHAT_TRADES, MAX_IMPORT_TRADES, MAX_REPORTED_ERRORS
+)
 
-# **OpenAI Integration**
-import openai
-import yfinance as yf
-
-def generate_openai_response(messages):
-    """
-    Gets a response from OpenAI GPT-3.5-turbo based on message history.
-    """
-    try:
-        logger.debug(f"Sending messages to OpenAI: {messages}")
-        response = openai.ChatCompletion.create(
-            model="gpt-3.5-turbo",
-            messages=messages,
-            temperature=0.7,
-            max_tokens=900,  # Increased for more detailed responses
-            top_p=1,
-            frequency_penalty=0,
-            presence_penalty=0
-        )
-        logger.debug(f"Received response from OpenAI: {response}")
-        return response.choices[0].message['content'].strip()
-    except Exception as e:
-        logger.error(f"Error calling OpenAI API: {e}")
-        logger.error(traceback.format_exc())
-        return "An error occurred while processing your request."
-        
-# **Import additional libraries for image processing and simplified neural network**
-import cv2
-import numpy as np
-import pandas as pd
-import mplfinance as mpf
-import shutil
-from skimage.segmentation import clear_border
-
-# **Add PyTorch for neural network analysis**
-import torch
-import torch.nn as nn
-import torch.nn.functional as F
-from torchvision import transforms
-from PIL import Image
+# **OpenAI Integration** (модуль загружается при первом запросе к OpenAI)
+from lazy_imports import lazy_import, on_import
+openai = lazy_import('openai')
+
+# **PyTorch trend model**: torch/torchvision/PIL загружаются вместе с trend_inference
+# при первом анализе графика (или при старте, если TREND_PRELOAD=true)
+trend_inference = lazy_import('trend_inference')
+from chart_cache import get_cached_trend, store_trend
+from poll_aggregates import record_prediction, aggregate_histogram, aggregate_stats
+from chart_render import (
+    CHART_FORMATS, chart_version, rendered_charts,
+    render_comparison_chart, render_distribution_chart
+)
 
 # Import functions for voting and charts
 from poll_functions import start_new_poll, process_poll_results, get_real_price  # Import get_real_price
@@ -83,106 +73,77 @@ if not app.config['OPENAI_API_KEY']:
     logger.error("OPENAI_API_KEY is not set in environment variables.")
     raise ValueError("OPENAI_API_KEY is not set in environment variables.")
 
-openai.api_key = app.config['OPENAI_API_KEY']
+on_import('openai', lambda module: setattr(module, 'api_key', app.config['OPENAI_API_KEY']))
 
 ##################################################
 # Trend Model (trend_model.pth)
 ##################################################
 
-trend_model = None
-
-class TrendCNN(nn.Module):
-    def __init__(self, num_classes=3):
-        super(TrendCNN, self).__init__()
-        self.features = nn.Sequential(
-            nn.Conv2d(3, 16, kernel_size=3, padding=1),
-            nn.ReLU(),
-            nn.MaxPool2d(2),
-            nn.Conv2d(16, 32, kernel_size=3, padding=1),
-            nn.ReLU(),
-            nn.MaxPool2d(2)
-        )
-        self.classifier = nn.Sequential(
-            nn.Linear(32 * 32 * 32, 128),
-            nn.ReLU(),
-            nn.Linear(128, num_classes)
-        )
-        
-    def forward(self, x):
-        x = self.features(x)
-        x = x.view(x.size(0), -1)
-        x = self.classifier(x)
-        return x
+# С TREND_PRELOAD модель загружается при старте процесса (при APP_PRELOAD — в мастере, wsgi.py),
+# иначе — при первом анализе графика; запросы группируются в микро-батчи (trend_inference.py)
+if app.config.get('TREND_PRELOAD', False):
+    trend_inference.preload()
 
 def get_trend_model():
-    global trend_model
-    if trend_model is None:
-        model_path = 'trend_model.pth'
-        if os.path.exists(model_path):
-            trend_model = TrendCNN(num_classes=3)
-            # Set map_location to ensure compatibility across devices
-            trend_model.load_state_dict(torch.load(model_path, map_location=torch.device('cpu')))
-            trend_model.eval()
-            logger.info("Trend model loaded from 'trend_model.pth'.")
-        else:
-            logger.warning("File 'trend_model.pth' not found. Trend model will not be loaded.")
-            trend_model = None
-    return trend_model
-    
+    return trend_inference.trend_service.load()
+
 
-def preprocess_for_trend(image_path):
+def preprocess_for_trend(image):
     """
     Preprocesses the image for trend model.
+    image: bytes, file-like object or PIL.Image (decoded in memory).
     """
     try:
-        if not os.path.exists(image_path):
-            return None
-
-        transform = transforms.Compose([
-            transforms.Resize((128, 128)),
-            transforms.ToTensor(),
-            transforms.Normalize(mean=[0.5,0.5,0.5], std=[0.5,0.5,0.5])
-        ])
-
-        img = Image.open(image_path).convert('RGB')
-        img_tensor = transform(img).unsqueeze(0)
-        return img_tensor
+        return trend_inference.preprocess_image(image)
     except Exception as e:
         logger.error(f"Error preprocessing image for trend: {e}")
         logger.error(traceback.format_exc())
         return None
 
-def predict_trend(image_path):
+def predict_trend(image):
     """
     Predicts trend direction: uptrend, downtrend or sideways.
+    Повторные загрузки того же графика отдаются из кэша (совпадение входа модели
+    или 256-битного dHash, см. trend_inference.chart_fingerprint).
     """
-    model = get_trend_model()
-    if model is None:
+    if get_trend_model() is None:
         return "Trend model not loaded."
 
-    img_tensor = preprocess_for_trend(image_path)
+    try:
+        img = trend_inference.load_chart_image(image)
+    except Exception as e:
+        logger.error(f"Error decoding image for trend: {e}")
+        logger.error(traceback.format_exc())
+        return "Failed to process image for trend."
+
+    trend_service = trend_inference.trend_service
+    content_hash, phash = trend_inference.chart_fingerprint(img)
+    trend_label = get_cached_trend(content_hash, phash, trend_service.model_version)
+    if trend_label is not None:
+        logger.debug(f"Chart analysis cache hit for {content_hash[:16]} (phash {phash[:16]}).")
+        return f"Trend prediction: {trend_label}"
+
+    img_tensor = preprocess_for_trend(img)
     if img_tensor is None:
         return "Failed to process image for trend."
 
-    with torch.no_grad():
-        outputs = model(img_tensor)
-        _, predicted = torch.max(outputs.data, 1)
-    # 0: downtrend, 1: sideways, 2: uptrend
-    classes = ["downtrend", "sideways", "uptrend"]
-    return f"Trend prediction: {classes[predicted.item()]}"
+    trend_label = trend_service.predict_label(img_tensor)
+    store_trend(content_hash, phash, trend_service.model_version, trend_label)
+    return f"Trend prediction: {trend_label}"
 
 ##################################################
 # Chart analysis and preprocessing
 ##################################################
 
-def analyze_chart(image_path):
+def analyze_chart(image):
     """
     Analyzes the chart image: predicts trend (trend_model.pth).
+    image: bytes, file-like object or PIL.Image.
     Returns a dictionary with analysis results.
     """
     try:
         # Trend prediction
-        trend_prediction = predict_trend(image_path)
+        trend_prediction = predict_trend(image)
 
         # Return the results
         return {
@@ -204,7 +165,13 @@ if not TOKEN:
     logger.error("TELEGRAM_BOT_TOKEN is not set in environment variables.")
     exit(1)
 
-bot = Bot(token=TOKEN)
+# Базовый URL Bot API (локальный сервер Bot API или фейковый API для тестов)
+TELEGRAM_API_BASE_URL = os.environ.get('TELEGRAM_API_BASE_URL', '').strip()
+if TELEGRAM_API_BASE_URL:
+    bot = Bot(token=TOKEN, base_url=TELEGRAM_API_BASE_URL)
+else:
+    bot = Bot(token=TOKEN)
+notification_queue.bind(bot)
 dispatcher = Dispatcher(bot, None, workers=1, use_context=True)
 
 
@@ -235,6 +202,19 @@ def premium_required(f):
         return f(*args, **kwargs)
     return decorated_function
 
+def metrics_auth_required(f):
+    # Метрики для Prometheus: Bearer METRICS_TOKEN или сессия администратора
+    @wraps(f)
+    def decorated_function(*args, **kwargs):
+        token = app.config.get('METRICS_TOKEN')
+        auth_header = request.headers.get('Authorization', '')
+        if token and hmac.compare_digest(auth_header, f"Bearer {token}"):
+            return f(*args, **kwargs)
+        if session.get('telegram_id') in ADMIN_TELEGRAM_IDS:
+            return f(*args, **kwargs)
+        return 'Unauthorized', 401
+    return decorated_function
+
 def start_command(update, context):
     user = update.effective_user
     logger.info(f"Received /start command from user {user.id} ({user.username})")
@@ -323,6 +303,16 @@ dispatcher.add_handler(CommandHandler('help', help_command))
 dispatcher.add_handler(CommandHandler('test', test_command))
 dispatcher.add_handler(CallbackQueryHandler(button_click))
 
+
+def process_telegram_update(payload):
+    # Выполняется в потоке пула UpdateIngestor, вне HTTP-запроса
+    with app.app_context():
+        update = Update.de_json(payload, bot)
+        dispatcher.process_update(update)
+        logger.debug(f"Processed Telegram update {update.update_id}")
+
+update_ingestor = UpdateIngestor(process_telegram_update)
+
 ##################################################
 # Routes for voting and assistant
 ##################################################
@@ -349,20 +339,12 @@ def assistant_analyze_chart():
     if image:
         try:
             MAX_IMAGE_SIZE = 5 * 1024 * 1024  # 5 MB
-            image.seek(0, os.SEEK_END)
-            file_size = image.tell()
-            image.seek(0)
-            if file_size > MAX_IMAGE_SIZE:
+            # Читаем загрузку в память (не больше лимита + 1 байт) — без временных файлов
+            image_bytes = image.stream.read(MAX_IMAGE_SIZE + 1)
+            if len(image_bytes) > MAX_IMAGE_SIZE:
                 return jsonify({'error': 'Image size exceeds 5 MB limit.'}), 400
 
-            filename = secure_filename(image.filename)
-            temp_dir = 'temp'
-            os.makedirs(temp_dir, exist_ok=True)
-            temp_path = os.path.join(temp_dir, filename)
-            image.save(temp_path)
-
-            analysis_result = analyze_chart(temp_path)
-            os.remove(temp_path)
+            analysis_result = analyze_chart(image_bytes)
 
             # Check what analyze_chart returned
             if 'error' in analysis_result:
@@ -486,6 +468,9 @@ def vote():
                     predicted_price=predicted_price
                 )
                 db.session.add(user_prediction)
+                db.session.flush()
+                # Инкрементальный агрегат (count/sum/sum²/min/max/корзины) в той же транзакции
+                record_prediction(active_poll.id, selected_instrument_id, predicted_price, real_price)
                 db.session.commit()
                 flash('Your prediction has been saved successfully.', 'success')
                 logger.info(
@@ -519,8 +504,27 @@ def vote():
         existing_predictions=existing_predictions
     )
 
+def _chart_aggregates(poll_ids):
+    """
+    Агрегаты прогнозов (несколько строк вместо скана user_prediction) и версия
+    картинки для каждой пары (poll, instrument).
+    """
+    aggregates = PollPredictionAggregate.query.filter(
+        PollPredictionAggregate.poll_id.in_(poll_ids),
+        PollPredictionAggregate.count > 0
+    ).all()
+    return {
+        (agg.poll_id, agg.instrument_id): (chart_version(agg.count, agg.total, agg.real_price), agg)
+        for agg in aggregates
+    }
+
 @app.route('/fetch_charts', methods=['GET'])
+@replica_router.read_only
 def fetch_charts():
+    """
+    Возвращает URL картинок распределения прогнозов по активным опросам.
+    Сами графики рендерятся один раз на версию и отдаются prediction_chart_image.
+    """
     if 'user_id' not in session:
         return jsonify({'error':'Unauthorized'}),401
 
@@ -533,54 +537,91 @@ def fetch_charts():
 
     active_polls = Poll.query.filter_by(status='active').filter(Poll.end_date > datetime.utcnow()).all()
     logger.debug(f"Found {len(active_polls)} active polls.")
+    if not active_polls:
+        return jsonify({'charts': charts})
+
+    versions = _chart_aggregates([poll.id for poll in active_polls])
+    instrument_names = dict(
+        db.session.query(Instrument.id, Instrument.name).filter(
+            Instrument.id.in_({instr_id for _, instr_id in versions})
+        ).all()
+    ) if versions else {}
 
     for poll in active_polls:
-        logger.debug(f"Processing poll ID {poll.id}. Instruments: {[pi.instrument.name for pi in poll.poll_instruments]}")
         for pi in poll.poll_instruments:
-            instr = pi.instrument
-            predictions = UserPrediction.query.filter_by(poll_id=poll.id, instrument_id=instr.id).all()
-            logger.debug(f"[fetch_charts] {len(predictions)} predictions for {instr.name} (poll {poll.id}).")
-
-            if not predictions:
-                continue
-
-            # Log to check if there is a 0.0 value
-            for p in predictions:
-                logger.debug(f"UserPred: user={p.user_id}, predicted={p.predicted_price}, real={p.real_price}")
-
-            df = pd.DataFrame([{
-                'user': p.user.username or p.user.first_name,
-                'predicted_price': float(p.predicted_price or 0.0)
-            } for p in predictions])
-
-            if df.empty:
+            entry = versions.get((poll.id, pi.instrument_id))
+            if entry is None:
                 continue
+            version, _ = entry
+            charts[f"Active - {instrument_names.get(pi.instrument_id)} (Poll {poll.id})"] = url_for(
+                'prediction_chart_image', poll_id=poll.id, instrument_id=pi.instrument_id,
+                fmt='png', v=version
+            )
 
-            real_price = predictions[0].real_price
+    logger.debug(f"Total charts to send: {len(charts)}.")
+    return jsonify({'charts': charts})
 
-            plt.figure(figsize=(10, 6))
-            plt.hist(df['predicted_price'], bins=20, color='green', alpha=0.7)
-            plt.xlabel('Predicted Price')
-            plt.ylabel('Number of Predictions')
-            plt.title(f'Prediction Distribution for {instr.name} (Poll {poll.id})')
+@app.route('/charts/prediction/<int:poll_id>/<int:instrument_id>.<fmt>', methods=['GET'])
+def prediction_chart_image(poll_id, instrument_id, fmt):
+    """
+    PNG/SVG распределения прогнозов. Кэшируется по (poll, instrument, версия, формат);
+    версия в URL (?v=) позволяет браузеру кэшировать картинку надолго.
+    """
+    if 'user_id' not in session:
+        return jsonify({'error':'Unauthorized'}),401
 
-            if real_price is not None:
-                plt.axvline(float(real_price), color='red', linestyle='dashed', linewidth=2,
-                            label=f'Real Price: {real_price}')
-                plt.legend()
+    user = User.query.get(session['user_id'])
+    if not user or not user.assistant_premium:
+        return jsonify({'error': 'Forbidden'}), 403
 
-            plt.tight_layout()
+    if fmt not in CHART_FORMATS:
+        return jsonify({'error': 'Unsupported format'}), 400
+
+    entry = _chart_aggregates([poll_id]).get((poll_id, instrument_id))
+    if entry is None:
+        return jsonify({'error': 'No predictions'}), 404
+    version, aggregate = entry
+
+    cache_key = (poll_id, instrument_id, version, fmt)
+    data = rendered_charts.get(cache_key)
+    if data is None:
+        instrument = Instrument.query.get(instrument_id)
+        counts, edges = aggregate_histogram(aggregate)
+        data = render_distribution_chart(
+            f'Prediction Distribution for {instrument.name if instrument else instrument_id} (Poll {poll_id})',
+            counts, edges, aggregate.real_price, fmt
+        )
+        rendered_charts.put(cache_key, data)
+        logger.debug(f"Rendered chart {cache_key} ({len(data)} bytes).")
+
+    response = Response(data, mimetype=CHART_FORMATS[fmt])
+    response.set_etag(version)
+    # Запрос с актуальной версией в URL неизменен — можно кэшировать надолго
+    max_age = 86400 if request.args.get('v') == version else 30
+    response.headers['Cache-Control'] = f'private, max-age={max_age}'
+    return response.make_conditional(request)
+
+@app.route('/poll_stats', methods=['GET'])
+def poll_stats():
+    """
+    Статистика активного опроса по инструментам (консенсус, разброс, min/max)
+    из агрегатов, без чтения отдельных прогнозов.
+    """
+    if 'user_id' not in session:
+        return jsonify({'error': 'Unauthorized'}), 401
 
-            buf = io.BytesIO()
-            plt.savefig(buf, format='png')
-            buf.seek(0)
-            image_base64 = base64.b64encode(buf.getvalue()).decode()
-            plt.close()
+    active_poll = Poll.query.filter_by(status='active').filter(Poll.end_date > datetime.utcnow()).first()
+    if not active_poll:
+        return jsonify({'error': 'No active poll.'}), 404
 
-            charts[f"Active - {instr.name} (Poll {poll.id})"] = image_base64
+    stats = {}
+    rows = db.session.query(PollPredictionAggregate, Instrument.name).join(
+        Instrument, Instrument.id == PollPredictionAggregate.instrument_id
+    ).filter(PollPredictionAggregate.poll_id == active_poll.id).all()
+    for aggregate, instrument_name in rows:
+        stats[instrument_name] = aggregate_stats(aggregate)
 
-    logger.debug(f"Total charts to send: {len(charts)}.")
-    return jsonify({'charts': charts})
+    return jsonify({'poll_id': active_poll.id, 'stats': stats}), 200
 
 @app.route('/fetch_predictions', methods=['GET'])
 def fetch_predictions():
@@ -619,19 +660,8 @@ def generate_chart_base64(user_prediction):
         if real_price is None or deviation is None:
             return None
 
-        plt.figure(figsize=(6, 4))
-        plt.bar(['Predicted Price', 'Real Price'], [user_prediction.predicted_price, real_price], color=['blue', 'green'])
-        plt.title('Comparison of Predicted and Real Prices')
-        plt.ylabel('Price')
-        plt.tight_layout()
-
-        buf = io.BytesIO()
-        plt.savefig(buf, format='png')
-        buf.seek(0)
-        image_base64 = base64.b64encode(buf.getvalue()).decode('utf-8')
-        plt.close()
-
-        return image_base64
+        png = render_comparison_chart(user_prediction.predicted_price, real_price)
+        return base64.b64encode(png).decode('utf-8')
     except Exception as e:
         logger.error(f"Error generating chart: {e}")
         logger.error(traceback.format_exc())
@@ -639,6 +669,7 @@ def generate_chart_base64(user_prediction):
 
 @app.route('/vote_results', methods=['GET'])
 @admin_required
+@replica_router.read_only
 def vote_results():
     completed_polls = Poll.query.filter(Poll.status == 'completed').all()
     return render_template('vote_results.html', polls=completed_polls)
@@ -741,16 +772,14 @@ def robokassa_fail():
 def webhook():
     if request.method == 'POST':
         try:
-            raw_data = request.get_data(as_text=True)
-            logger.debug(f"Raw request data: {raw_data}")
-
-            if not raw_data:
-                logger.error("Empty request data received.")
+            payload = request.get_json(force=True, silent=True)
+            if not isinstance(payload, dict):
+                logger.error("Empty or invalid webhook payload received.")
                 return 'Bad Request', 400
 
-            update = Update.de_json(request.get_json(force=True), bot)
-            dispatcher.process_update(update)
-            logger.info(f"Received Telegram update: {update}")
+            # Подтверждаем сразу, обработка — в пуле update_ingestor
+            if not update_ingestor.submit(payload):
+                return 'Service Unavailable', 503
             return 'OK', 200
         except Exception as e:
             logger.error(f"Error processing webhook: {e}")
@@ -855,52 +884,21 @@ FUNCTIONS = [
 ]
 
 
-@app.route('/assistant/chat', methods=['POST'])
-@csrf.exempt
-def assistant_chat():
-    if 'user_id' not in session:
-        return jsonify({'error': 'Unauthorized'}), 401
-
-    user_id = session['user_id']
-    user = User.query.get(user_id)
-    if not user or not user.assistant_premium:
-        return jsonify({'error': 'Access denied. Please purchase a subscription.'}), 403
-
-    data = request.get_json()
-    user_question = data.get('question')
-
-    if not user_question:
-        return jsonify({'error': 'No question provided'}), 400
+# Общие параметры completion для обычного и потокового режима
+ASSISTANT_COMPLETION_PARAMS = dict(
+    model="gpt-3.5-turbo",
+    functions=FUNCTIONS,
+    function_call="auto",
+    temperature=0.7,
+    max_tokens=900,
+    top_p=1,
+    frequency_penalty=0,
+    presence_penalty=0
+)
 
-    # Инициализация chat_history (как и раньше)
-    if 'chat_history' not in session:
-        session['chat_history'] = []
 
-        trades = Trade.query.filter_by(user_id=user_id).all()
-        if not trades:
-            trade_data = "You currently have no trades."
-            comments = "No comments on trades."
-        else:
-            trade_data = "\n\n".join([
-                f"**Trade ID {trade.id}:**\n"
-                f" - **Instrument:** {trade.instrument.name}\n"
-                f" - **Direction:** {trade.direction}\n"
-                f" - **Entry Price:** {trade.entry_price}\n"
-                f" - **Exit Price:** {trade.exit_price}\n"
-                f" - **Open Time:** {trade.trade_open_time}\n"
-                f" - **Close Time:** {trade.trade_close_time}\n"
-                f" - **Profit/Loss:** {trade.profit_loss} ({trade.profit_loss_percentage}%)\n"
-                f" - **Setup:** {trade.setup.setup_name if trade.setup else 'No setup'}\n"
-                f" - **Criteria:** {', '.join([criterion.name for criterion in trade.criteria]) if trade.criteria else 'No criteria'}"
-                for trade in trades
-            ])
-            comments = "\n\n".join([
-                f"**Trade ID {trade.id}:** {trade.comment}" 
-                for trade in trades if trade.comment
-            ]) if any(trade.comment for trade in trades) else "No comments on trades."
-
-        # Расширяем system_message, добавляя правила для Function Calling
-        system_message = f"""
+# Шаблон system prompt ассистента; {trade_context} — сводка журнала пользователя
+ASSISTANT_SYSTEM_TEMPLATE = """
 You are Uncle John, a versatile trading assistant with the following capabilities:
 
 1. **Analyze Trades:**
@@ -960,64 +958,183 @@ You are Uncle John, a versatile trading assistant with the following capabilitie
   - If user is only analyzing or discussing, do not call `create_trades`.
   - If finalizing trades, you may end the conversation.
   - If you ask for advice or help, always give a specific solution, using in detail numbers, indicators, situations, examples. Avoid general information.
+  - Start the answer with the exact tag [GENERAL] only if it uses nothing from the Existing Trades Summary or the user's own trades, statistics or journal and would be the same for any user (e.g. explaining a concept or an indicator). Otherwise never use the tag.
 
 **Existing Trades Summary:**
-{trade_data}
-
-**User Trade Comments:**
-{comments}
+{trade_context}
 
 """
+
+def build_assistant_system_message(user_id):
+    """
+    System prompt ассистента с правилами Function Calling и контекстом сделок.
+    """
+    # Компактная SQL-статистика + самые релевантные сделки в пределах бюджета токенов
+    # (кэшируется per-user до изменения trade_stats_version)
+    trade_context = get_trade_context(user_id)
+    return ASSISTANT_SYSTEM_TEMPLATE.format(trade_context=trade_context)
+
+
+def _dispatch_function_call(user_id, fn_name, fn_args_json, chat_history):
+    """
+    Выполняет function call ассистента и возвращает текст ответа.
+    """
+    try:
+        fn_args = json.loads(fn_args_json or "{}")
+    except ValueError:
+        fn_args = {}
+
+    if fn_name == "create_trades":
+        return handle_create_trades(user_id, fn_args, chat_history)
+
+    error_text = f"Error: unknown function call '{fn_name}'."
+    chat_history.append('assistant', error_text)
+    return error_text
+
+
+def _save_chat_history(user_id, chat_history):
+    # Сохраняем историю (с обрезкой до MAX_CHAT_HISTORY и продлением TTL)
+    try:
+        chat_history.save()
+    except Exception as e:
+        db.session.rollback()
+        logger.error(f"Error saving chat history for user {user_id}: {e}", exc_info=True)
+
+
+def _stream_assistant_chat(user_id, chat_history, cache_token=None):
+    """
+    Генератор SSE-событий для потокового режима /assistant/chat:
+    'token' — очередной фрагмент текста, 'status' — ассистент вызывает функцию,
+    'done' — итоговый ответ целиком, 'error' — ошибка AI-сервера.
+    """
+    collector = ChatStreamCollector(leading_tag=GENERAL_ANSWER_TAG)
+    try:
+        response = openai.ChatCompletion.create(
+            messages=chat_history.messages,
+            stream=True,
+            **ASSISTANT_COMPLETION_PARAMS
+        )
+        for text in collector.iter_text(response):
+            yield sse_event('token', {'content': text})
+
+        if collector.has_function_call:
+            # Аргументы create_trades приходят кусками — вызываем функцию после сборки
+            yield sse_event('status', {'status': 'function_call', 'name': collector.function_name})
+            assistant_response_new = _dispatch_function_call(
+                user_id, collector.function_name, collector.function_arguments, chat_history
+            )
+        else:
+            assistant_response_new = collector.content
+            chat_history.append('assistant', assistant_response_new)
+            if collector.tagged:
+                get_response_cache().put(cache_token, assistant_response_new)
+
+    except GeneratorExit:
+        # Клиент закрыл соединение — сохраняем то, что успели получить
+        logger.info(f"Assistant stream for user {user_id} closed by client.")
+        if collector.content and not collector.has_function_call:
+            chat_history.append('assistant', collector.content)
+        _save_chat_history(user_id, chat_history)
+        raise
+    except Exception as e:
+        logger.error(f"OpenAI API streaming error: {e}", exc_info=True)
+        assistant_response_new = "Sorry, an error occurred with the AI server."
+        chat_history.append('assistant', assistant_response_new)
+        _save_chat_history(user_id, chat_history)
+        yield sse_event('error', {'error': assistant_response_new})
+        return
+
+    _save_chat_history(user_id, chat_history)
+    yield sse_event('done', {'response': assistant_response_new})
+
+
+@app.route('/assistant/chat', methods=['POST'])
+@csrf.exempt
+def assistant_chat():
+    """
+    Чат с ассистентом. По умолчанию отвечает JSON целиком; с {"stream": true}
+    в теле (или Accept: text/event-stream) отдаёт ответ токенами через SSE.
+    """
+    if 'user_id' not in session:
+        return jsonify({'error': 'Unauthorized'}), 401
+
+    user_id = session['user_id']
+    user = User.query.get(user_id)
+    if not user or not user.assistant_premium:
+        return jsonify({'error': 'Access denied. Please purchase a subscription.'}), 403
+
+    data = request.get_json() or {}
+    user_question = data.get('question')
+
+    if not user_question:
+        return jsonify({'error': 'No question provided'}), 400
+
+    # История диалога хранится на сервере, в сессии только id диалога
+    chat_history = ChatHistory.load(user_id)
+    if chat_history.is_new:
+        system_message = build_assistant_system_message(user_id)
         logger.debug(f"System message for OpenAI: {system_message}")
-        session['chat_history'].append({'role': 'system', 'content': system_message})
+        chat_history.append('system', system_message)
 
     # Добавляем сообщение пользователя
-    session['chat_history'].append({'role': 'user', 'content': user_question})
+    chat_history.append('user', user_question)
+    stream = data.get('stream') or 'text/event-stream' in request.headers.get('Accept', '')
+
+    # Кэш общих ответов (вопросы о журнале пользователя и ведущие к create_trades его обходят).
+    # Модель всегда получает контекст сделок; в кэш идут только ответы, которые
+    # она сама пометила как общие (GENERAL_ANSWER_TAG)
+    response_cache = get_response_cache()
+    cached_answer, cache_token = response_cache.get(
+        user_question, chat_history.messages[:-1], template=ASSISTANT_SYSTEM_TEMPLATE
+    )
+    if cached_answer is not None:
+        logger.info(f"Assistant response cache hit for user {user_id}.")
+        chat_history.append('assistant', cached_answer)
+        _save_chat_history(user_id, chat_history)
+        if stream:
+            return Response(
+                [sse_event('token', {'content': cached_answer}), sse_event('done', {'response': cached_answer})],
+                mimetype='text/event-stream',
+                headers=SSE_HEADERS
+            )
+        return jsonify({'response': cached_answer}), 200
+
+    if stream:
+        # Сохраняем до отправки заголовков, чтобы id нового диалога попал в cookie
+        _save_chat_history(user_id, chat_history)
+        return Response(
+            stream_with_context(_stream_assistant_chat(user_id, chat_history, cache_token)),
+            mimetype='text/event-stream',
+            headers=SSE_HEADERS
+        )
 
     try:
         response = openai.ChatCompletion.create(
-            model="gpt-3.5-turbo",
-            messages=session['chat_history'],
-            functions=FUNCTIONS,
-            function_call="auto",
-            temperature=0.7,
-            max_tokens=900,
-            top_p=1,
-            frequency_penalty=0,
-            presence_penalty=0
+            messages=chat_history.messages,
+            **ASSISTANT_COMPLETION_PARAMS
         )
         assistant_message = response["choices"][0]["message"]
 
         # Если ассистент решил вызвать функцию:
         if assistant_message.get("function_call"):
-            fn_name = assistant_message["function_call"]["name"]
-            fn_args_json = assistant_message["function_call"]["arguments"]
-            try:
-                fn_args = json.loads(fn_args_json)
-            except:
-                fn_args = {}
-
-            if fn_name == "create_trades":
-                assistant_response_new = handle_create_trades(user_id, fn_args)
-                return assistant_response_new
-            else:
-                error_text = f"Error: unknown function call '{fn_name}'."
-                session['chat_history'].append({'role': 'assistant', 'content': error_text})
-                return jsonify({'response': error_text}), 200
+            assistant_response_new = _dispatch_function_call(
+                user_id,
+                assistant_message["function_call"]["name"],
+                assistant_message["function_call"]["arguments"],
+                chat_history
+            )
         else:
-            assistant_response_new = assistant_message["content"]
-            session['chat_history'].append({'role': 'assistant', 'content': assistant_response_new})
+            assistant_response_new, general = strip_general_tag(assistant_message["content"])
+            chat_history.append('assistant', assistant_response_new)
+            if general:
+                response_cache.put(cache_token, assistant_response_new)
 
     except Exception as e:
         logger.error(f"OpenAI API error: {e}", exc_info=True)
         assistant_response_new = "Sorry, an error occurred with the AI server."
-        session['chat_history'].append({'role': 'assistant', 'content': assistant_response_new})
-
-    # Ограничиваем длину истории
-    MAX_CHAT_HISTORY = 20
-    if len(session['chat_history']) > MAX_CHAT_HISTORY:
-        session['chat_history'] = session['chat_history'][-MAX_CHAT_HISTORY:]
+        chat_history.append('assistant', assistant_response_new)
 
+    _save_chat_history(user_id, chat_history)
     return jsonify({'response': assistant_response_new}), 200
 
 
@@ -1026,10 +1143,8 @@ def get_chat_history():
     if 'user_id' not in session:
         return jsonify({'error': 'Unauthorized'}), 401
 
-    chat_history = session.get('chat_history', [])
-    # Системные сообщения скрываем
-    display_history = [msg for msg in chat_history if msg['role'] != 'system']
-    return jsonify({'chat_history': display_history}), 200
+    chat_history = ChatHistory.load(session['user_id'])
+    return jsonify({'chat_history': chat_history.display_messages()}), 200
 
 @app.route('/clear_chat_history', methods=['POST'])
 @csrf.exempt
@@ -1037,7 +1152,7 @@ def clear_chat_history():
     if 'user_id' not in session:
         return jsonify({'error': 'Unauthorized'}), 401
 
-    session.pop('chat_history', None)
+    ChatHistory.load(session['user_id']).clear()
     return jsonify({'status': 'success'}), 200
 
 @app.route('/logout')
@@ -1114,6 +1229,7 @@ def init():
 
 @app.route('/admin/users')
 @admin_required
+@replica_router.read_only
 def admin_users():
     users = User.query.all()
     voting_config = Config.query.filter_by(key='voting_enabled').first()
@@ -1134,6 +1250,99 @@ def admin_users():
         game_pool_size=game_pool_size           # Недельный пул
     )
     
+@app.route('/admin/assistant_cache_stats')
+@admin_required
+def assistant_cache_stats():
+    # Размер кэша ответов ассистента и hit rate (в рамках текущего процесса)
+    return jsonify(get_response_cache().stats()), 200
+
+@app.route('/admin/job_runs')
+@admin_required
+def job_runs():
+    # История запусков заданий планировщика (все процессы кластера)
+    limit = min(request.args.get('limit', 100, type=int), 1000)
+    runs = recent_runs(limit=limit, job_id=request.args.get('job_id'))
+    return jsonify([{
+        'id': run.id,
+        'job_id': run.job_id,
+        'host': run.host,
+        'pid': run.pid,
+        'started_at': run.started_at.isoformat(),
+        'finished_at': run.finished_at.isoformat() if run.finished_at else None,
+        'duration_ms': run.duration_ms,
+        'status': run.status,
+        'error': run.error,
+    } for run in runs]), 200
+
+@app.route('/admin/job_metrics')
+@admin_required
+def job_metrics():
+    # Длительности, перерасход интервала, SQL/строки/внешние вызовы по заданиям
+    return jsonify({
+        'leader': job_runner.is_leader(),
+        'jobs': job_stats(job_runner.intervals),
+    }), 200
+
+@app.route('/metrics')
+@metrics_auth_required
+def metrics():
+    # Метрики HTTP-запросов (все воркеры, если задан METRICS_MULTIPROC_DIR)
+    # + текущее состояние пулов соединений этого воркера
+    pools = {'web': db.engine.pool}
+    pools.update({role: engine.pool for role, engine in created_engines().items()})
+    body = request_metrics.prometheus_text() + pool_status_text(pools)
+    return Response(body, mimetype='text/plain; version=0.0.4')
+
+@app.route('/metrics/jobs')
+@metrics_auth_required
+def job_metrics_prometheus():
+    body = jobs_prometheus_text(job_stats(job_runner.intervals), is_leader=job_runner.is_leader())
+    return Response(body, mimetype='text/plain; version=0.0.4')
+
+@app.route('/admin/profile/start', methods=['POST'])
+@admin_required
+def profile_start():
+    # seconds=N — все потоки воркеров N секунд; endpoint=<name>&requests=K — следующие K запросов
+    data = request.get_json(silent=True) or request.form
+    endpoint = (data.get('endpoint') or '').strip() or None
+    if endpoint and endpoint not in app.view_functions:
+        return jsonify({'error': f"Unknown endpoint '{endpoint}'."}), 400
+    try:
+        session_info = profiler.start_session(
+            seconds=data.get('seconds'),
+            endpoint=endpoint,
+            requests=data.get('requests'),
+            interval_ms=data.get('interval_ms') or 5
+        )
+    except (TypeError, ValueError):
+        return jsonify({'error': 'Invalid profiling parameters.'}), 400
+    session_info['result_url'] = url_for('profile_result', session_id=session_info['id'])
+    return jsonify(session_info), 200
+
+@app.route('/admin/profile/stop', methods=['POST'])
+@admin_required
+def profile_stop():
+    profiler.stop_session()
+    return jsonify({'stopped': True}), 200
+
+@app.route('/admin/profile/<session_id>')
+@admin_required
+def profile_result(session_id):
+    # Collapsed stacks (flamegraph.pl, speedscope), сумма по всем воркерам хоста
+    text, workers = profiler.result(session_id)
+    response = Response(text, mimetype='text/plain')
+    response.headers['X-Profile-Workers'] = str(workers)
+    return response
+
+@app.route('/admin/telegram_stats')
+@admin_required
+def telegram_stats():
+    # Очередь входящих апдейтов вебхука и исходящих уведомлений (текущий процесс)
+    return jsonify({
+        'webhook': update_ingestor.stats(),
+        'notifications': notification_queue.stats(),
+    }), 200
+
 @app.route('/admin/toggle_voting', methods=['POST'])
 @admin_required
 def toggle_voting():
@@ -1213,6 +1422,7 @@ def set_pool_size():
     return redirect(url_for('admin_users'))
 
 @app.route('/', methods=['GET'])
+@replica_router.read_only
 def index():
     if 'user_id' in session:
         user_id = session['user_id']
@@ -1350,6 +1560,7 @@ def new_trade():
                     return redirect(url_for('new_trade'))
 
             db.session.add(trade)
+            bump_trade_stats_version(user_id)
             db.session.commit()
             flash('Trade added successfully.', 'success')
             logger.info(f"Trade ID {trade.id} added by user ID {user_id}.")
@@ -1468,6 +1679,7 @@ def edit_trade(trade_id):
                     logger.error(f"Failed to upload new image for trade ID {trade_id} to S3.")
                     return redirect(url_for('edit_trade', trade_id=trade_id))
 
+            bump_trade_stats_version(user_id)
             db.session.commit()
             flash('Trade updated successfully.', 'success')
             logger.info(f"Trade ID {trade.id} updated by user ID {user_id}.")
@@ -1505,6 +1717,7 @@ def delete_trade(trade_id):
                 flash('Error deleting screenshot.', 'danger')
                 logger.error("Failed to delete screenshot from S3.")
         db.session.delete(trade)
+        bump_trade_stats_version(user_id)
         db.session.commit()
         flash('Trade deleted successfully.', 'success')
         logger.info(f"Trade ID {trade.id} deleted by user ID {user_id}.")
@@ -1661,6 +1874,7 @@ def edit_setup(setup_id):
                     logger.error(f"Failed to upload new image for setup ID {setup_id} to S3.")
                     return redirect(url_for('edit_setup', setup_id=setup_id))
 
+            bump_trade_stats_version(user_id)
             db.session.commit()
             flash('Setup updated successfully.', 'success')
             logger.info(f"Setup ID {setup.id} updated by user ID {user_id}.")
@@ -1698,6 +1912,7 @@ def delete_setup(setup_id):
                 flash('Error deleting screenshot.', 'danger')
                 logger.error("Failed to delete screenshot from S3.")
         db.session.delete(setup)
+        bump_trade_stats_version(user_id)
         db.session.commit()
         flash('Setup deleted successfully.', 'success')
         logger.info(f"Setup ID {setup.id} deleted by user ID {user_id}.")
@@ -1755,6 +1970,7 @@ def view_setup(setup_id):
 
 
 @app.route('/get_user_stakes', methods=['GET'])
+@replica_router.read_only
 def get_user_stakes():
     if 'user_id' not in session:
         return jsonify({'error':'Unauthorized'}),401
@@ -1854,153 +2070,32 @@ def unstake_staking():
         return jsonify({'error':'Transaction error during unstake'}),400
 
 
-def parse_date_time(dt_str: str) -> datetime:
+def _find_instrument_by_substring(user_input: str):
     """
-    Парсит строку даты/времени. Поддерживает форматы:
-      1) 'YYYY-MM-DD HH:MM:SS'
-      2) 'YYYY-MM-DD' (тогда автоматически добавляется '00:00:00')
-    При неудаче выбрасывает ValueError.
+    Ищет инструмент через индекс InstrumentResolver (нормализованные имена,
+    тикеры yfinance, многоязычные синонимы, затем частичное и fuzzy-совпадение).
+    Возвращает ResolvedInstrument (id, name, score). Если совпадений нет
+    или их несколько, бросает ValueError с ранжированным списком кандидатов.
     """
-    dt_str = dt_str.strip()
-    # Сначала пробуем "YYYY-MM-DD HH:MM:SS"
-    try:
-        return datetime.strptime(dt_str, "%Y-%m-%d %H:%M:%S")
-    except ValueError:
-        # Пробуем "YYYY-MM-DD"
-        try:
-            d = datetime.strptime(dt_str, "%Y-%m-%d")
-            return d
-        except ValueError:
-            raise ValueError(
-                f"Invalid date/time format: '{dt_str}'. Use 'YYYY-MM-DD' or 'YYYY-MM-DD HH:MM:SS'."
-            )
+    return get_instrument_resolver().resolve(user_input)
 
-def _find_instrument_by_substring(user_input: str) -> Instrument:
+def handle_create_trades(user_id, fn_args, chat_history):
     """
-    Ищет инструмент в БД по подстроке (case-insensitive), сначала используя словарь
-    синонимов, а затем — частичное совпадение. Если находит ровно один инструмент,
-    возвращает его. Если нет совпадений или несколько совпадений, бросает ValueError.
+    Обрабатывает вызов функции create_trades. Возвращает текст ответа
+    ассистента; история диалога обновляется (или очищается) в chat_history.
     """
-
-    # 1) Определяем словарь синонимов (можно расширять):
-    SYNONYMS = {
-        "серебро": "Silver",
-        "xag": "Silver",
-        "xag/usd": "Silver",
-        "silver": "Silver",
-        "gold": "Gold",
-        "золото": "Gold",
-        # Можно добавлять: "euro": "EUR/USD", "евро": "EUR/USD" и т.д.
-    }
-
-    user_input_lower = user_input.lower().strip()
-
-    # 2) Если это слово есть в словаре синонимов, подменяем
-    if user_input_lower in SYNONYMS:
-        mapped_name = SYNONYMS[user_input_lower]
-        user_input_lower = mapped_name.lower()  # например "Silver".lower() = "silver"
-
-    # 3) Собираем все инструменты из БД
-    all_instruments = Instrument.query.all()
-
-    matches = []
-    for instr in all_instruments:
-        # Сравниваем lower-версию имени инструмента с user_input_lower
-        # но при этом делаем проверку "содержит ли"
-        db_instrument_lower = instr.name.lower()
-        if user_input_lower in db_instrument_lower:
-            matches.append(instr)
-
-    if len(matches) == 1:
-        return matches[0]
-    elif len(matches) > 1:
-        conflict_names = ", ".join(i.name for i in matches)
-        raise ValueError(f"Ambiguous instrument '{user_input}'. Matches: {conflict_names}")
-    else:
-        raise ValueError(f"Instrument '{user_input}' not found in DB.")
-        
-
-def _create_new_trade_in_db(user_id, instrument, direction, entry_price, open_time,
-                            exit_price=None, close_time=None, comment=None):
-    """
-    Пример внутренней функции, сохраняющей ОДНУ сделку в БД,
-    теперь с «поиском» инструмента по подстроке (case-insensitive).
-    """
-    # Вместо строгого filter_by(name=instrument), делаем простой partial match
-    instrument_record = _find_instrument_by_substring(instrument)
-
-    if direction not in ["Buy", "Sell"]:
-        raise ValueError(f"Direction must be 'Buy' or 'Sell', got '{direction}'.")
-
-    if entry_price <= 0:
-        raise ValueError(f"Entry price must be > 0, got {entry_price}.")
-
-    open_dt = parse_date_time(open_time)
-    close_dt = None
-    if close_time:
-        close_dt = parse_date_time(close_time)
-
-    trade = Trade(
-        user_id=user_id,
-        instrument_id=instrument_record.id,
-        direction=direction,
-        entry_price=entry_price,
-        trade_open_time=open_dt,
-        exit_price=exit_price if exit_price else None
-    )
-
-    if close_dt:
-        trade.trade_close_time = close_dt
-
-    if comment:
-        trade.comment = comment
-
-    # Если задан exit_price, считаем profit_loss
-    if trade.exit_price:
-        sign = 1 if trade.direction == 'Buy' else -1
-        trade.profit_loss = (trade.exit_price - trade.entry_price) * sign
-        trade.profit_loss_percentage = (trade.profit_loss / trade.entry_price) * 100
-    else:
-        trade.profit_loss = None
-        trade.profit_loss_percentage = None
-
-    db.session.add(trade)
-    return trade
-
-def check_duplicate_trade(user_id, instrument_str, direction_str, entry_price_val, open_time_str):
-    try:
-        instrument_obj = _find_instrument_by_substring(instrument_str)
-    except ValueError:
-        return False  # Или обработайте ошибку соответствующим образом
-
-    try:
-        open_dt = parse_date_time(open_time_str)
-    except ValueError:
-        return False
-
-    existing_trade = Trade.query.filter(
-        Trade.user_id == user_id,
-        Trade.instrument_id == instrument_obj.id,
-        Trade.direction == direction_str,
-        Trade.entry_price == entry_price_val,
-        Trade.trade_open_time == open_dt
-    ).first()
-
-    return existing_trade is not None
-
-def handle_create_trades(user_id, fn_args):
     trades = fn_args.get("trades", [])
     confirm = fn_args.get("confirm", False)
 
     if not trades:
         msg = "No trades provided."
-        session['chat_history'].append({'role': 'assistant', 'content': msg})
-        return jsonify({'response': msg}), 200
+        chat_history.append('assistant', msg)
+        return msg
 
-    if len(trades) > 5:
-        msg = "You are trying to create more than 5 trades in one request, which is not allowed."
-        session['chat_history'].append({'role': 'assistant', 'content': msg})
-        return jsonify({'response': msg}), 200
+    if len(trades) > MAX_CHAT_TRADES:
+        msg = f"You are trying to create more than {MAX_CHAT_TRADES} trades in one request, which is not allowed."
+        chat_history.append('assistant', msg)
+        return msg
 
     if not confirm:
         summary_lines = []
@@ -2014,49 +2109,19 @@ def handle_create_trades(user_id, fn_args):
             f"{summary_text}\n\n"
             "Please say 'confirm' or 'yes' to finalize, or 'no' to cancel."
         )
-        session['chat_history'].append({'role': 'assistant', 'content': answer})
-        return jsonify({"response": answer}), 200
+        chat_history.append('assistant', answer)
+        return answer
     else:
-        created_ids = []
-        duplicates_skipped = 0
         try:
-            for t in trades:
-                instrument_str = t["instrument"]
-                direction_str = t["direction"]
-                entry_price_val = t["entry_price"]
-                open_time_str = t["open_time"]
-                exit_price_val = t.get("exit_price")
-                close_time_str = t.get("close_time")
-                comment_str = t.get("comment")
-
-                if check_duplicate_trade(
-                    user_id,
-                    instrument_str,
-                    direction_str,
-                    entry_price_val,
-                    open_time_str
-                ):
-                    duplicates_skipped += 1
-                    continue
-
-                new_trade = _create_new_trade_in_db(
-                    user_id=user_id,
-                    instrument=instrument_str,
-                    direction=direction_str,
-                    entry_price=entry_price_val,
-                    open_time=open_time_str,
-                    exit_price=exit_price_val,
-                    close_time=close_time_str,
-                    comment=comment_str
-                )
-                db.session.flush()
-                created_ids.append(new_trade.id)
-
+            # Один проход по индексу инструментов, один запрос на дубликаты, один flush
+            result = bulk_create_trades(user_id, trades, return_ids=True, stop_on_error=True)
             db.session.commit()
 
             # После добавления сделок — очищаем историю, чтобы диалог закончился
-            session.pop('chat_history', None)
+            chat_history.clear()
 
+            created_ids = result.created_ids
+            duplicates_skipped = result.duplicates_skipped
             if created_ids:
                 text = f"Successfully created trades with IDs: {created_ids}"
                 if duplicates_skipped > 0:
@@ -2070,16 +2135,96 @@ def handle_create_trades(user_id, fn_args):
             # Дополнительная фраза (по желанию):
             text += "\n\nConversation ended. Chat history cleared."
 
-            return jsonify({"response": text}), 200
+            return text
 
         except Exception as e:
             db.session.rollback()
             error_text = f"Error creating trades: {str(e)}"
-            session['chat_history'].append({'role': 'assistant', 'content': error_text})
-            return jsonify({"response": error_text}), 200
+            chat_history.append('assistant', error_text)
+            return error_text
+
+@app.route('/import_trades', methods=['POST'])
+def import_trades():
+    """
+    Импорт журнала из CSV/JSON (файл в поле 'file' или JSON-тело {"trades": [...]}).
+    Использует тот же bulk-путь, что и create_trades, но с лимитом MAX_IMPORT_TRADES.
+    """
+    if 'user_id' not in session:
+        return jsonify({'error': 'Unauthorized'}), 401
+
+    user_id = session['user_id']
+    try:
+        upload = request.files.get('file')
+        if upload and upload.filename:
+            trades = parse_import_payload(upload.read(), upload.filename, upload.content_type)
+        else:
+            data = request.get_json(silent=True)
+            if data is None:
+                return jsonify({'error': 'No file or JSON body provided.'}), 400
+            trades = trades_from_json(data)
+    except (ValueError, UnicodeDecodeError) as e:
+        return jsonify({'error': f'Invalid import file: {e}'}), 400
+
+    if not trades:
+        return jsonify({'error': 'No trades found in import.'}), 400
+
+    max_import = app.config.get('MAX_IMPORT_TRADES', MAX_IMPORT_TRADES)
+    if len(trades) > max_import:
+        return jsonify({'error': f'Too many trades in one import (max {max_import}).'}), 400
+
+    try:
+        result = bulk_create_trades(user_id, trades, return_ids=False)
+        db.session.commit()
+    except Exception as e:
+        db.session.rollback()
+        logger.error(f"Error importing trades for user ID {user_id}: {e}")
+        logger.error(traceback.format_exc())
+        return jsonify({'error': 'An error occurred while importing trades.'}), 500
+
+    logger.info(f"User ID {user_id} imported {result.created} trades "
+                f"({result.duplicates_skipped} duplicates, {len(result.errors)} invalid).")
+    return jsonify({
+        'status': 'success',
+        'created': result.created,
+        'duplicates_skipped': result.duplicates_skipped,
+        'invalid': len(result.errors),
+        'errors': result.errors[:MAX_REPORTED_ERRORS]
+    }), 200
+
+@app.route('/export_trades', methods=['GET'])
+def export_trades():
+    """
+    Экспорт журнала пользователя: ?format=csv (по умолчанию, streaming) или ?format=parquet.
+    Строки читаются server-side курсором, инструмент/сетап/критерии подтягиваются в том же запросе.
+    """
+    if 'user_id' not in session:
+        return jsonify({'error': 'Unauthorized'}), 401
 
+    user_id = session['user_id']
+    export_format = request.args.get('format', 'csv').lower()
+    stamp = datetime.utcnow().strftime('%Y%m%d')
+
+    if export_format == 'csv':
+        logger.info(f"User ID {user_id} started CSV journal export.")
+        return Response(
+            stream_with_context(iter_journal_csv(user_id)),
+            mimetype='text/csv',
+            headers={'Content-Disposition': f'attachment; filename=trades_{stamp}.csv'}
+        )
+    elif export_format == 'parquet':
+        try:
+            parquet_file = write_journal_parquet(user_id)
+        except RuntimeError as e:
+            return jsonify({'error': str(e)}), 400
         except Exception as e:
-            db.session.rollback()
-            error_text = f"Error creating trades: {str(e)}"
-            session['chat_history'].append({'role': 'assistant', 'content': error_text})
-            return jsonify({"response": error_text}), 200
+            logger.error(f"Error exporting trades to Parquet for user ID {user_id}: {e}")
+            logger.error(traceback.format_exc())
+            return jsonify({'error': 'An error occurred while exporting trades.'}), 500
+        logger.info(f"User ID {user_id} exported journal to Parquet.")
+        return Response(
+            iter_file_chunks(parquet_file),
+            mimetype='application/vnd.apache.parquet',
+            headers={'Content-Disposition': f'attachment; filename=trades_{stamp}.parquet'}
+        )
+    else:
+        return jsonify({'error': "Unsupported format. Use 'csv' or 'parquet'."}), 400
@@ -1,5 +1,6 @@
 # routes_staking.py
 
+import asyncio
 import logging
 import traceback
 import os
@@ -11,10 +12,18 @@ import requests  # Импорт для работы с HTTP запросами
 
 from flask import Blueprint, request, jsonify, session, render_template, flash, redirect, url_for
 from flask_wtf.csrf import validate_csrf, CSRFError
-from web3 import Web3
+from async_io import AsyncRpc, http_client, run_sync
 from models import db, User, UserStaking
+from read_replica import replica_router
 from staking_logic import (
-    confirm_staking_tx,
+    Web3,
+    BASE_RPC_URL,
+    PSEUDO_ETH_ADDRESS,
+    allowance_async,
+    confirm_staking_tx_async,
+    get_balances_async,
+    token_balances_async,
+    token_decimals_async,
     get_token_balance,
     get_token_price_in_usd,
     get_token_decimals,  # Функция для получения decimals токена
@@ -23,10 +32,8 @@ from staking_logic import (
     weth_contract,
     ujo_contract,
     UJO_CONTRACT_ADDRESS,
-    TOKEN_CONTRACT_ADDRESS,
     WETH_CONTRACT_ADDRESS,
     PROJECT_WALLET_ADDRESS,
-    ERC20_ABI,
     get_balances,
     generate_unique_wallet,
     send_token_reward,
@@ -246,8 +253,49 @@ def subscription_page():
         return redirect(url_for('staking_bp.generate_unique_wallet_route'))
     return render_template('subscription.html', user=user)
 
+def _load_user(user_id):
+    # Для async-view: выполняется в потоке запроса через run_sync
+    return User.query.get(user_id)
+
+def get_token_address(symbol: str) -> str:
+    """
+    Адрес токена по символу (ETH обменивается как WETH).
+    """
+    symbol_upper = symbol.upper()
+    if symbol_upper == "ETH":
+        logger.info("Received ETH as source token – switching to WETH address for swap.")
+        return WETH_CONTRACT_ADDRESS
+    elif symbol_upper == "WETH":
+        return WETH_CONTRACT_ADDRESS
+    elif symbol_upper == "UJO":
+        return UJO_CONTRACT_ADDRESS
+    else:
+        return symbol
+
+def _approve_paraswap_proxy(contract, label, user_address, private_key, wait_receipt):
+    """
+    approve(max) для TokenTransferProxy ParaSwap raw-транзакцией, подписанной ключом пользователя.
+    """
+    max_allowance = 2**256 - 1
+    approve_tx = contract.functions.approve(
+        Web3.to_checksum_address(PARASWAP_PROXY_ADDRESS),
+        max_allowance
+    ).build_transaction({
+        "from": Web3.to_checksum_address(user_address),
+        "nonce": web3.eth.get_transaction_count(Web3.to_checksum_address(user_address), "pending"),
+        "gas": 100000,
+        "gasPrice": web3.to_wei(0.1, "gwei"),
+        "chainId": web3.eth.chain_id
+    })
+    logger.info(f"{label} approve transaction built: {approve_tx}")
+    signed_approve_tx = web3.eth.account.sign_transaction(approve_tx, private_key)
+    approve_tx_hash = web3.eth.send_raw_transaction(signed_approve_tx.rawTransaction)
+    logger.info(f"{label} approve transaction sent, tx_hash: {Web3.to_hex(approve_tx_hash)}")
+    if wait_receipt:
+        web3.eth.wait_for_transaction_receipt(approve_tx_hash, timeout=180)
+
 @staking_bp.route('/confirm', methods=['POST'])
-def confirm_staking():
+async def confirm_staking():
     try:
         csrf_token = request.headers.get('X-CSRFToken')
         if not csrf_token:
@@ -255,14 +303,15 @@ def confirm_staking():
         validate_csrf(csrf_token)
         if 'user_id' not in session:
             return jsonify({"error": "Unauthorized"}), 401
-        user = User.query.get(session['user_id'])
+        user = await run_sync(_load_user, session['user_id'])
         if not user:
             return jsonify({"error": "User not found."}), 404
         data = request.get_json() or {}
         tx_hash = data.get("txHash")
         if not tx_hash:
             return jsonify({"error": "No txHash provided"}), 400
-        ok = confirm_staking_tx(user, tx_hash)
+        async with http_client() as client:
+            ok = await confirm_staking_tx_async(AsyncRpc(client, BASE_RPC_URL), client, user, tx_hash)
         if ok:
             return jsonify({"status": "success"}), 200
         else:
@@ -274,6 +323,7 @@ def confirm_staking():
         return jsonify({"error": "Internal server error."}), 500
 
 @staking_bp.route('/api/get_user_stakes', methods=['GET'])
+@replica_router.read_only
 def get_user_stakes():
     if 'user_id' not in session:
         return jsonify({"error": "Unauthorized"}), 401
@@ -298,25 +348,28 @@ def get_user_stakes():
         return jsonify({"error": "Internal server error."}), 500
 
 @staking_bp.route('/api/get_balances', methods=['GET'])
-def get_balances_route():
+async def get_balances_route():
     if 'user_id' not in session:
         return jsonify({"error": "Unauthorized"}), 401
-    user = User.query.get(session['user_id'])
+    user = await run_sync(_load_user, session['user_id'])
     if not user or not user.unique_wallet_address:
         return jsonify({"error": "User not found or unique wallet not set."}), 404
-    result = get_balances(user)
+    async with http_client() as client:
+        result = await get_balances_async(AsyncRpc(client, BASE_RPC_URL), user.unique_wallet_address)
     if "error" in result:
         return jsonify({"error": result["error"]}), 500
     return jsonify(result), 200
 
 @staking_bp.route('/api/exchange_tokens', methods=['POST'])
-def exchange_tokens():
+async def exchange_tokens():
     """
     Обмен токенов через ParaSwap.
     Если в качестве исходного токена указан ETH, сначала оборачиваем ETH в WETH.
     Если целевой токен равен ETH и исходный – WETH, выполняется операция unwrap (WETH -> ETH).
     Если обмен осуществляется с UJO, проверяется allowance для TokenTransferProxy.
     Также, если обмен производится из ETH в WETH, повторное оборачивание не выполняется.
+    Чтения (балансы, allowance) идут пакетами JSON-RPC, транзакции подписываются
+    и отправляются синхронным web3 в потоке запроса.
     """
     try:
         logger.info("=== exchange_tokens START ===")
@@ -328,10 +381,12 @@ def exchange_tokens():
         if 'user_id' not in session:
             logger.error("Unauthorized access in exchange_tokens.")
             return jsonify({"error": "Unauthorized"}), 401
-        user = User.query.get(session['user_id'])
+        user = await run_sync(_load_user, session['user_id'])
         if not user or not user.unique_wallet_address:
             logger.error("User not found or unique wallet not set in exchange_tokens.")
             return jsonify({"error": "User not found or unique wallet not set."}), 404
+        wallet = user.unique_wallet_address
+        private_key = user.unique_private_key
         data = request.get_json() or {}
         from_token_symbol = data.get("from_token")
         to_token_symbol = data.get("to_token")
@@ -347,184 +402,125 @@ def exchange_tokens():
             logger.error(f"Invalid from_amount value: {from_amount}")
             return jsonify({"error": "Invalid value for from_amount."}), 400
 
-        # Функция для определения адреса токена по символу.
-        def get_token_address(symbol: str) -> str:
-            symbol_upper = symbol.upper()
-            if symbol_upper == "ETH":
-                logger.info("Received ETH as source token – switching to WETH address for swap.")
-                return WETH_CONTRACT_ADDRESS
-            elif symbol_upper == "WETH":
-                return WETH_CONTRACT_ADDRESS
-            elif symbol_upper == "UJO":
-                return UJO_CONTRACT_ADDRESS
+        async with http_client() as client:
+            rpc = AsyncRpc(client, BASE_RPC_URL)
+
+            # Если исходный токен указан как ETH, оборачиваем его в WETH (но не если уже достаточно WETH)
+            if from_token_symbol.upper() == "ETH":
+                logger.info("Detected ETH as source token. Initiating wrapping (deposit) to WETH.")
+                eth_balance, current_weth = await token_balances_async(
+                    rpc, wallet, [PSEUDO_ETH_ADDRESS, WETH_CONTRACT_ADDRESS]
+                )
+                logger.info(f"User ETH balance: {eth_balance} ETH")
+                if eth_balance < from_amount:
+                    logger.error("Insufficient ETH balance for wrapping.")
+                    return jsonify({"error": "Insufficient ETH balance for wrapping."}), 400
+                if current_weth < from_amount:
+                    wrap_success = await run_sync(deposit_eth_to_weth, private_key, wallet, from_amount)
+                    if not wrap_success:
+                        logger.error("Failed to wrap ETH to WETH.")
+                        return jsonify({"error": "Failed to wrap ETH to WETH."}), 400
+                    else:
+                        logger.info("Successfully wrapped ETH to WETH.")
+                if to_token_symbol.upper() == "WETH":
+                    logger.info("Exchange ETH to WETH requested; deposit operation completed, returning balances.")
+                    result = await get_balances_async(rpc, wallet)
+                    return jsonify({"status": "success", "balances": result["balances"]}), 200
+                effective_from_token = "WETH"
             else:
-                return symbol
-
-        # Если исходный токен указан как ETH, оборачиваем его в WETH (но не если уже достаточно WETH)
-        if from_token_symbol.upper() == "ETH":
-            logger.info("Detected ETH as source token. Initiating wrapping (deposit) to WETH.")
-            eth_balance = float(Web3.from_wei(web3.eth.get_balance(user.unique_wallet_address), 'ether'))
-            logger.info(f"User ETH balance: {eth_balance} ETH")
-            if eth_balance < from_amount:
-                logger.error("Insufficient ETH balance for wrapping.")
-                return jsonify({"error": "Insufficient ETH balance for wrapping."}), 400
-            current_weth = get_token_balance(user.unique_wallet_address, weth_contract)
-            if current_weth < from_amount:
-                wrap_success = deposit_eth_to_weth(user.unique_private_key, user.unique_wallet_address, from_amount)
-                if not wrap_success:
-                    logger.error("Failed to wrap ETH to WETH.")
-                    return jsonify({"error": "Failed to wrap ETH to WETH."}), 400
+                effective_from_token = from_token_symbol
+
+            # Если обмен WETH -> ETH, выполняем операцию unwrap
+            if effective_from_token.upper() == "WETH" and to_token_symbol.upper() == "ETH":
+                logger.info("Exchange WETH to ETH requested; initiating unwrap process.")
+                current_weth, = await token_balances_async(rpc, wallet, [WETH_CONTRACT_ADDRESS])
+                if current_weth < from_amount - 1e-12:
+                    logger.error("Insufficient WETH balance for unwrap.")
+                    return jsonify({"error": "Insufficient WETH balance for unwrap."}), 400
+                unwrap_success = await run_sync(unwrap_weth_to_eth, private_key, wallet, from_amount)
+                if unwrap_success:
+                    logger.info("Successfully unwrapped WETH to ETH.")
+                    result = await get_balances_async(rpc, wallet)
+                    return jsonify({"status": "success", "balances": result["balances"]}), 200
                 else:
-                    logger.info("Successfully wrapped ETH to WETH.")
-            if to_token_symbol.upper() == "WETH":
-                logger.info("Exchange ETH to WETH requested; deposit operation completed, returning balances.")
-                result = get_balances(user)
-                return jsonify({"status": "success", "balances": result["balances"]}), 200
-            effective_from_token = "WETH"
-        else:
-            effective_from_token = from_token_symbol
-
-        # Если обмен WETH -> ETH, выполняем операцию unwrap
-        if effective_from_token.upper() == "WETH" and to_token_symbol.upper() == "ETH":
-            logger.info("Exchange WETH to ETH requested; initiating unwrap process.")
-            current_weth = get_token_balance(user.unique_wallet_address, weth_contract)
-            if current_weth < from_amount - 1e-12:
-                logger.error("Insufficient WETH balance for unwrap.")
-                return jsonify({"error": "Insufficient WETH balance for unwrap."}), 400
-            unwrap_success = unwrap_weth_to_eth(user.unique_private_key, user.unique_wallet_address, from_amount)
-            if unwrap_success:
-                logger.info("Successfully unwrapped WETH to ETH.")
-                result = get_balances(user)
-                return jsonify({"status": "success", "balances": result["balances"]}), 200
-            else:
-                logger.error("Error executing unwrap (WETH to ETH).")
-                return jsonify({"error": "Error executing unwrap (WETH to ETH)."}), 400
-
-        # Если источник UJO, проверяем allowance для TokenTransferProxy
-        if effective_from_token.upper() == "UJO":
-            allowance = token_contract.functions.allowance(
-                Web3.to_checksum_address(user.unique_wallet_address),
-                Web3.to_checksum_address(PARASWAP_PROXY_ADDRESS)
-            ).call()
-            logger.info(f"Current UJO allowance for proxy {PARASWAP_PROXY_ADDRESS}: {allowance}")
-            required_amount = int(from_amount * 10 ** get_token_decimals(UJO_CONTRACT_ADDRESS))
-            if allowance < required_amount:
-                logger.info("Allowance insufficient for UJO, initiating approve transaction.")
-                max_allowance = 2**256 - 1
-                approve_tx = token_contract.functions.approve(
-                    Web3.to_checksum_address(PARASWAP_PROXY_ADDRESS),
-                    max_allowance
-                ).build_transaction({
-                    "from": Web3.to_checksum_address(user.unique_wallet_address),
-                    "nonce": web3.eth.get_transaction_count(Web3.to_checksum_address(user.unique_wallet_address), "pending"),
-                    "gas": 100000,
-                    "gasPrice": web3.to_wei(0.1, "gwei"),
-                    "chainId": web3.eth.chain_id
-                })
-                logger.info(f"UJO approve transaction built: {approve_tx}")
-                signed_approve_tx = web3.eth.account.sign_transaction(approve_tx, user.unique_private_key)
-                approve_tx_hash = web3.eth.send_raw_transaction(signed_approve_tx.rawTransaction)
-                logger.info(f"UJO approve transaction sent, tx_hash: {Web3.to_hex(approve_tx_hash)}")
-                web3.eth.wait_for_transaction_receipt(approve_tx_hash, timeout=180)
-        # Если источник WETH, проверяем allowance
-        if effective_from_token.upper() == "WETH":
-            allowance = weth_contract.functions.allowance(
-                Web3.to_checksum_address(user.unique_wallet_address),
-                Web3.to_checksum_address(PARASWAP_PROXY_ADDRESS)
-            ).call()
-            logger.info(f"Current WETH allowance for proxy {PARASWAP_PROXY_ADDRESS}: {allowance}")
-            required_amount = int(from_amount * 10 ** get_token_decimals(WETH_CONTRACT_ADDRESS))
-            if allowance < required_amount:
-                logger.info("Allowance insufficient, initiating approve transaction using raw signed transaction.")
-                max_allowance = 2**256 - 1
-                approve_tx = weth_contract.functions.approve(
-                    Web3.to_checksum_address(PARASWAP_PROXY_ADDRESS),
-                    max_allowance
-                ).build_transaction({
-                    "from": Web3.to_checksum_address(user.unique_wallet_address),
-                    "nonce": web3.eth.get_transaction_count(Web3.to_checksum_address(user.unique_wallet_address), "pending"),
-                    "gas": 100000,
-                    "gasPrice": web3.to_wei(0.1, "gwei"),
-                    "chainId": web3.eth.chain_id
-                })
-                logger.info(f"Approve transaction built: {approve_tx}")
-                signed_approve_tx = web3.eth.account.sign_transaction(approve_tx, user.unique_private_key)
-                approve_tx_hash = web3.eth.send_raw_transaction(signed_approve_tx.rawTransaction)
-                logger.info(f"Approve transaction sent, tx_hash: {Web3.to_hex(approve_tx_hash)}")
-            else:
-                logger.info("Sufficient allowance exists for WETH.")
+                    logger.error("Error executing unwrap (WETH to ETH).")
+                    return jsonify({"error": "Error executing unwrap (WETH to ETH)."}), 400
+
+            # Если источник UJO или WETH, проверяем allowance для TokenTransferProxy
+            approvals = {
+                "UJO": (token_contract, UJO_CONTRACT_ADDRESS, True),
+                "WETH": (weth_contract, WETH_CONTRACT_ADDRESS, False),
+            }
+            if effective_from_token.upper() in approvals:
+                label = effective_from_token.upper()
+                contract, token_address, wait_receipt = approvals[label]
+                allowance, decimals = await asyncio.gather(
+                    allowance_async(rpc, token_address, wallet, PARASWAP_PROXY_ADDRESS),
+                    token_decimals_async(rpc, token_address),
+                )
+                logger.info(f"Current {label} allowance for proxy {PARASWAP_PROXY_ADDRESS}: {allowance}")
+                required_amount = int(from_amount * 10 ** decimals)
+                if allowance < required_amount:
+                    logger.info(f"Allowance insufficient for {label}, initiating approve transaction.")
+                    await run_sync(_approve_paraswap_proxy, contract, label, wallet, private_key, wait_receipt)
+                else:
+                    logger.info(f"Sufficient allowance exists for {label}.")
 
-        # Выполнение обмена через ParaSwap
-        sell_token = get_token_address(effective_from_token)
-        buy_token = get_token_address(to_token_symbol)
-        logger.info(f"Exchange: {from_amount} {from_token_symbol} (using {sell_token}) -> {to_token_symbol} ({buy_token})")
+            # Выполнение обмена через ParaSwap
+            sell_token = get_token_address(effective_from_token)
+            buy_token = get_token_address(to_token_symbol)
+            logger.info(f"Exchange: {from_amount} {from_token_symbol} (using {sell_token}) -> {to_token_symbol} ({buy_token})")
 
-        # Проверка баланса пользователя для исходного токена
-        if effective_from_token.upper() == "WETH":
-            user_balance = get_token_balance(user.unique_wallet_address, weth_contract)
-            logger.info(f"User WETH balance: {user_balance}")
-            if user_balance < from_amount:
-                logger.error("Insufficient WETH for exchange.")
-                return jsonify({"error": "Insufficient WETH for exchange."}), 400
-        else:
-            if sell_token.lower() == TOKEN_CONTRACT_ADDRESS.lower():
-                sell_contract = token_contract
-            elif sell_token.lower() == WETH_CONTRACT_ADDRESS.lower():
-                sell_contract = weth_contract
-            elif sell_token.lower() == UJO_CONTRACT_ADDRESS.lower():
-                sell_contract = ujo_contract
-            else:
-                sell_contract = web3.eth.contract(
-                    address=Web3.to_checksum_address(sell_token),
-                    abi=ERC20_ABI
-                )
-            user_balance = get_token_balance(user.unique_wallet_address, sell_contract)
+            # Проверка баланса пользователя для исходного токена
+            user_balance, = await token_balances_async(rpc, wallet, [sell_token])
             logger.info(f"User {effective_from_token} balance: {user_balance}")
             if user_balance < from_amount:
                 logger.error(f"Insufficient {effective_from_token} for exchange.")
                 return jsonify({"error": f"Insufficient {effective_from_token} for exchange."}), 400
 
-        swap_ok = swap_tokens_via_paraswap(
-            user.unique_private_key,
-            sell_token,
-            buy_token,
-            from_amount,
-            user.unique_wallet_address
-        )
-        if not swap_ok:
-            logger.error("Error executing exchange via ParaSwap.")
-            return jsonify({"error": "Error executing exchange via ParaSwap."}), 400
-
-        result = get_balances(user)
-        if "error" in result:
-            logger.error(f"Error in get_balances: {result['error']}")
-            return jsonify({"error": result["error"]}), 500
-
-        logger.info(f"Successful exchange: {from_token_symbol} -> {to_token_symbol}, amount: {from_amount}")
-
-        # ============== ДОБАВЛЯЕМ БЛОК ДЛЯ UNWRAP ==============
-        if to_token_symbol.upper() == "ETH":
-            # Проверим, остался ли у пользователя баланс WETH, который нужно "развернуть" в ETH
-            w_balance = get_token_balance(user.unique_wallet_address, weth_contract)
-            if w_balance > 0.0000001:  # минимущее число, чтобы не пытаться анроллить пыль
-                logger.info(f"User requested ETH, but ended with {w_balance} WETH. Unwrapping now...")
-                unwrap_success = unwrap_weth_to_eth(
-                    user.unique_private_key,
-                    user.unique_wallet_address,
-                    w_balance  # Разворачиваем всё, чтобы остался только ETH
-                )
-                if not unwrap_success:
-                    logger.error("Auto-unwrap after swap failed.")
-                    # Можно вернуть ошибку или просто продолжить. В примере продолжаем.
-                else:
-                    logger.info("Auto-unwrap WETH->ETH succeeded.")
-                    # После unwrap обновим балансы
-                    result = get_balances(user)
-                    if "error" in result:
-                        logger.error(f"Error in get_balances after unwrap: {result['error']}")
-                        return jsonify({"error": result["error"]}), 500
-    # ============== КОНЕЦ БЛОКА UNWRAP ==============
-        
+            swap_ok = await run_sync(
+                swap_tokens_via_paraswap,
+                private_key,
+                sell_token,
+                buy_token,
+                from_amount,
+                wallet
+            )
+            if not swap_ok:
+                logger.error("Error executing exchange via ParaSwap.")
+                return jsonify({"error": "Error executing exchange via ParaSwap."}), 400
+
+            result = await get_balances_async(rpc, wallet)
+            if "error" in result:
+                logger.error(f"Error in get_balances: {result['error']}")
+                return jsonify({"error": result["error"]}), 500
+
+            logger.info(f"Successful exchange: {from_token_symbol} -> {to_token_symbol}, amount: {from_amount}")
+
+            # ============== ДОБАВЛЯЕМ БЛОК ДЛЯ UNWRAP ==============
+            if to_token_symbol.upper() == "ETH":
+                # Проверим, остался ли у пользователя баланс WETH, который нужно "развернуть" в ETH
+                w_balance, = await token_balances_async(rpc, wallet, [WETH_CONTRACT_ADDRESS])
+                if w_balance > 0.0000001:  # минимущее число, чтобы не пытаться анроллить пыль
+                    logger.info(f"User requested ETH, but ended with {w_balance} WETH. Unwrapping now...")
+                    unwrap_success = await run_sync(
+                        unwrap_weth_to_eth,
+                        private_key,
+                        wallet,
+                        w_balance  # Разворачиваем всё, чтобы остался только ETH
+                    )
+                    if not unwrap_success:
+                        logger.error("Auto-unwrap after swap failed.")
+                        # Можно вернуть ошибку или просто продолжить. В примере продолжаем.
+                    else:
+                        logger.info("Auto-unwrap WETH->ETH succeeded.")
+                        # После unwrap обновим балансы
+                        result = await get_balances_async(rpc, wallet)
+                        if "error" in result:
+                            logger.error(f"Error in get_balances after unwrap: {result['error']}")
+                            return jsonify({"error": result["error"]}), 500
+            # ============== КОНЕЦ БЛОКА UNWRAP ==============
+
         logger.info("=== exchange_tokens END ===")
         return jsonify({
             "status": "success",
@@ -1,30 +1,44 @@
 # staking_logic.py
 
 import os
+import asyncio
 import logging
 import math
 from datetime import datetime, timedelta
 import requests
 import secrets
+import re
 import string
-import sys
 import json
 
-from web3.exceptions import ContractCustomError
-from web3 import Web3
-from eth_account import Account
-
+from async_io import run_sync
+from lazy_imports import LazyObject, lazy_attribute
 from models import db, User, UserStaking
 
 logger = logging.getLogger(__name__)
 
+# web3 / eth_account загружаются при первом обращении, подключение к RPC —
+# при первом вызове, которому нужна сеть (а не при импорте модуля)
+Web3 = lazy_attribute('web3', 'Web3')
+Account = lazy_attribute('eth_account', 'Account')
+
 # Обновленный RPC URL
 BASE_RPC_URL = os.environ.get("BASE_RPC_URL", "https://base-mainnet.public.blastapi.io")
-web3 = Web3(Web3.HTTPProvider(BASE_RPC_URL))
+# Пауза перед повторной попыткой подключения после неудачи (секунды)
+RPC_RETRY_SECONDS = float(os.environ.get("RPC_RETRY_SECONDS", "30"))
+ADDRESS_RE = re.compile(r'^0x[0-9a-fA-F]{40}$')
+
+
+def _connect_web3():
+    client = Web3(Web3.HTTPProvider(BASE_RPC_URL))
+    if not client.is_connected():
+        logger.error("Не удалось подключиться к RPC сети Base.")
+        raise ConnectionError(f"RPC {BASE_RPC_URL} is not reachable.")
+    logger.info("Подключено к RPC сети Base.")
+    return client
+
 
-if not web3.is_connected():
-    logger.error("Не удалось подключиться к RPC сети Base.")
-    sys.exit(1)
+web3 = LazyObject(_connect_web3, 'web3 (Base RPC)', retry_seconds=RPC_RETRY_SECONDS)
 
 # Переменные окружения для сети Base
 TOKEN_CONTRACT_ADDRESS = os.environ.get("TOKEN_CONTRACT_ADDRESS", "0xYOUR_TOKEN_CONTRACT_ADDRESS")
@@ -53,12 +67,14 @@ if missing_vars:
     logger.error(f"Отсутствуют необходимые переменные окружения: {', '.join(missing_vars)}")
     raise ValueError(f"Отсутствуют необходимые переменные окружения: {', '.join(missing_vars)}")
 
-try:
-    ONEINCH_ROUTER_ADDRESS = Web3.to_checksum_address(ONEINCH_ROUTER_ADDRESS)
-    logger.info(f"ONEINCH_ROUTER_ADDRESS установлен на: {ONEINCH_ROUTER_ADDRESS}")
-except Exception as e:
-    logger.error(f"Invalid ONEINCH_ROUTER_ADDRESS: {ONEINCH_ROUTER_ADDRESS}. Error: {e}")
-    raise ValueError(f"Invalid ONEINCH_ROUTER_ADDRESS: {ONEINCH_ROUTER_ADDRESS}. Error: {e}")
+# Формат проверяется при старте, checksum-адрес вычисляется при первом использовании
+if not ADDRESS_RE.match(ONEINCH_ROUTER_ADDRESS):
+    logger.error(f"Invalid ONEINCH_ROUTER_ADDRESS: {ONEINCH_ROUTER_ADDRESS}.")
+    raise ValueError(f"Invalid ONEINCH_ROUTER_ADDRESS: {ONEINCH_ROUTER_ADDRESS}.")
+
+
+def oneinch_router_address():
+    return Web3.to_checksum_address(ONEINCH_ROUTER_ADDRESS)
 
 # ERC20 ABI
 ERC20_ABI = [
@@ -108,37 +124,55 @@ ERC20_ABI = [
     },
 ]
 
-try:
-    token_contract = web3.eth.contract(
-        address=Web3.to_checksum_address(TOKEN_CONTRACT_ADDRESS),
-        abi=ERC20_ABI
-    )
-    # Обновлённый ABI для WETH: функция withdraw теперь принимает аргумент "wad"
-    weth_contract = web3.eth.contract(
-        address=Web3.to_checksum_address(WETH_CONTRACT_ADDRESS),
-        abi=ERC20_ABI + [
-            {
-                "constant": False,
-                "inputs": [],
-                "name": "deposit",
-                "outputs": [],
-                "payable": True,
-                "type": "function"
-            },
-            {
-                "constant": False,
-                "inputs": [{"name": "wad", "type": "uint256"}],
-                "name": "withdraw",
-                "outputs": [],
-                "type": "function"
-            },
-        ]
-    )
-    ujo_contract = token_contract
-    logger.info("Контракты успешно инициализированы.")
-except Exception as e:
-    logger.error(f"Ошибка инициализации контрактов: {e}", exc_info=True)
-    sys.exit(1)
+# Обновлённый ABI для WETH: функция withdraw теперь принимает аргумент "wad"
+WETH_ABI = ERC20_ABI + [
+    {
+        "constant": False,
+        "inputs": [],
+        "name": "deposit",
+        "outputs": [],
+        "payable": True,
+        "type": "function"
+    },
+    {
+        "constant": False,
+        "inputs": [{"name": "wad", "type": "uint256"}],
+        "name": "withdraw",
+        "outputs": [],
+        "type": "function"
+    },
+]
+
+PSEUDO_ETH_ADDRESS = "0xeeeeeeeeeeeeeeeeeeeeeeeeeeeeeeeeeeeeeeee"
+# keccak("Transfer(address,address,uint256)")
+TRANSFER_TOPIC = "0xddf252ad1be2c89b69c2b068fc378daa952ba7f163c4a11628f55a4df523b3ef"
+# Селекторы ERC20 для eth_call без web3 (async-версии функций ниже)
+BALANCE_OF_SELECTOR = "0x70a08231"
+DECIMALS_SELECTOR = "0x313ce567"
+ALLOWANCE_SELECTOR = "0xdd62ed3e"
+
+# decimals токена не меняется: адрес (в нижнем регистре) -> decimals
+_decimals_cache = {}
+
+
+def _contract_factory(address, abi, label):
+    def create():
+        try:
+            contract = web3.eth.contract(address=Web3.to_checksum_address(address), abi=abi)
+        except Exception as e:
+            logger.error(f"Ошибка инициализации контракта {label}: {e}", exc_info=True)
+            raise
+        logger.info(f"Контракт {label} инициализирован.")
+        return contract
+    return create
+
+
+# Контракты создаются при первом использовании (после подключения к RPC)
+token_contract = LazyObject(_contract_factory(TOKEN_CONTRACT_ADDRESS, ERC20_ABI, 'UJO'), 'token_contract',
+                            retry_seconds=RPC_RETRY_SECONDS)
+weth_contract = LazyObject(_contract_factory(WETH_CONTRACT_ADDRESS, WETH_ABI, 'WETH'), 'weth_contract',
+                           retry_seconds=RPC_RETRY_SECONDS)
+ujo_contract = token_contract
 
 def generate_unique_wallet():
     while True:
@@ -169,10 +203,14 @@ def get_token_decimals(token_address: str) -> int:
     Для pseudo-ETH 0xEe... => 18.
     """
     try:
-        if token_address.lower() == "0xeeeeeeeeeeeeeeeeeeeeeeeeeeeeeeeeeeeeeeee":
+        if token_address.lower() == PSEUDO_ETH_ADDRESS:
             return 18
+        cached = _decimals_cache.get(token_address.lower())
+        if cached is not None:
+            return cached
         tmp = web3.eth.contract(address=Web3.to_checksum_address(token_address), abi=ERC20_ABI)
         decimals = tmp.functions.decimals().call()
+        _decimals_cache[token_address.lower()] = decimals
         logger.info(f"Token {token_address} has {decimals} decimals.")
         return decimals
     except Exception as e:
@@ -372,6 +410,35 @@ def get_balances(user: User) -> dict:
         logger.error(f"get_balances error: {e}", exc_info=True)
         return {"balances": {"eth": 0, "weth": 0, "ujo": 0}}
 
+# Версия API GeckoTerminal указывается через заголовок
+GECKO_HEADERS = {
+    "Accept": "application/json;version=20230302"
+}
+
+
+def _gecko_price_url(pair_address: str) -> str:
+    return (
+        f"https://api.geckoterminal.com/api/v2/simple/networks/base/"
+        f"token_price/{pair_address}?include_market_cap=false&include_24hr_vol=false"
+    )
+
+
+def _parse_gecko_price(data: dict, pair_address: str) -> float:
+    # Из структуры ответа нам нужно добраться до:
+    # data -> attributes -> token_prices -> ["<address>"]
+    attributes = data.get("data", {}).get("attributes", {})
+    token_prices = attributes.get("token_prices", {})
+
+    # Попробуем взять цену по адресу (в нижнем регистре)
+    price_str = token_prices.get(pair_address.lower())
+    if not price_str:
+        logger.warning("Цена USD не найдена в ответе GeckoTerminal.")
+        return 0.0
+
+    logger.info(f"Цена UJO: {price_str} USD")
+    return float(price_str)
+
+
 def get_token_price_in_usd() -> float:
     """
     Запрашиваем цену токена с GeckoTerminal. Если не удалось — вернём 0.0
@@ -382,37 +449,11 @@ def get_token_price_in_usd() -> float:
             logger.error("DEXScreener_PAIR_ADDRESS (адрес токена) не задан.")
             return 0.0
 
-        # Формируем URL для GeckoTerminal:
-        api_url = (
-            f"https://api.geckoterminal.com/api/v2/simple/networks/base/"
-            f"token_price/{pair_address}?include_market_cap=false&include_24hr_vol=false"
-        )
-
-        # Укажем версию API через заголовок
-        headers = {
-            "Accept": "application/json;version=20230302"
-        }
-
-        # Делаем GET-запрос
-        resp = requests.get(api_url, headers=headers, timeout=10)
+        resp = requests.get(_gecko_price_url(pair_address), headers=GECKO_HEADERS, timeout=10)
         if resp.status_code != 200:
             logger.error(f"GeckoTerminal code={resp.status_code}")
             return 0.0
-
-        data = resp.json()
-        # Из структуры ответа нам нужно добраться до:
-        # data -> attributes -> token_prices -> ["<address>"]
-        attributes = data.get("data", {}).get("attributes", {})
-        token_prices = attributes.get("token_prices", {})
-
-        # Попробуем взять цену по адресу (в нижнем регистре)
-        price_str = token_prices.get(pair_address.lower())
-        if not price_str:
-            logger.warning("Цена USD не найдена в ответе GeckoTerminal.")
-            return 0.0
-
-        logger.info(f"Цена UJO: {price_str} USD")
-        return float(price_str)
+        return _parse_gecko_price(resp.json(), pair_address)
 
     except Exception as e:
         logger.error(f"get_token_price_in_usd: {e}", exc_info=True)
@@ -471,9 +512,10 @@ def swap_tokens_via_1inch(user_private_key: str, from_token: str, to_token: str,
             decimals = from_token_contract.functions.decimals().call()
             amount_in = int(amount * (10**decimals))
 
-            curr_allow = from_token_contract.functions.allowance(user_address, ONEINCH_ROUTER_ADDRESS).call()
+            router_address = oneinch_router_address()
+            curr_allow = from_token_contract.functions.allowance(user_address, router_address).call()
             if curr_allow < amount_in:
-                if not approve_token(user_private_key, from_token_contract, ONEINCH_ROUTER_ADDRESS, amount_in):
+                if not approve_token(user_private_key, from_token_contract, router_address, amount_in):
                     return False
 
         headers = {
@@ -532,53 +574,40 @@ def swap_tokens_via_1inch(user_private_key: str, from_token: str, to_token: str,
         logger.error("[swap_tokens_via_1inch] except", exc_info=True)
         return False
 
-def confirm_staking_tx(user: User, tx_hash: str) -> bool:
+def _hex(value) -> str:
+    # Лог из web3 (HexBytes) или из ответа JSON-RPC (строка '0x...')
+    return value.lower() if isinstance(value, str) else '0x' + bytes(value).hex()
+
+
+def _find_staking_transfer(logs, wallet_address: str, price_usd: float, token_decimals: int):
     """
-    Если транзакция >= 25$ => создаём запись в UserStaking + assistant_premium = True.
-    (В ТЕСТЕ: >= 0.5$)
-    
-    Но ВНИМАНИЕ! Если пользователь отправляет UJO => проекту,
-    тогда мы ищем from_addr == user.unique_wallet_address 
-                 and to_addr   == PROJECT_WALLET_ADDRESS.
+    Ищем в логах транзакции Transfer UJO user -> проект на сумму >= 0.5$ (или 25$).
+    """
+    for lg in logs:
+        if lg['address'].lower() != TOKEN_CONTRACT_ADDRESS.lower():
+            continue
+        topics = [_hex(topic) for topic in lg['topics']]
+        if len(topics) >= 3 and topics[0] == TRANSFER_TOPIC:
+            from_addr = "0x" + topics[1][26:]
+            to_addr = "0x" + topics[2][26:]
+
+            # Ищем именно user -> project (в тесте 0.5$, в основном 25$).
+            if from_addr.lower() == wallet_address.lower() and \
+               to_addr.lower() == PROJECT_WALLET_ADDRESS.lower():
+                amt_int = int(_hex(lg['data']), 16)
+                token_amt = amt_int / (10**token_decimals)
+                usd_amt = token_amt * price_usd
+                logger.info(f"[confirm_staking_tx] found {token_amt} UJO => ~{usd_amt} USD")
+                if usd_amt >= 0.5:  # или 25
+                    return {"token_amount": token_amt, "usd_amount": usd_amt}
+    return None
+
+
+def _record_staking(user: User, tx_hash: str, found: dict) -> bool:
+    """
+    Создаём запись UserStaking и включаем premium (если tx ещё не учтена).
     """
-    if not user or not tx_hash:
-        return False
     try:
-        receipt = web3.eth.get_transaction_receipt(tx_hash)
-        if not receipt or receipt.status != 1:
-            logger.error(f"Tx not found or fail: {tx_hash}")
-            return False
-
-        transfer_topic = Web3.keccak(text="Transfer(address,address,uint256)").hex()
-        price_usd = get_token_price_in_usd()
-        if price_usd <= 0:
-            return False
-
-        found = None
-        for lg in receipt.logs:
-            if lg.address.lower() == token_contract.address.lower():
-                if len(lg.topics) >= 3 and lg.topics[0].hex().lower() == transfer_topic.lower():
-                    from_addr = "0x" + lg.topics[1].hex()[26:]
-                    to_addr = "0x" + lg.topics[2].hex()[26:]
-                    from_addr = Web3.to_checksum_address(from_addr)
-                    to_addr = Web3.to_checksum_address(to_addr)
-
-                    # Ищем именно user -> project (в тесте 0.5$, в основном 25$).
-                    if from_addr.lower() == user.unique_wallet_address.lower() and \
-                       to_addr.lower() == PROJECT_WALLET_ADDRESS.lower():
-                        amt_int = int(lg.data, 16)
-                        token_decimals = get_token_decimals(token_contract.address)
-                        token_amt = amt_int / (10**token_decimals)
-                        usd_amt = token_amt * price_usd
-                        logger.info(f"[confirm_staking_tx] found {token_amt} UJO => ~{usd_amt} USD")
-                        if usd_amt >= 0.5:  # или 25
-                            found = {"token_amount": token_amt, "usd_amount": usd_amt}
-                            break
-
-        if not found:
-            logger.warning("Not found an appropriate Transfer in logs.")
-            return False
-
         # Проверка на дубликат
         ex = UserStaking.query.filter_by(tx_hash=tx_hash).first()
         if ex:
@@ -604,12 +633,161 @@ def confirm_staking_tx(user: User, tx_hash: str) -> bool:
 
         logger.info(f"User {user.id}: staked ~{found['usd_amount']:.2f}$ => premium ON.")
         return True
+    except Exception as e:
+        db.session.rollback()
+        logger.error(f"[confirm_staking_tx] except: {e}", exc_info=True)
+        return False
+
+
+def confirm_staking_tx(user: User, tx_hash: str) -> bool:
+    """
+    Если транзакция >= 25$ => создаём запись в UserStaking + assistant_premium = True.
+    (В ТЕСТЕ: >= 0.5$)
+    
+    Но ВНИМАНИЕ! Если пользователь отправляет UJO => проекту,
+    тогда мы ищем from_addr == user.unique_wallet_address 
+                 and to_addr   == PROJECT_WALLET_ADDRESS.
+    """
+    if not user or not tx_hash:
+        return False
+    try:
+        receipt = web3.eth.get_transaction_receipt(tx_hash)
+        if not receipt or receipt.status != 1:
+            logger.error(f"Tx not found or fail: {tx_hash}")
+            return False
+
+        price_usd = get_token_price_in_usd()
+        if price_usd <= 0:
+            return False
+
+        found = _find_staking_transfer(
+            receipt.logs, user.unique_wallet_address, price_usd, get_token_decimals(TOKEN_CONTRACT_ADDRESS)
+        )
+        if not found:
+            logger.warning("Not found an appropriate Transfer in logs.")
+            return False
+
+        return _record_staking(user, tx_hash, found)
 
     except Exception as e:
         db.session.rollback()
         logger.error(f"[confirm_staking_tx] except: {e}", exc_info=True)
         return False
 
+##################################################
+# Async-версии для async-view (async_io.py): чтения идут одним пакетом
+# JSON-RPC / параллельно, БД — через run_sync в потоке запроса
+##################################################
+
+def _abi_address(address: str) -> str:
+    return address.lower().replace('0x', '', 1).rjust(64, '0')
+
+
+def _balance_call(token: str, owner: str):
+    if token == PSEUDO_ETH_ADDRESS:
+        return ('eth_getBalance', [owner, 'latest'])
+    return ('eth_call', [{'to': token, 'data': BALANCE_OF_SELECTOR + _abi_address(owner)}, 'latest'])
+
+
+async def token_balances_async(rpc, owner: str, tokens) -> list:
+    """
+    Балансы owner по токенам (PSEUDO_ETH_ADDRESS — ETH) одним пакетом JSON-RPC;
+    decimals запрашиваются только для токенов, которых ещё нет в кэше.
+    """
+    tokens = [token.lower() for token in tokens]
+    missing = [token for token in dict.fromkeys(tokens)
+               if token != PSEUDO_ETH_ADDRESS and token not in _decimals_cache]
+    calls = [_balance_call(token, owner) for token in tokens]
+    calls += [('eth_call', [{'to': token, 'data': DECIMALS_SELECTOR}, 'latest']) for token in missing]
+    results = await rpc.batch(calls)
+    for token, raw in zip(missing, results[len(tokens):]):
+        _decimals_cache[token] = int(raw, 16)
+    return [
+        int(raw, 16) / 10 ** (18 if token == PSEUDO_ETH_ADDRESS else _decimals_cache[token])
+        for token, raw in zip(tokens, results)
+    ]
+
+
+async def token_decimals_async(rpc, token_address: str) -> int:
+    token = token_address.lower()
+    if token == PSEUDO_ETH_ADDRESS:
+        return 18
+    if token not in _decimals_cache:
+        raw = await rpc.call('eth_call', {'to': token, 'data': DECIMALS_SELECTOR}, 'latest')
+        _decimals_cache[token] = int(raw, 16)
+    return _decimals_cache[token]
+
+
+async def allowance_async(rpc, token_address: str, owner: str, spender: str) -> int:
+    data = ALLOWANCE_SELECTOR + _abi_address(owner) + _abi_address(spender)
+    return int(await rpc.call('eth_call', {'to': token_address, 'data': data}, 'latest'), 16)
+
+
+async def get_balances_async(rpc, wallet_address: str) -> dict:
+    """
+    get_balances() для async-view: ETH/WETH/UJO одним пакетом JSON-RPC.
+    """
+    try:
+        eth_bal, wbal, ujo_bal = await token_balances_async(
+            rpc, wallet_address, [PSEUDO_ETH_ADDRESS, WETH_CONTRACT_ADDRESS, UJO_CONTRACT_ADDRESS]
+        )
+        return {
+            "balances": {
+                "eth": math.floor(eth_bal * 1e4) / 1e4,
+                "weth": math.floor(wbal * 1e4) / 1e4,
+                "ujo": math.floor(ujo_bal * 1e4) / 1e4
+            }
+        }
+    except Exception as e:
+        logger.error(f"get_balances_async error: {e}", exc_info=True)
+        return {"balances": {"eth": 0, "weth": 0, "ujo": 0}}
+
+
+async def get_token_price_in_usd_async(client) -> float:
+    try:
+        pair_address = os.environ.get("DEXScreener_PAIR_ADDRESS", "")
+        if not pair_address:
+            logger.error("DEXScreener_PAIR_ADDRESS (адрес токена) не задан.")
+            return 0.0
+        resp = await client.get(_gecko_price_url(pair_address), headers=GECKO_HEADERS, timeout=10)
+        if resp.status_code != 200:
+            logger.error(f"GeckoTerminal code={resp.status_code}")
+            return 0.0
+        return _parse_gecko_price(resp.json(), pair_address)
+    except Exception as e:
+        logger.error(f"get_token_price_in_usd_async: {e}", exc_info=True)
+        return 0.0
+
+
+async def confirm_staking_tx_async(rpc, client, user: User, tx_hash: str) -> bool:
+    """
+    confirm_staking_tx() для async-view: receipt, цена и decimals запрашиваются
+    параллельно, запись в БД — в потоке запроса.
+    """
+    if not user or not tx_hash:
+        return False
+    try:
+        receipt, price_usd, token_decimals = await asyncio.gather(
+            rpc.call('eth_getTransactionReceipt', tx_hash),
+            get_token_price_in_usd_async(client),
+            token_decimals_async(rpc, TOKEN_CONTRACT_ADDRESS),
+        )
+        if not receipt or int(receipt.get('status') or '0x0', 16) != 1:
+            logger.error(f"Tx not found or fail: {tx_hash}")
+            return False
+        if price_usd <= 0:
+            return False
+
+        found = _find_staking_transfer(receipt['logs'], user.unique_wallet_address, price_usd, token_decimals)
+        if not found:
+            logger.warning("Not found an appropriate Transfer in logs.")
+            return False
+
+        return await run_sync(_record_staking, user, tx_hash, found)
+    except Exception as e:
+        logger.error(f"[confirm_staking_tx_async] except: {e}", exc_info=True)
+        return False
+
 def accumulate_staking_rewards():
     """
     Каждую минуту: + (12% / 525600) * staked_amount
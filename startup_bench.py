@@ -0,0 +1,118 @@
+# startup_bench.py
+"""
+Время импорта и прирост RSS по подсистемам.
+
+    python startup_bench.py                 # каждая подсистема в отдельном чистом процессе
+    python startup_bench.py --app           # + импорт app.py: время, RSS и какие тяжёлые
+                                            #   модули загрузились при старте (нужны env-переменные app)
+    python startup_bench.py --json          # то же в JSON
+
+Подсистема, которой нет в окружении, выводится как 'not installed'.
+"""
+
+import argparse
+import json
+import os
+import subprocess
+import sys
+
+# Подсистемы -> модули, которые они импортируют
+SUBSYSTEMS = {
+    'torch': ['torch'],
+    'torchvision': ['torchvision'],
+    'trend_inference': ['trend_inference'],
+    'tensorflow': ['tensorflow'],
+    'matplotlib': ['matplotlib', 'matplotlib.figure', 'matplotlib.backends.backend_agg'],
+    'numpy': ['numpy'],
+    'pandas': ['pandas'],
+    'yfinance': ['yfinance'],
+    'openai': ['openai'],
+    'boto3': ['boto3'],
+    'web3': ['web3', 'eth_account'],
+    'telegram': ['telegram', 'telegram.ext'],
+    'flask_sqlalchemy': ['flask', 'flask_sqlalchemy'],
+}
+
+# Модули, которых не должно быть в sys.modules сразу после импорта app
+HEAVY_MODULES = ('torch', 'torchvision', 'tensorflow', 'matplotlib', 'numpy', 'pandas',
+                 'yfinance', 'openai', 'web3', 'eth_account', 'cv2', 'skimage', 'mplfinance', 'PIL')
+
+_MEASURE = r"""
+import json, sys, time
+from lazy_imports import current_rss_bytes
+modules = json.loads(sys.argv[1])
+rss_before = current_rss_bytes()
+started = time.perf_counter()
+try:
+    for name in modules:
+        __import__(name)
+except ImportError as e:
+    print(json.dumps({'error': f'not installed ({e.name})'}))
+    raise SystemExit(0)
+print(json.dumps({
+    'seconds': time.perf_counter() - started,
+    'rss_delta_mb': (current_rss_bytes() - rss_before) / (1024 * 1024),
+    'rss_mb': current_rss_bytes() / (1024 * 1024),
+}))
+"""
+
+
+def measure_subsystem(modules):
+    proc = subprocess.run(
+        [sys.executable, '-c', _MEASURE, json.dumps(modules)],
+        capture_output=True, text=True, cwd=os.path.dirname(os.path.abspath(__file__))
+    )
+    lines = proc.stdout.strip().splitlines()
+    if proc.returncode != 0 or not lines:
+        return {'error': (proc.stderr.strip().splitlines() or ['failed'])[-1]}
+    return json.loads(lines[-1])
+
+
+def measure_app():
+    """
+    Импортирует app в текущем процессе (должен быть чистым).
+    """
+    import time
+    from lazy_imports import current_rss_bytes, import_stats
+
+    rss_before = current_rss_bytes()
+    started = time.perf_counter()
+    import app  # noqa: F401
+    elapsed = time.perf_counter() - started
+    return {
+        'seconds': elapsed,
+        'rss_delta_mb': (current_rss_bytes() - rss_before) / (1024 * 1024),
+        'heavy_loaded': sorted(name for name in HEAVY_MODULES if name in sys.modules),
+        'lazy_loaded_at_startup': sorted(import_stats),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Import time and RSS per subsystem")
+    parser.add_argument('--app', action='store_true', help="also import app.py and list heavy modules it loaded")
+    parser.add_argument('--only', nargs='*', help="subsystems to measure (default: all)")
+    parser.add_argument('--json', action='store_true')
+    args = parser.parse_args()
+
+    names = args.only or list(SUBSYSTEMS)
+    results = {name: measure_subsystem(SUBSYSTEMS[name]) for name in names if name in SUBSYSTEMS}
+    app_result = measure_app() if args.app else None
+
+    if args.json:
+        print(json.dumps({'subsystems': results, 'app': app_result}, indent=2))
+        return
+
+    print(f"{'subsystem':<18}{'import, ms':>12}{'RSS +MB':>10}")
+    for name, result in sorted(results.items(), key=lambda item: -item[1].get('seconds', -1)):
+        if 'error' in result:
+            print(f"{name:<18}  {result['error']}")
+        else:
+            print(f"{name:<18}{result['seconds'] * 1000:>12.0f}{result['rss_delta_mb']:>10.1f}")
+    if app_result:
+        print(f"\nimport app: {app_result['seconds'] * 1000:.0f} ms, RSS +{app_result['rss_delta_mb']:.1f} MB")
+        print(f"  heavy modules loaded at startup: {', '.join(app_result['heavy_loaded']) or 'none'}")
+        print(f"  loaded through lazy facades at startup: {', '.join(app_result['lazy_loaded_at_startup']) or 'none'}")
+
+
+if __name__ == '__main__':
+    main()
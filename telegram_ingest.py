@@ -0,0 +1,134 @@
+# telegram_ingest.py
+
+import logging
+import os
+import queue
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+# Число потоков-обработчиков апдейтов на процесс
+WEBHOOK_WORKERS = int(os.environ.get('TELEGRAM_WEBHOOK_WORKERS', '4'))
+# Суммарная ёмкость очередей (делится поровну между потоками)
+WEBHOOK_QUEUE_SIZE = int(os.environ.get('TELEGRAM_WEBHOOK_QUEUE_SIZE', '1000'))
+# Что делать при переполнении: 'reject' — отвечаем 503, Telegram доставит
+# апдейт повторно (backpressure); 'drop' — подтверждаем и теряем апдейт
+WEBHOOK_OVERFLOW = os.environ.get('TELEGRAM_WEBHOOK_OVERFLOW', 'reject').lower()
+
+
+def update_chat_key(payload):
+    """
+    Ключ упорядочивания апдейта: id чата (или пользователя) из сырого JSON.
+    Апдейты с одним ключом обрабатываются одним потоком строго по порядку.
+    """
+    for name, value in payload.items():
+        if not isinstance(value, dict):
+            continue
+        chat = value.get('chat') or (value.get('message') or {}).get('chat')
+        if chat and 'id' in chat:
+            return chat['id']
+        sender = value.get('from') or value.get('user')
+        if sender and 'id' in sender:
+            return sender['id']
+    return payload.get('update_id', 0)
+
+
+class UpdateIngestor:
+    """
+    Приём апдейтов вебхука: submit() только кладёт JSON в ограниченную
+    очередь, обработка (Update.de_json + dispatcher) идёт в пуле потоков.
+    У каждого потока своя очередь, апдейты распределяются по ключу чата —
+    так сообщения одного чата не обгоняют друг друга, а разные чаты
+    обрабатываются параллельно.
+    """
+
+    def __init__(self, handler, workers=WEBHOOK_WORKERS, queue_size=WEBHOOK_QUEUE_SIZE,
+                 overflow=WEBHOOK_OVERFLOW):
+        self.handler = handler
+        self.workers = max(workers, 1)
+        self.shard_size = max(queue_size // self.workers, 1)
+        self.overflow = overflow
+        self._queues = []
+        self._threads = []
+        self._pid = None
+        self._start_lock = threading.Lock()
+        self._stats_lock = threading.Lock()
+        self._stats = {
+            'received': 0, 'processed': 0, 'failed': 0,
+            'dropped': 0, 'rejected': 0,
+            'max_depth': 0, 'max_wait_ms': 0.0, 'total_wait_ms': 0.0,
+        }
+
+    def _ensure_workers(self):
+        # Потоки не переживают fork — в каждом воркере gunicorn свой пул
+        pid = os.getpid()
+        if self._pid == pid:
+            return
+        with self._start_lock:
+            if self._pid == pid:
+                return
+            self._queues = [queue.Queue(maxsize=self.shard_size) for _ in range(self.workers)]
+            self._threads = []
+            for index, shard in enumerate(self._queues):
+                thread = threading.Thread(
+                    target=self._run, args=(shard,), name=f'telegram-update-{index}', daemon=True
+                )
+                thread.start()
+                self._threads.append(thread)
+            self._pid = pid
+
+    def _count(self, key, amount=1):
+        with self._stats_lock:
+            self._stats[key] += amount
+
+    def submit(self, payload):
+        """
+        Ставит апдейт в очередь. Возвращает True, если апдейт принят
+        (поставлен или отброшен в режиме 'drop'), False — если вызывающему
+        нужно ответить ошибкой, чтобы Telegram повторил доставку.
+        """
+        self._ensure_workers()
+        self._count('received')
+        shard = self._queues[hash(update_chat_key(payload)) % self.workers]
+        try:
+            shard.put_nowait((time.monotonic(), payload))
+        except queue.Full:
+            key = 'dropped' if self.overflow == 'drop' else 'rejected'
+            with self._stats_lock:
+                self._stats[key] += 1
+                total = self._stats[key]
+            # При перегрузке не пишем строку на каждый апдейт
+            if total % 100 == 1:
+                logger.warning(f"Telegram update queue full: {total} updates {key} so far.")
+            return key == 'dropped'
+        depth = shard.qsize()
+        with self._stats_lock:
+            if depth > self._stats['max_depth']:
+                self._stats['max_depth'] = depth
+        return True
+
+    def _run(self, shard):
+        while True:
+            enqueued_at, payload = shard.get()
+            wait_ms = (time.monotonic() - enqueued_at) * 1000
+            with self._stats_lock:
+                self._stats['total_wait_ms'] += wait_ms
+                self._stats['max_wait_ms'] = max(self._stats['max_wait_ms'], wait_ms)
+            try:
+                self.handler(payload)
+                self._count('processed')
+            except Exception as e:
+                self._count('failed')
+                logger.error(f"Error processing Telegram update {payload.get('update_id')}: {e}", exc_info=True)
+
+    def stats(self):
+        with self._stats_lock:
+            result = dict(self._stats)
+        handled = result['processed'] + result['failed']
+        result['avg_wait_ms'] = result.pop('total_wait_ms') / handled if handled else 0.0
+        result['workers'] = self.workers
+        result['overflow'] = self.overflow
+        result['queue_capacity'] = self.shard_size * self.workers
+        result['queue_depth'] = [q.qsize() for q in self._queues]
+        return result
@@ -0,0 +1,244 @@
+# telegram_notify.py
+
+import atexit
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict, deque
+
+from telegram.error import BadRequest, NetworkError, RetryAfter, Unauthorized
+
+logger = logging.getLogger(__name__)
+
+# Лимиты Bot API: ~30 сообщений/с на бота и ~1 сообщение/с в один чат.
+# Лимит глобальный на процесс — при нескольких воркерах делите между ними.
+GLOBAL_RATE = int(os.environ.get('TELEGRAM_GLOBAL_RATE', '25'))
+PER_CHAT_INTERVAL = float(os.environ.get('TELEGRAM_PER_CHAT_INTERVAL', '1.0'))
+# Повторы при сетевых ошибках (429 повторяется всегда, по retry_after)
+MAX_ATTEMPTS = int(os.environ.get('TELEGRAM_MAX_ATTEMPTS', '5'))
+RETRY_BACKOFF = 2.0
+# Максимальная длина одного сообщения в Telegram
+MAX_MESSAGE_LENGTH = 4096
+# Сколько ждать доставки очереди при завершении процесса (секунды)
+SHUTDOWN_DRAIN_TIMEOUT = 5.0
+
+
+def coalesce_messages(texts, limit=MAX_MESSAGE_LENGTH):
+    """
+    Склеивает накопившиеся для одного чата тексты в минимальное число
+    сообщений не длиннее limit (слишком длинный текст режется).
+    """
+    chunks = []
+    current = ''
+    for text in texts:
+        while len(text) > limit:
+            if current:
+                chunks.append(current)
+                current = ''
+            chunks.append(text[:limit])
+            text = text[limit:]
+        if not current:
+            current = text
+        elif len(current) + 2 + len(text) <= limit:
+            current = f"{current}\n\n{text}"
+        else:
+            chunks.append(current)
+            current = text
+    if current:
+        chunks.append(current)
+    return chunks
+
+
+class NotificationQueue:
+    """
+    Очередь исходящих уведомлений в Telegram с фоновым воркером.
+
+    send() не блокирует вызывающий код (финализация опросов, выплаты):
+    сообщения складываются по chat_id, воркер отправляет их с учётом
+    глобального и по-чатового лимитов, склеивая всё накопленное для чата
+    в одно сообщение. Если накопленное не влезает в одно сообщение, за раз
+    отправляется одна часть, остальные возвращаются в очередь с паузой
+    per_chat_interval. На 429 отправка всех чатов приостанавливается на
+    retry_after, сообщение возвращается в начало очереди.
+    """
+
+    def __init__(self, bot=None, global_rate=GLOBAL_RATE, per_chat_interval=PER_CHAT_INTERVAL,
+                 max_attempts=MAX_ATTEMPTS):
+        self.bot = bot
+        self.global_rate = global_rate
+        self.per_chat_interval = per_chat_interval
+        self.max_attempts = max_attempts
+
+        self._cond = threading.Condition()
+        self._pending = OrderedDict()   # chat_id -> [text, ...]
+        self._attempts = {}             # chat_id -> неудачных попыток подряд
+        self._not_before = {}           # chat_id -> monotonic, раньше которого в чат не пишем
+        self._sent_times = deque()      # моменты отправок за последнюю секунду
+        self._paused_until = 0.0
+        self._in_flight = 0
+        self._worker = None
+        self._worker_pid = None
+        self._stats = {
+            'queued': 0, 'sent': 0, 'coalesced': 0,
+            'rate_limited': 0, 'retried': 0, 'dropped': 0,
+        }
+
+    def bind(self, bot):
+        self.bot = bot
+
+    def send(self, chat_id, text):
+        """
+        Ставит сообщение в очередь. Возвращает сразу.
+        """
+        if not chat_id or not text:
+            return
+        with self._cond:
+            texts = self._pending.setdefault(chat_id, [])
+            if texts:
+                self._stats['coalesced'] += 1
+            texts.append(text)
+            self._stats['queued'] += 1
+            self._cond.notify()
+        self._ensure_worker()
+
+    def stats(self):
+        with self._cond:
+            result = dict(self._stats)
+            result['pending_chats'] = len(self._pending)
+            result['pending_messages'] = sum(len(t) for t in self._pending.values())
+            result['paused_for'] = max(self._paused_until - time.monotonic(), 0.0)
+            return result
+
+    def drain(self, timeout=None):
+        """
+        Ждёт, пока очередь опустеет (для завершения процесса и тестов).
+        Возвращает True, если всё отправлено (или отброшено) за timeout.
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self._cond:
+            while self._pending or self._in_flight:
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    return False
+                self._cond.wait(remaining)
+            return True
+
+    def _ensure_worker(self):
+        # Поток не переживает fork — после форка воркера gunicorn стартуем заново
+        pid = os.getpid()
+        with self._cond:
+            if self._worker is not None and self._worker_pid == pid and self._worker.is_alive():
+                return
+            self._worker_pid = pid
+            self._worker = threading.Thread(target=self._run, name='telegram-notify', daemon=True)
+            self._worker.start()
+
+    def _next_chat(self, now):
+        """
+        Первый чат, в который уже можно писать, либо (None, сколько ждать).
+        Вызывается под self._cond.
+        """
+        if now < self._paused_until:
+            return None, self._paused_until - now
+        while self._sent_times and now - self._sent_times[0] >= 1.0:
+            self._sent_times.popleft()
+        if len(self._sent_times) >= self.global_rate:
+            return None, 1.0 - (now - self._sent_times[0])
+        wait = None
+        for chat_id in self._pending:
+            not_before = self._not_before.get(chat_id, 0.0)
+            if not_before <= now:
+                return chat_id, 0.0
+            delay = not_before - now
+            wait = delay if wait is None else min(wait, delay)
+        return None, wait
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while True:
+                    now = time.monotonic()
+                    chat_id, wait = self._next_chat(now)
+                    if chat_id is not None:
+                        break
+                    self._cond.wait(wait)
+                texts = self._pending.pop(chat_id)
+                self._in_flight += 1
+            try:
+                self._deliver(chat_id, texts)
+            except Exception as e:
+                logger.error(f"Telegram notification worker error for chat {chat_id}: {e}", exc_info=True)
+            finally:
+                with self._cond:
+                    self._in_flight -= 1
+                    self._cond.notify_all()
+
+    def _requeue(self, chat_id, texts, delay):
+        # Под self._cond: неотправленное встаёт перед тем, что пришло за время отправки
+        texts = texts + self._pending.pop(chat_id, [])
+        self._pending[chat_id] = texts
+        self._pending.move_to_end(chat_id, last=False)
+        self._not_before[chat_id] = time.monotonic() + delay
+
+    def _deliver(self, chat_id, texts):
+        # За одну выборку из очереди — одно сообщение: остальные части
+        # возвращаются в очередь и ждут per_chat_interval и глобального лимита
+        chunks = coalesce_messages(texts)
+        with self._cond:
+            now = time.monotonic()
+            self._sent_times.append(now)
+            self._not_before[chat_id] = now + self.per_chat_interval
+        try:
+            self.bot.send_message(chat_id=chat_id, text=chunks[0])
+        except RetryAfter as e:
+            retry_after = float(e.retry_after)
+            logger.warning(f"Telegram 429 for chat {chat_id}, retrying after {retry_after}s.")
+            with self._cond:
+                self._stats['rate_limited'] += 1
+                # 429 — лимит бота целиком, притормаживаем все чаты
+                self._paused_until = max(self._paused_until, time.monotonic() + retry_after)
+                self._requeue(chat_id, chunks, retry_after)
+            return
+        except (Unauthorized, BadRequest) as e:
+            # Пользователь заблокировал бота / чат не найден — повтор не поможет
+            logger.warning(f"Telegram notification to chat {chat_id} dropped: {e}")
+            with self._cond:
+                self._stats['dropped'] += len(chunks)
+                self._attempts.pop(chat_id, None)
+            return
+        except NetworkError as e:
+            with self._cond:
+                attempts = self._attempts.get(chat_id, 0) + 1
+                if attempts >= self.max_attempts:
+                    logger.error(f"Telegram notification to chat {chat_id} dropped after {attempts} attempts: {e}")
+                    self._stats['dropped'] += len(chunks)
+                    self._attempts.pop(chat_id, None)
+                    return
+                self._attempts[chat_id] = attempts
+                self._stats['retried'] += 1
+                delay = RETRY_BACKOFF ** attempts
+                logger.warning(f"Telegram notification to chat {chat_id} failed ({e}), retry in {delay:.0f}s.")
+                self._requeue(chat_id, chunks, delay)
+            return
+        with self._cond:
+            self._stats['sent'] += 1
+            self._attempts.pop(chat_id, None)
+            if len(chunks) > 1:
+                self._requeue(chat_id, chunks[1:], self.per_chat_interval)
+
+notification_queue = NotificationQueue()
+
+
+def send_notification(chat_id, text):
+    """
+    Асинхронное уведомление пользователю в Telegram (через общую очередь).
+    """
+    notification_queue.send(chat_id, text)
+
+
+@atexit.register
+def _drain_on_exit():
+    if notification_queue._worker is not None and notification_queue._worker_pid == os.getpid():
+        if not notification_queue.drain(SHUTDOWN_DRAIN_TIMEOUT):
+            logger.warning(f"Telegram notification queue not drained on exit: {notification_queue.stats()}")
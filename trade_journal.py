@@ -0,0 +1,370 @@
+# trade_journal.py
+
+import csv
+import io
+import json
+import logging
+import tempfile
+from collections import namedtuple
+from datetime import datetime
+
+from sqlalchemy import func, literal_column, tuple_
+
+from assistant_context import bump_trade_stats_version
+from models import db, Trade, Instrument, Setup, Criterion, trade_criteria
+from instrument_resolver import get_instrument_resolver
+
+logger = logging.getLogger(__name__)
+
+# Лимит для function call create_trades (ассистент) и для импорта журнала
+MAX_CHAT_TRADES = 5
+MAX_IMPORT_TRADES = 10000
+
+# Обязательные колонки импорта (CSV-заголовок или ключи JSON-объектов);
+# необязательные: exit_price, close_time, comment
+REQUIRED_IMPORT_FIELDS = ('instrument', 'direction', 'entry_price', 'open_time')
+
+# Сколько ошибок валидации возвращать клиенту (остальные только считаются)
+MAX_REPORTED_ERRORS = 50
+
+# Колонки экспорта; первые совпадают с форматом импорта, чтобы файл можно было загрузить обратно
+EXPORT_FIELDS = ['id', 'instrument', 'direction', 'entry_price', 'open_time',
+                 'exit_price', 'close_time', 'comment', 'setup', 'criteria',
+                 'profit_loss', 'profit_loss_percentage']
+
+# Размер пачки для server-side cursor (yield_per) и для одного CSV-чанка / row group Parquet
+EXPORT_BATCH_SIZE = 1000
+
+BulkCreateResult = namedtuple('BulkCreateResult', ['created', 'created_ids', 'duplicates_skipped', 'errors'])
+
+
+def parse_date_time(dt_str: str) -> datetime:
+    """
+    Парсит строку даты/времени. Поддерживает форматы:
+      1) 'YYYY-MM-DD HH:MM:SS'
+      2) 'YYYY-MM-DD' (тогда автоматически добавляется '00:00:00')
+    При неудаче выбрасывает ValueError.
+    """
+    dt_str = dt_str.strip()
+    # Сначала пробуем "YYYY-MM-DD HH:MM:SS"
+    try:
+        return datetime.strptime(dt_str, "%Y-%m-%d %H:%M:%S")
+    except ValueError:
+        # Пробуем "YYYY-MM-DD"
+        try:
+            d = datetime.strptime(dt_str, "%Y-%m-%d")
+            return d
+        except ValueError:
+            raise ValueError(
+                f"Invalid date/time format: '{dt_str}'. Use 'YYYY-MM-DD' or 'YYYY-MM-DD HH:MM:SS'."
+            )
+
+
+def _to_float(value, field):
+    if value is None or value == '':
+        return None
+    try:
+        return float(str(value).strip().replace(',', '.'))
+    except ValueError:
+        raise ValueError(f"Invalid number for '{field}': '{value}'.")
+
+
+def _build_trade_row(user_id, raw, instrument_record):
+    """
+    Валидирует одну сделку и возвращает dict с колонками таблицы trade.
+    Бросает ValueError при некорректных данных.
+    """
+    direction = (raw.get('direction') or '').strip().capitalize()
+    if direction not in ["Buy", "Sell"]:
+        raise ValueError(f"Direction must be 'Buy' or 'Sell', got '{raw.get('direction')}'.")
+
+    entry_price = _to_float(raw.get('entry_price'), 'entry_price')
+    if entry_price is None or entry_price <= 0:
+        raise ValueError(f"Entry price must be > 0, got {raw.get('entry_price')}.")
+
+    open_time = raw.get('open_time')
+    if not open_time:
+        raise ValueError("open_time is required.")
+    open_dt = parse_date_time(str(open_time))
+
+    close_time = raw.get('close_time')
+    close_dt = parse_date_time(str(close_time)) if close_time else None
+
+    exit_price = _to_float(raw.get('exit_price'), 'exit_price') or None
+
+    # Если задан exit_price, считаем profit_loss
+    if exit_price:
+        sign = 1 if direction == 'Buy' else -1
+        profit_loss = (exit_price - entry_price) * sign
+        profit_loss_percentage = (profit_loss / entry_price) * 100
+    else:
+        profit_loss = None
+        profit_loss_percentage = None
+
+    return {
+        'user_id': user_id,
+        'instrument_id': instrument_record.id,
+        'direction': direction,
+        'entry_price': entry_price,
+        'exit_price': exit_price,
+        # Колонка trade_open_time имеет тип Date
+        'trade_open_time': open_dt.date(),
+        'trade_close_time': close_dt.date() if close_dt else None,
+        'comment': raw.get('comment') or None,
+        'profit_loss': profit_loss,
+        'profit_loss_percentage': profit_loss_percentage,
+    }
+
+
+def _duplicate_key(row):
+    return (row['instrument_id'], row['direction'], row['entry_price'], row['trade_open_time'])
+
+
+def find_existing_trade_keys(user_id, keys):
+    """
+    Одним запросом находит, какие из (instrument_id, direction, entry_price, open_date)
+    уже есть в журнале пользователя.
+    """
+    keys = list(keys)
+    if not keys:
+        return set()
+    rows = db.session.query(
+        Trade.instrument_id, Trade.direction, Trade.entry_price, Trade.trade_open_time
+    ).filter(
+        Trade.user_id == user_id,
+        tuple_(Trade.instrument_id, Trade.direction, Trade.entry_price, Trade.trade_open_time).in_(keys)
+    ).all()
+    return {tuple(r) for r in rows}
+
+
+def bulk_create_trades(user_id, trades, return_ids=True, stop_on_error=False):
+    """
+    Bulk-путь создания сделок, общий для create_trades (ассистент) и импорта журнала:
+      1) все инструменты разрешаются за один проход по InstrumentResolver;
+      2) дубликаты (в журнале и внутри самого батча) ищутся одним запросом
+         по кортежам (instrument, direction, entry_price, open_time);
+      3) новые сделки вставляются одним flush.
+
+    return_ids=True — ORM-вставка (нужны id созданных сделок, для маленьких батчей).
+    return_ids=False — bulk_insert_mappings (executemany), для больших импортов.
+    stop_on_error=True — первая ошибка валидации бросает ValueError (поведение чата).
+    Коммит остаётся за вызывающим кодом.
+    """
+    resolved = get_instrument_resolver().resolve_many(
+        (t.get('instrument') or '').strip() for t in trades
+    )
+
+    rows = []
+    errors = []
+    for index, raw in enumerate(trades, start=1):
+        try:
+            instrument_record = resolved[(raw.get('instrument') or '').strip()]
+            if isinstance(instrument_record, ValueError):
+                raise instrument_record
+            rows.append(_build_trade_row(user_id, raw, instrument_record))
+        except ValueError as e:
+            if stop_on_error:
+                raise
+            errors.append(f"Row {index}: {e}")
+
+    existing = find_existing_trade_keys(user_id, {_duplicate_key(r) for r in rows})
+    new_rows = []
+    duplicates_skipped = 0
+    for row in rows:
+        key = _duplicate_key(row)
+        if key in existing:
+            duplicates_skipped += 1
+            continue
+        existing.add(key)
+        new_rows.append(row)
+
+    created_ids = []
+    if new_rows:
+        if return_ids:
+            new_trades = [Trade(**row) for row in new_rows]
+            db.session.add_all(new_trades)
+            db.session.flush()
+            created_ids = [t.id for t in new_trades]
+        else:
+            db.session.bulk_insert_mappings(Trade, new_rows)
+            db.session.flush()
+        bump_trade_stats_version(user_id)
+
+    logger.info(
+        f"bulk_create_trades: user={user_id}, received={len(trades)}, created={len(new_rows)}, "
+        f"duplicates={duplicates_skipped}, errors={len(errors)}."
+    )
+    return BulkCreateResult(len(new_rows), created_ids, duplicates_skipped, errors)
+
+
+def trades_from_json(payload):
+    """
+    Достаёт список сделок из JSON: список объектов или {"trades": [...]}.
+    """
+    if isinstance(payload, dict):
+        payload = payload.get('trades', [])
+    if not isinstance(payload, list):
+        raise ValueError("JSON import must be a list of trades or {'trades': [...]}.")
+    return [t for t in payload if isinstance(t, dict)]
+
+
+def parse_import_payload(data: bytes, filename: str = '', content_type: str = ''):
+    """
+    Разбирает файл импорта журнала: CSV (с заголовком) или JSON
+    (список объектов или {"trades": [...]}). Возвращает список dict.
+    """
+    filename = (filename or '').lower()
+    content_type = (content_type or '').lower()
+    text = data.decode('utf-8-sig')
+
+    if filename.endswith('.json') or 'json' in content_type:
+        return trades_from_json(json.loads(text))
+
+    reader = csv.DictReader(io.StringIO(text))
+    if not reader.fieldnames:
+        raise ValueError("CSV import is empty.")
+    missing = [f for f in REQUIRED_IMPORT_FIELDS
+               if f not in [h.strip().lower() for h in reader.fieldnames]]
+    if missing:
+        raise ValueError(f"CSV import is missing columns: {', '.join(missing)}.")
+    trades = []
+    try:
+        for row in reader:
+            trades.append({(k or '').strip().lower(): (v.strip() if isinstance(v, str) else v)
+                           for k, v in row.items()})
+    except csv.Error as e:
+        raise ValueError(f"CSV parse error at line {reader.line_num}: {e}")
+    return trades
+
+
+def journal_export_query(user_id):
+    """
+    Один запрос для экспорта журнала: сделки + имя инструмента + имя сетапа +
+    критерии, склеенные string_agg в подзапросе (без N+1 по trade.criteria).
+    Результат читается через server-side cursor пачками EXPORT_BATCH_SIZE.
+    """
+    # Критерии агрегируются только по сделкам этого пользователя, а не по всей trade_criteria
+    criteria_subq = db.session.query(
+        trade_criteria.c.trade_id.label('trade_id'),
+        func.string_agg(Criterion.name, literal_column("'; '")).label('criteria')
+    ).select_from(trade_criteria).join(
+        Trade, Trade.id == trade_criteria.c.trade_id
+    ).join(
+        Criterion, Criterion.id == trade_criteria.c.criterion_id
+    ).filter(
+        Trade.user_id == user_id
+    ).group_by(trade_criteria.c.trade_id).subquery()
+
+    return db.session.query(
+        Trade.id,
+        Instrument.name.label('instrument'),
+        Trade.direction,
+        Trade.entry_price,
+        Trade.trade_open_time.label('open_time'),
+        Trade.exit_price,
+        Trade.trade_close_time.label('close_time'),
+        Trade.comment,
+        Setup.setup_name.label('setup'),
+        criteria_subq.c.criteria,
+        Trade.profit_loss,
+        Trade.profit_loss_percentage
+    ).join(
+        Instrument, Instrument.id == Trade.instrument_id
+    ).outerjoin(
+        Setup, Setup.id == Trade.setup_id
+    ).outerjoin(
+        criteria_subq, criteria_subq.c.trade_id == Trade.id
+    ).filter(
+        Trade.user_id == user_id
+    ).order_by(
+        Trade.trade_open_time, Trade.id
+    ).execution_options(stream_results=True).yield_per(EXPORT_BATCH_SIZE)
+
+
+def iter_journal_csv(user_id):
+    """
+    Генератор CSV-чанков для streaming-ответа: заголовок, затем по чанку
+    на каждые EXPORT_BATCH_SIZE строк. Память не зависит от размера журнала.
+    """
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(EXPORT_FIELDS)
+
+    count = 0
+    for row in journal_export_query(user_id):
+        writer.writerow(['' if value is None else value for value in row])
+        count += 1
+        if count % EXPORT_BATCH_SIZE == 0:
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate(0)
+
+    yield buffer.getvalue()
+    logger.info(f"CSV export for user {user_id} finished: {count} trades.")
+
+
+def write_journal_parquet(user_id):
+    """
+    Пишет журнал в Parquet (по row group на пачку) во временный файл и
+    возвращает его, перемотанным в начало. Требует pyarrow.
+    """
+    try:
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+    except ImportError:
+        raise RuntimeError("Parquet export requires the 'pyarrow' package.")
+
+    schema = pa.schema([
+        ('id', pa.int64()),
+        ('instrument', pa.string()),
+        ('direction', pa.string()),
+        ('entry_price', pa.float64()),
+        ('open_time', pa.date32()),
+        ('exit_price', pa.float64()),
+        ('close_time', pa.date32()),
+        ('comment', pa.string()),
+        ('setup', pa.string()),
+        ('criteria', pa.string()),
+        ('profit_loss', pa.float64()),
+        ('profit_loss_percentage', pa.float64()),
+    ])
+
+    tmp = tempfile.TemporaryFile()
+    count = 0
+    with pq.ParquetWriter(tmp, schema, compression='snappy') as writer:
+        batch = []
+        for row in journal_export_query(user_id):
+            batch.append(row)
+            if len(batch) >= EXPORT_BATCH_SIZE:
+                writer.write_table(_parquet_table(pa, schema, batch))
+                count += len(batch)
+                batch = []
+        if batch or count == 0:
+            writer.write_table(_parquet_table(pa, schema, batch))
+            count += len(batch)
+
+    tmp.seek(0)
+    logger.info(f"Parquet export for user {user_id} finished: {count} trades.")
+    return tmp
+
+
+def _parquet_table(pa, schema, rows):
+    columns = list(zip(*rows)) if rows else [[] for _ in EXPORT_FIELDS]
+    return pa.Table.from_arrays(
+        [pa.array(list(col), type=field.type) for col, field in zip(columns, schema)],
+        schema=schema
+    )
+
+
+def iter_file_chunks(fileobj, chunk_size=64 * 1024):
+    """
+    Отдаёт файл чанками и закрывает его по окончании.
+    """
+    try:
+        while True:
+            chunk = fileobj.read(chunk_size)
+            if not chunk:
+                break
+            yield chunk
+    finally:
+        fileobj.close()
@@ -0,0 +1,128 @@
+# trend_export.py
+"""
+Экспорт TrendCNN в оптимизированный артефакт для CPU-инференса.
+
+    python trend_export.py [--model trend_model.pth] [--out trend_model_int8.pt]
+                           [--images <папка с графиками>] [--samples 256]
+
+Шаги: загрузка fp32-весов -> динамическая int8-квантизация слоёв nn.Linear
+(на них приходится основная часть весов: 32*32*32 -> 128) -> torch.jit.script
+-> проверка паритета с исходной моделью -> сохранение. Артефакт включается
+в приложении через TREND_BACKEND=torchscript_int8.
+"""
+
+import argparse
+import logging
+import os
+import sys
+
+import torch
+import torch.nn as nn
+
+from trend_inference import (
+    TREND_MODEL_PATH, TREND_SCRIPTED_MODEL_PATH,
+    load_eager_model, preprocess_image, select_quantized_engine
+)
+
+logger = logging.getLogger(__name__)
+
+# Минимальная доля совпадающих top-1 предсказаний квантизованной модели с fp32
+PARITY_MIN_AGREEMENT = 0.99
+IMAGE_EXTENSIONS = ('.png', '.jpg', '.jpeg', '.webp', '.bmp')
+
+
+def quantize_dynamic_int8(model):
+    """
+    Динамическая квантизация: веса Linear хранятся в int8, активации
+    квантуются на лету. Свёртки остаются в fp32.
+    """
+    select_quantized_engine()
+    return torch.quantization.quantize_dynamic(model, {nn.Linear}, dtype=torch.qint8)
+
+
+def build_scripted_int8(model):
+    scripted = torch.jit.script(quantize_dynamic_int8(model))
+    scripted.eval()
+    return scripted
+
+
+def parity_inputs(images_dir=None, samples=256, seed=0):
+    """
+    Входы для проверки паритета: реальные графики из папки (если указана)
+    или синтетические тензоры в диапазоне нормализованных пикселей [-1, 1].
+    """
+    if images_dir:
+        files = sorted(
+            os.path.join(images_dir, name) for name in os.listdir(images_dir)
+            if name.lower().endswith(IMAGE_EXTENSIONS)
+        )[:samples]
+        if files:
+            tensors = []
+            for path in files:
+                with open(path, 'rb') as f:
+                    tensors.append(preprocess_image(f.read()))
+            return torch.cat(tensors, dim=0)
+        logger.warning(f"No images found in '{images_dir}', using synthetic inputs.")
+    generator = torch.Generator().manual_seed(seed)
+    return torch.rand((samples, 3, 128, 128), generator=generator) * 2 - 1
+
+
+def check_parity(reference, candidate, inputs, batch_size=32):
+    """
+    Сравнивает логиты и top-1 классы двух моделей.
+    Возвращает dict(agreement, max_abs_diff, samples).
+    """
+    agree = 0
+    max_abs_diff = 0.0
+    with torch.inference_mode():
+        for start in range(0, inputs.size(0), batch_size):
+            batch = inputs[start:start + batch_size]
+            ref_out = reference(batch)
+            cand_out = candidate(batch)
+            agree += int((ref_out.argmax(dim=1) == cand_out.argmax(dim=1)).sum())
+            max_abs_diff = max(max_abs_diff, float((ref_out - cand_out).abs().max()))
+    return {
+        'agreement': agree / inputs.size(0),
+        'max_abs_diff': max_abs_diff,
+        'samples': int(inputs.size(0)),
+    }
+
+
+def export(model_path=TREND_MODEL_PATH, out_path=TREND_SCRIPTED_MODEL_PATH, images_dir=None,
+           samples=256, min_agreement=PARITY_MIN_AGREEMENT):
+    reference = load_eager_model(model_path)
+    scripted = build_scripted_int8(reference)
+
+    report = check_parity(reference, scripted, parity_inputs(images_dir, samples))
+    print(
+        f"Parity vs '{model_path}': top-1 agreement {report['agreement'] * 100:.2f}% "
+        f"on {report['samples']} inputs, max |logit diff| {report['max_abs_diff']:.5f}"
+    )
+    if report['agreement'] < min_agreement:
+        print(f"Parity check failed (< {min_agreement * 100:.0f}%), artifact not written.")
+        return False
+
+    torch.jit.save(scripted, out_path)
+    print(
+        f"Saved '{out_path}' ({os.path.getsize(out_path) / 1024:.0f} KB, "
+        f"fp32 weights {os.path.getsize(model_path) / 1024:.0f} KB)."
+    )
+    return True
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Export TrendCNN to TorchScript with dynamic int8 Linear layers")
+    parser.add_argument('--model', default=TREND_MODEL_PATH)
+    parser.add_argument('--out', default=TREND_SCRIPTED_MODEL_PATH)
+    parser.add_argument('--images', default=None, help="folder with chart images for the parity check")
+    parser.add_argument('--samples', type=int, default=256)
+    parser.add_argument('--min-agreement', type=float, default=PARITY_MIN_AGREEMENT)
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    ok = export(args.model, args.out, args.images, args.samples, args.min_agreement)
+    sys.exit(0 if ok else 1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,322 @@
+# trend_inference.py
+
+import hashlib
+import io
+import logging
+import os
+import queue
+import threading
+import time
+from concurrent.futures import Future
+
+import torch
+import torch.nn as nn
+from PIL import Image
+from torchvision import transforms
+
+logger = logging.getLogger(__name__)
+
+TREND_MODEL_PATH = os.environ.get('TREND_MODEL_PATH', 'trend_model.pth')
+# Бэкенд инференса: 'eager' (fp32 nn.Module) или 'torchscript_int8'
+# (артефакт trend_export.py: TorchScript с динамической int8-квантизацией Linear)
+TREND_BACKEND = os.environ.get('TREND_BACKEND', 'eager').lower()
+TREND_SCRIPTED_MODEL_PATH = os.environ.get('TREND_SCRIPTED_MODEL_PATH', 'trend_model_int8.pt')
+# 0: downtrend, 1: sideways, 2: uptrend
+TREND_CLASSES = ["downtrend", "sideways", "uptrend"]
+
+# Потоки запросов в воркере (gunicorn.conf.py). С одним потоком соседних
+# запросов не бывает — предсказание выполняется сразу, без окна батчинга
+WEB_THREADS = int(os.environ.get('WEB_THREADS', '1'))
+# Микро-батчинг: сколько ждать соседние запросы (0 — не ждать, склеиваются только
+# уже стоящие в очереди) и максимальный размер батча
+BATCH_WINDOW_MS = float(os.environ.get('TREND_BATCH_WINDOW_MS', '10' if WEB_THREADS > 1 else '0'))
+MAX_BATCH_SIZE = int(os.environ.get('TREND_MAX_BATCH_SIZE', '16'))
+# Таймаут ожидания результата одним запросом (секунды)
+PREDICT_TIMEOUT = 30
+# Потоки torch на процесс: по умолчанию ядра делятся между воркерами gunicorn
+TORCH_THREADS = int(os.environ.get('TORCH_NUM_THREADS', '0'))
+
+# Препроцессинг строится один раз на модуль, а не на каждый вызов
+TREND_IMAGE_SIZE = (128, 128)
+TREND_TRANSFORM = transforms.Compose([
+    transforms.Resize(TREND_IMAGE_SIZE),
+    transforms.ToTensor(),
+    transforms.Normalize(mean=[0.5, 0.5, 0.5], std=[0.5, 0.5, 0.5])
+])
+# Сторона сетки dHash для кэша результатов (16 -> 256 бит)
+PHASH_SIZE = 16
+
+
+class TrendCNN(nn.Module):
+    def __init__(self, num_classes=3):
+        super(TrendCNN, self).__init__()
+        self.features = nn.Sequential(
+            nn.Conv2d(3, 16, kernel_size=3, padding=1),
+            nn.ReLU(),
+            nn.MaxPool2d(2),
+            nn.Conv2d(16, 32, kernel_size=3, padding=1),
+            nn.ReLU(),
+            nn.MaxPool2d(2)
+        )
+        self.classifier = nn.Sequential(
+            nn.Linear(32 * 32 * 32, 128),
+            nn.ReLU(),
+            nn.Linear(128, num_classes)
+        )
+
+    def forward(self, x):
+        x = self.features(x)
+        x = x.view(x.size(0), -1)
+        x = self.classifier(x)
+        return x
+
+
+def configure_torch_threads():
+    """
+    Ограничивает intra-op потоки torch, чтобы N воркеров gunicorn не
+    конкурировали за одни и те же ядра (oversubscription).
+    """
+    threads = TORCH_THREADS
+    if threads <= 0:
+        workers = int(os.environ.get('WEB_CONCURRENCY', '1')) or 1
+        threads = max(1, (os.cpu_count() or 1) // workers)
+    torch.set_num_threads(threads)
+    try:
+        torch.set_num_interop_threads(1)
+    except RuntimeError:
+        # Можно вызвать только до первой параллельной операции
+        pass
+    logger.info(f"Torch configured with {threads} intra-op threads.")
+    return threads
+
+
+def select_quantized_engine():
+    """
+    Выбирает движок квантизованных ядер: fbgemm на x86, qnnpack на ARM.
+    """
+    engines = torch.backends.quantized.supported_engines
+    for engine in ('fbgemm', 'x86', 'qnnpack'):
+        if engine in engines:
+            torch.backends.quantized.engine = engine
+            return engine
+    return None
+
+
+def load_eager_model(model_path=TREND_MODEL_PATH):
+    model = TrendCNN(num_classes=len(TREND_CLASSES))
+    # Set map_location to ensure compatibility across devices
+    model.load_state_dict(torch.load(model_path, map_location=torch.device('cpu')))
+    model.eval()
+    # Веса больше не меняются — не держим autograd-метаданные
+    for param in model.parameters():
+        param.requires_grad_(False)
+    return model
+
+
+def load_scripted_model(scripted_path=TREND_SCRIPTED_MODEL_PATH):
+    select_quantized_engine()
+    model = torch.jit.load(scripted_path, map_location=torch.device('cpu'))
+    model.eval()
+    return model
+
+
+def load_chart_image(source):
+    """
+    Декодирует изображение в памяти: bytes, file-like (в т.ч. поток загрузки
+    FileStorage) или готовый PIL.Image. На диск ничего не пишется.
+    """
+    if isinstance(source, Image.Image):
+        return source.convert('RGB')
+    if isinstance(source, (bytes, bytearray, memoryview)):
+        source = io.BytesIO(source)
+    img = Image.open(source)
+    img.load()
+    return img.convert('RGB')
+
+
+def preprocess_image(source):
+    """
+    Возвращает тензор [1, 3, 128, 128] для TrendCNN.
+    """
+    return TREND_TRANSFORM(load_chart_image(source)).unsqueeze(0)
+
+
+def chart_fingerprint(img):
+    """
+    (content_hash, phash) для кэша результатов:
+      * content_hash — sha256 пикселей 128x128 после того же resize, что в
+        TREND_TRANSFORM, т.е. ровно входа модели;
+      * phash — dHash 16x16 (256 бит, hex) того же изображения: перекодированный
+        скриншот с тем же содержимым даёт тот же хэш.
+    Кэш отдаёт результат только при совпадении content_hash или всех 256 бит
+    phash (расстояние Хэмминга 0).
+    """
+    normalized = img.resize(TREND_IMAGE_SIZE, Image.BILINEAR)
+    content_hash = hashlib.sha256(normalized.tobytes()).hexdigest()
+
+    small = normalized.convert('L').resize((PHASH_SIZE + 1, PHASH_SIZE), Image.BILINEAR)
+    pixels = list(small.getdata())
+    bits = 0
+    for row in range(PHASH_SIZE):
+        for col in range(PHASH_SIZE):
+            left = pixels[row * (PHASH_SIZE + 1) + col]
+            right = pixels[row * (PHASH_SIZE + 1) + col + 1]
+            bits = (bits << 1) | (1 if left > right else 0)
+    return content_hash, f"{bits:0{PHASH_SIZE * PHASH_SIZE // 4}x}"
+
+
+def file_fingerprint(path) -> str:
+    md5 = hashlib.md5()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b''):
+            md5.update(chunk)
+    return md5.hexdigest()
+
+
+class TrendInferenceService:
+    """
+    Holds the TrendCNN weights for the process and serves predictions.
+
+    load() is meant to run once at startup (in the gunicorn master with
+    --preload, so forked workers share the weights copy-on-write). Requests
+    submit single image tensors; a background thread groups the ones that
+    arrive within BATCH_WINDOW_MS into one forward pass. The batching
+    thread is started lazily in each worker, since threads do not survive
+    fork - no inference must run in the master before forking. With a
+    single request thread per worker there is nothing to batch, so
+    predictions run inline in the calling thread.
+    """
+
+    def __init__(self, model_path=TREND_MODEL_PATH, batch_window_ms=BATCH_WINDOW_MS,
+                 max_batch_size=MAX_BATCH_SIZE, backend=TREND_BACKEND,
+                 scripted_model_path=TREND_SCRIPTED_MODEL_PATH, request_threads=WEB_THREADS):
+        self.model_path = model_path
+        self.scripted_model_path = scripted_model_path
+        self.backend = backend
+        self.batch_window = batch_window_ms / 1000.0
+        self.inline = request_threads <= 1
+        self.max_batch_size = max_batch_size
+        self.model = None
+        # Версия загруженной модели (бэкенд + md5 файла) — ключ инвалидации кэша результатов
+        self.model_version = None
+        self._load_lock = threading.Lock()
+        self._queue = None
+        self._worker = None
+        self._worker_pid = None
+
+    @property
+    def loaded(self):
+        return self.model is not None
+
+    def load(self):
+        with self._load_lock:
+            if self.model is not None:
+                return self.model
+            started = time.time()
+
+            if self.backend == 'torchscript_int8':
+                if os.path.exists(self.scripted_model_path):
+                    self.model = load_scripted_model(self.scripted_model_path)
+                    self.model_version = f"torchscript_int8:{file_fingerprint(self.scripted_model_path)}"
+                    logger.info(
+                        f"Trend model (TorchScript int8) loaded from '{self.scripted_model_path}' "
+                        f"in {(time.time() - started) * 1000:.0f} ms."
+                    )
+                    return self.model
+                logger.warning(
+                    f"File '{self.scripted_model_path}' not found, falling back to eager fp32 trend model. "
+                    f"Run 'python trend_export.py' to build it."
+                )
+            elif self.backend != 'eager':
+                logger.warning(f"Unknown TREND_BACKEND '{self.backend}', using eager fp32 trend model.")
+
+            if not os.path.exists(self.model_path):
+                logger.warning(f"File '{self.model_path}' not found. Trend model will not be loaded.")
+                return None
+            self.model = load_eager_model(self.model_path)
+            self.model_version = f"eager:{file_fingerprint(self.model_path)}"
+            logger.info(f"Trend model loaded from '{self.model_path}' in {(time.time() - started) * 1000:.0f} ms.")
+            return self.model
+
+    def _ensure_worker(self):
+        pid = os.getpid()
+        if self._worker is not None and self._worker_pid == pid and self._worker.is_alive():
+            return
+        with self._load_lock:
+            if self._worker is not None and self._worker_pid == pid and self._worker.is_alive():
+                return
+            self._queue = queue.Queue()
+            self._worker_pid = pid
+            self._worker = threading.Thread(target=self._batch_loop, name='trend-batcher', daemon=True)
+            self._worker.start()
+
+    def _batch_loop(self):
+        while True:
+            batch = [self._queue.get()]
+            if self.batch_window <= 0:
+                # Без окна: в батч идут только запросы, уже ждущие в очереди
+                while len(batch) < self.max_batch_size:
+                    try:
+                        batch.append(self._queue.get_nowait())
+                    except queue.Empty:
+                        break
+                self._run_batch(batch)
+                continue
+            deadline = time.time() + self.batch_window
+            while len(batch) < self.max_batch_size:
+                timeout = deadline - time.time()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(self._queue.get(timeout=timeout))
+                except queue.Empty:
+                    break
+            self._run_batch(batch)
+
+    def _run_batch(self, batch):
+        tensors = [tensor for tensor, _ in batch]
+        futures = [future for _, future in batch]
+        try:
+            with torch.inference_mode():
+                outputs = self.model(torch.cat(tensors, dim=0))
+                predicted = torch.argmax(outputs, dim=1).tolist()
+            for future, index in zip(futures, predicted):
+                future.set_result(index)
+            if len(batch) > 1:
+                logger.debug(f"Trend batch of {len(batch)} images processed.")
+        except Exception as e:
+            logger.error(f"Error in trend batch inference: {e}", exc_info=True)
+            for future in futures:
+                if not future.done():
+                    future.set_exception(e)
+
+    def predict_index(self, img_tensor):
+        """
+        img_tensor: [1, 3, 128, 128]. Returns class index; blocks until the
+        micro-batch containing this image has been processed (or runs the
+        forward pass in place when the worker has one request thread).
+        """
+        if self.model is None and self.load() is None:
+            raise RuntimeError("Trend model not loaded.")
+        if self.inline:
+            with torch.inference_mode():
+                return int(torch.argmax(self.model(img_tensor), dim=1)[0])
+        self._ensure_worker()
+        future = Future()
+        self._queue.put((img_tensor, future))
+        return future.result(timeout=PREDICT_TIMEOUT)
+
+    def predict_label(self, img_tensor):
+        return TREND_CLASSES[self.predict_index(img_tensor)]
+
+
+trend_service = TrendInferenceService()
+
+
+def preload():
+    """
+    Хук для старта приложения (gunicorn --preload): настраивает потоки torch
+    и загружает веса один раз, до fork воркеров.
+    """
+    configure_torch_threads()
+    return trend_service.load()
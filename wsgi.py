@@ -0,0 +1,77 @@
+# wsgi.py
+"""
+Точка входа gunicorn: gunicorn wsgi:application (настройки — gunicorn.conf.py).
+
+create_app() импортирует app.py (маршруты, конфиг, задания) и, если включена
+предзагрузка (APP_PRELOAD=true, тогда gunicorn.conf.py включает preload_app),
+выполняет в мастере работу, результат которой воркеры разделяют после fork:
+
+  * веса TrendCNN (trend_inference.preload());
+  * справочник инструментов для поиска по названию (instrument_resolver);
+  * скомпилированные шаблоны Jinja;
+  * тяжёлые модули из PRELOAD_MODULES (numpy, matplotlib...).
+
+Планировщик, пулы БД, клиенты S3/RPC/OpenAI в мастере не создаются: пулы
+закрываются после прогрева, службы (@worker_service) стартуют в post_fork,
+ленивые клиенты (LazyObject) создаются в воркере при первом обращении.
+"""
+
+import logging
+import os
+
+from app_lifecycle import PRELOAD, prefork_setup
+from lazy_imports import load_module
+
+logger = logging.getLogger(__name__)
+
+# Модули, которые при предзагрузке импортируются в мастере (через запятую)
+PRELOAD_MODULES = [
+    name.strip() for name in os.environ.get(
+        'PRELOAD_MODULES',
+        'numpy,matplotlib.figure,matplotlib.backends.backend_agg,openai,web3,eth_account'
+    ).split(',') if name.strip()
+]
+
+
+def _preload_modules():
+    for name in PRELOAD_MODULES:
+        try:
+            load_module(name)
+        except ImportError as e:
+            logger.warning(f"Preload of module '{name}' skipped: {e}")
+
+
+def _compile_templates(app):
+    for name in app.jinja_env.list_templates(extensions=['html']):
+        app.jinja_env.get_template(name)
+
+
+def _build_instrument_index(app):
+    from instrument_resolver import get_instrument_resolver
+    with app.app_context():
+        get_instrument_resolver()
+
+
+def prefork_tasks(app):
+    return [
+        ('modules', _preload_modules),
+        ('trend model', lambda: load_module('trend_inference').preload()),
+        ('instrument index', lambda: _build_instrument_index(app)),
+        ('templates', lambda: _compile_templates(app)),
+    ]
+
+
+def create_app():
+    from app import app, db
+    from db_engines import created_engines
+
+    if PRELOAD:
+        with app.app_context():
+            prefork_setup(
+                prefork_tasks(app),
+                engines=lambda: [db.engine, *created_engines().values()],
+            )
+    return app
+
+
+application = create_app()